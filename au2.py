@@ -144,10 +144,98 @@ def gauss_factor(beamConv, beamOrig=None, dx1=1, dy1=1):
     if (abs(gamma) + abs(alpha - beta)) == 0:
         bpa = 0.0
     else:
-        bpa = 0.5 * arctan2(-1 * gamma, alpha - beta)
+        bpa = 0.5 * np.arctan2(-1 * gamma, alpha - beta)
         #print alpha,beta,gamma
     amp = (math.pi / (4.0 * math.log(2.0)) * bmaj1 * bmin1 * bmaj2 * bmin2
            / math.sqrt(alpha * beta - 0.25 * gamma * gamma))
     fac = ((math.sqrt(dx1 ** 2) * math.sqrt(dy1 ** 2))) / amp
 
     return fac, amp, bmaj , bmin , np.degrees(bpa)
+
+
+def gaussianDeconvolve_array(smaj, smin, spa, bmaj, bmin, bpa, masks=False):
+    """Array version of gaussianDeconvolve.
+
+    Takes arrays (or scalars) that broadcast against each other, and
+    gives the same results as calling gaussianDeconvolve on each element.
+    Position angles in degrees, axes in any consistent units.
+
+    Returns dmaj, dmin, dpa arrays. With masks=True, also returns the
+    pointlike (s <= t, dmin set to 0) and fail (alpha < 0 or beta < 0,
+    dmaj and dmin set to 0) masks.
+    """
+    smaj, smin, spa, bmaj, bmin, bpa = np.broadcast_arrays(
+        *[np.asarray(x, dtype=np.float64)
+          for x in (smaj, smin, spa, bmaj, bmin, bpa)])
+    spa = np.radians(spa)
+    bpa = np.radians(bpa)
+    smaj = np.where(smaj < bmaj, bmaj, smaj)
+    smin = np.where(smin < bmin, bmin, smin)
+
+    alpha = ((smaj * np.cos(spa))**2 + (smin * np.sin(spa))**2 -
+             (bmaj * np.cos(bpa))**2 - (bmin * np.sin(bpa))**2)
+    beta = ((smaj * np.sin(spa))**2 + (smin * np.cos(spa))**2 -
+            (bmaj * np.sin(bpa))**2 - (bmin * np.cos(bpa))**2)
+    gamma = 2 * ((smin**2 - smaj**2) * np.sin(spa) * np.cos(spa) -
+                 (bmin**2 - bmaj**2) * np.sin(bpa) * np.cos(bpa))
+    s = alpha + beta
+    t = np.sqrt((alpha - beta)**2 + gamma**2)
+    with np.errstate(invalid='ignore'):
+        dmaj = np.sqrt(0.5 * (s + t))
+        pointlike = ~(s > t)
+        dmin = np.where(pointlike, 0., np.sqrt(0.5 * (s - t)))
+    fail = (alpha < 0) | (beta < 0)
+    dmaj = np.where(fail, 0., dmaj)
+    dmin = np.where(fail, 0., dmin)
+    # As in the scalar version, the PA is kept for failed beams
+    dpa = np.where(np.abs(gamma) + np.abs(alpha - beta) == 0, 0.,
+                   0.5 * np.arctan2(-gamma, alpha - beta))
+    if masks:
+        return dmaj, dmin, np.degrees(dpa), pointlike, fail
+    return dmaj, dmin, np.degrees(dpa)
+
+
+def gauss_factor_array(beamConv, beamOrig=None, dx1=1, dy1=1):
+    """Array version of gauss_factor.
+
+    beamConv and beamOrig are [major axis, minor axis, position_angle]
+    where each item can be an array; they broadcast against each other and
+    against the pixel sizes dx1, dy1. Gives the same results as calling
+    gauss_factor on each element.
+
+    Returns fac, amp, bmaj, bmin, bpa arrays.
+    """
+    deg2Grad = (np.pi/180)
+    bmaj2, bmin2, bpa2 = [np.asarray(x, dtype=np.float64) for x in beamConv]
+    bmaj1, bmin1, bpa1 = [np.asarray(x, dtype=np.float64) for x in beamOrig]
+    bpa1 = bpa1 * deg2Grad
+    bpa2 = bpa2 * deg2Grad
+    dx1 = np.asarray(dx1, dtype=np.float64)
+    dy1 = np.asarray(dy1, dtype=np.float64)
+    cospa1 = np.cos(bpa1)
+    cospa2 = np.cos(bpa2)
+    sinpa1 = np.sin(bpa1)
+    sinpa2 = np.sin(bpa2)
+    alpha = ((bmaj1 * cospa1) ** 2
+             + (bmin1 * sinpa1) ** 2
+             + (bmaj2 * cospa2) ** 2
+             + (bmin2 * sinpa2) ** 2)
+    beta = ((bmaj1 * sinpa1) ** 2
+            + (bmin1 * cospa1) ** 2
+            + (bmaj2 * sinpa2) ** 2
+            + (bmin2 * cospa2) ** 2)
+    gamma = (2 * ((bmin1 ** 2 - bmaj1 ** 2)
+                  * sinpa1 * cospa1
+                  + (bmin2 ** 2 - bmaj2 ** 2)
+                  * sinpa2 * cospa2))
+    s = alpha + beta
+    t = np.sqrt((alpha - beta) ** 2 + gamma ** 2)
+    bmaj = np.sqrt(0.5 * (s + t))
+    bmin = np.sqrt(0.5 * (s - t))
+    bpa = np.where((np.abs(gamma) + np.abs(alpha - beta)) == 0, 0.,
+                   0.5 * np.arctan2(-1 * gamma, alpha - beta))
+    amp = (np.pi / (4.0 * np.log(2.0)) * bmaj1 * bmin1 * bmaj2 * bmin2
+           / np.sqrt(alpha * beta - 0.25 * gamma * gamma))
+    fac = ((np.sqrt(dx1 ** 2) * np.sqrt(dy1 ** 2))) / amp
+
+    return fac, amp, bmaj, bmin, np.degrees(bpa)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Bad-channel flagging for QUOCKA bands.
+
+The badchans_<band>.txt files list one channel range (lc-uc) per line. The
+files are parsed once per band and the ranges merged. The channels of every
+range are flagged in one pass over the flags item of each dataset (see
+miriaduv.py), instead of one uvflag invocation per range (uvflag only takes
+one line= selection), each of which reads the whole dataset.
+"""
+
+import os
+
+import numpy as np
+
+from instrument import stage
+from miriaduv import read_flags, read_layout, write_flags
+
+_cache = {}
+
+
+def read_badchans(filename):
+    """Parse a bad-channel file, caching the result.
+
+    Arguments:
+        filename {str} -- Path of the badchans file.
+
+    Returns:
+        ranges {list} -- Sorted, merged (first, last) channel ranges (1-based,
+            inclusive).
+    """
+    if not os.path.exists(filename):
+        return []
+    mtime = os.path.getmtime(filename)
+    if filename in _cache and _cache[filename][0] == mtime:
+        return _cache[filename][1]
+    ranges = []
+    for line in open(filename):
+        sline = line.split()
+        if len(sline) == 0 or sline[0][0] == '#':
+            continue
+        lc, uc = sline[0].split('-')
+        ranges.append((int(lc), int(uc)))
+    merged = []
+    for lc, uc in sorted(ranges):
+        if merged and lc <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], uc))
+        else:
+            merged.append((lc, uc))
+    _cache[filename] = (mtime, merged)
+    return merged
+
+
+def flag_channels(vis, ranges):
+    """Flag channel ranges on every record of a dataset, in place.
+
+    Arguments:
+        vis {str} -- Dataset.
+        ranges {list} -- Disjoint (first, last) channel ranges (1-based,
+            inclusive).
+
+    Returns:
+        counts {list} -- Newly flagged correlations per range.
+    """
+    offsets, nchan = read_layout(vis)
+    prior = read_flags(vis, offsets, nchan)
+    flags = np.zeros(prior.shape, dtype=bool)
+    counts = []
+    for lc, uc in ranges:
+        chans = slice(max(lc - 1, 0), min(uc, nchan))
+        flags[:, chans] = True
+        counts.append(int((~prior[:, chans]).sum()))
+    write_flags(vis, offsets, flags)
+    return counts
+
+
+def flag_badchans(vislist, band, logf, badchans_dir='..', cache=None):
+    """Flag the bad channels of a band on a set of datasets.
+
+    Arguments:
+        vislist {list} -- Datasets of the band.
+        band {str} -- Band name, e.g. '2100'.
+        logf {file} -- Log file.
+
+    Keyword Arguments:
+        badchans_dir {str} -- Directory holding badchans_<band>.txt (default: {'..'})
+        cache {StepCache} -- Skip datasets already flagged while unchanged
+            (default: {None})
+
+    Returns:
+        ret {int} -- Exit status, non-zero if any dataset couldn't be flagged.
+        counts {dict} -- Newly flagged correlations per (first, last) range
+            (None where the step was skipped on every dataset).
+    """
+    ranges = read_badchans(os.path.join(badchans_dir, 'badchans_%s.txt' % band))
+    ret = 0
+    counts = dict((rng, None) for rng in ranges)
+    if len(ranges) == 0:
+        return ret, counts
+    for vis in vislist:
+        args = ['badchans', 'vis=%s' % vis,
+                'chans=%s' % ','.join('%d-%d' % rng for rng in ranges)]
+
+        def runner(args, logf):
+            try:
+                with stage('badchans', source=vis, band=band):
+                    nflag = flag_channels(vis, ranges)
+            except (IOError, OSError, ValueError) as err:
+                if logf is not None:
+                    logf.write('Error: flagging the bad channels of %s failed: %s\n' %
+                               (vis, err))
+                return 1
+            for rng, n in zip(ranges, nflag):
+                counts[rng] = (counts[rng] or 0) + n
+            return 0
+        if cache is not None:
+            status = cache.call(args, vis, logf, runner=runner)
+        else:
+            status = runner(args, logf)
+        ret = ret or status
+    return ret, counts
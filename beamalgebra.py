@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""Gaussian beam algebra on arrays of beams.
+
+The closed forms of MIRIAD's gaupar.for (as in au2.gaussianDeconvolve,
+au2.gauss_factor and radio_beam), written with NumPy so one call handles any
+number of beams. Arguments broadcast against each other, so a single beam
+can be deconvolved from a whole Beams table at once.
+
+Major and minor axes can be in any units, as long as they are consistent;
+position angles are in degrees.
+"""
+
+import numpy as np
+
+import au2
+
+EPS = np.finfo(np.float64).eps
+
+
+def _moments(bmaj, bmin, bpa):
+    """Second moments (alpha, beta, gamma) of beams, PA in radians."""
+    cospa = np.cos(bpa)
+    sinpa = np.sin(bpa)
+    return ((bmaj*cospa)**2 + (bmin*sinpa)**2,
+            (bmaj*sinpa)**2 + (bmin*cospa)**2,
+            2*(bmin**2 - bmaj**2)*sinpa*cospa)
+
+
+def _axes(alpha, beta, gamma):
+    s = alpha + beta
+    t = np.sqrt((alpha - beta)**2 + gamma**2)
+    return s, t
+
+
+def deconvolve(bmaj1, bmin1, bpa1, bmaj2, bmin2, bpa2, atol=1e-7/3600.):
+    """Deconvolve beams 2 from beams 1, as radio_beam's Beam.deconvolve.
+
+    Arguments:
+        bmaj1, bmin1, bpa1 {array} -- Beams to deconvolve from (axes in deg).
+        bmaj2, bmin2, bpa2 {array} -- Beams to deconvolve (axes in deg).
+
+    Keyword Arguments:
+        atol {float} -- Below this (deg) the result is circular and its PA
+            is set to 0 (default: {1e-7/3600.})
+
+    Returns:
+        bmaj, bmin, bpa {array} -- Deconvolved beams, 0 where it failed.
+        ok {array} -- False where beam 2 is larger than beam 1.
+    """
+    a1, b1, g1 = _moments(bmaj1, bmin1, np.radians(bpa1))
+    a2, b2, g2 = _moments(bmaj2, bmin2, np.radians(bpa2))
+    alpha = a1 - a2
+    beta = b1 - b2
+    gamma = g1 - g2
+    s, t = _axes(alpha, beta, gamma)
+    # Same tolerances as radio_beam.utils.deconvolve_optimized
+    ok = ~((alpha + EPS < 0) | (beta + EPS < 0) | (s < t + EPS/3600.**2))
+    with np.errstate(invalid='ignore'):
+        bmaj = np.where(ok, np.sqrt(0.5*(s + t)) + EPS, 0.)
+        bmin = np.where(ok, np.sqrt(0.5*(s - t)) + EPS, 0.)
+    circular = np.sqrt(np.abs(gamma) + np.abs(alpha - beta)) < atol
+    bpa = np.where(ok & ~circular,
+                   np.degrees(0.5*np.arctan2(-gamma, alpha - beta)), 0.)
+    return bmaj, bmin, bpa, ok
+
+
+def convolve(bmaj1, bmin1, bpa1, bmaj2, bmin2, bpa2):
+    """Convolve beams 1 with beams 2, as radio_beam's Beam.convolve.
+
+    Arguments:
+        bmaj1, bmin1, bpa1 {array} -- First beams.
+        bmaj2, bmin2, bpa2 {array} -- Second beams.
+
+    Returns:
+        bmaj, bmin, bpa {array} -- Convolved beams.
+    """
+    a1, b1, g1 = _moments(bmaj1, bmin1, np.radians(bpa1))
+    a2, b2, g2 = _moments(bmaj2, bmin2, np.radians(bpa2))
+    alpha = a1 + a2
+    beta = b1 + b2
+    gamma = g1 + g2
+    s, t = _axes(alpha, beta, gamma)
+    bpa = np.where(np.abs(gamma) + np.abs(alpha - beta) == 0, 0.,
+                   np.degrees(0.5*np.arctan2(-gamma, alpha - beta)))
+    return np.sqrt(0.5*(s + t)), np.sqrt(0.5*(s - t)), bpa
+
+
+def scale_factor(conv, orig, dx=1, dy=1):
+    """Flux scaling factor after convolving images, as au2.gauss_factor.
+
+    Arguments:
+        conv {tuple} -- (bmaj, bmin, bpa) of the convolving beams.
+        orig {tuple} -- (bmaj, bmin, bpa) of the beams of the images.
+
+    Keyword Arguments:
+        dx, dy {array} -- Pixel sizes, in the units of the axes (default: {1})
+
+    Returns:
+        fac {array} -- Factor for the output units (Jy/beam).
+        amp {array} -- Amplitude of the resulting gaussians.
+        bmaj, bmin, bpa {array} -- Resulting beams.
+    """
+    return au2.gauss_factor_array(conv, beamOrig=orig, dx1=dx, dy1=dy)
+
+
+def nyquist_correction(common, beams, grid, nsamp=2):
+    """Check that the kernels smoothing beams to a common beam are sampled.
+
+    Arguments:
+        common {tuple} -- (bmaj, bmin, bpa) of the common beam (axes in deg).
+        beams {tuple} -- (bmaj, bmin, bpa) arrays of the beams (axes in deg).
+        grid {float} -- Pixel size (deg).
+
+    Keyword Arguments:
+        nsamp {float} -- Pixels needed across the minor axis of a kernel (default: {2})
+
+    Returns:
+        idx {int} -- Beam with the worst sampled kernel, None if all kernels
+            are sampled.
+        cor_beam {tuple} -- (bmaj, bmin, bpa) of its kernel, widened to be
+            sampled; the new common beam is that beam convolved with it.
+    """
+    conmaj, conmin, conpa, ok = deconvolve(*(tuple(common) + tuple(beams)))
+    if not np.all(ok):
+        raise ValueError('Beam could not be deconvolved')
+    samps = conmin/abs(grid)
+    if not np.any(samps < nsamp):
+        return None, None
+    idx = int(np.argmin(samps))
+    major = conmaj[idx]
+    minor = conmin[idx]*nsamp/samps[idx]
+    pa = conpa[idx]
+    # Check for small major!
+    if major < minor:
+        major = minor
+        pa = 0.
+    return idx, (major, minor, pa)
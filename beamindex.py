@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""Beam and frequency index of QUOCKA images.
+
+Finding the common beam of a field needs BMAJ, BMIN, BPA and the frequency of
+every channel image, and parsing each header with astropy dominates that.
+BeamIndex keeps a table of
+
+    filename, crval3, bmaj, bmin, bpa, cdelt1, cdelt2, mtime_ns, size
+
+per field in a .npy file next to the images. On later runs only images that
+are new or changed (size or modification time) are read again. Headers are
+read with a scanner that only looks at the cards it needs, on a thread pool.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Header cards read, and their column in the table (values in header units)
+CARDS = {'CRVAL3': 'crval3', 'BMAJ': 'bmaj', 'BMIN': 'bmin', 'BPA': 'bpa',
+         'CDELT1': 'cdelt1', 'CDELT2': 'cdelt2'}
+
+COLUMNS = [('crval3', 'f8'), ('bmaj', 'f8'), ('bmin', 'f8'), ('bpa', 'f8'),
+           ('cdelt1', 'f8'), ('cdelt2', 'f8'), ('mtime_ns', 'i8'), ('size', 'i8')]
+
+
+def scan_header(filename):
+    """Read the CARDS values from the primary header of a FITS file.
+
+    Arguments:
+        filename {str} -- FITS file.
+
+    Returns:
+        values {dict} -- {column: value}, NaN for missing cards.
+    """
+    values = dict((column, np.nan) for column in CARDS.values())
+    with open(filename, 'rb') as fitsf:
+        while True:
+            block = fitsf.read(2880)
+            if len(block) < 2880:
+                raise ValueError('%s: no END card in the header' % filename)
+            for pos in range(0, 2880, 80):
+                card = block[pos:pos + 80].decode('ascii', errors='replace')
+                key = card[:8].rstrip()
+                if key == 'END':
+                    return values
+                if key in CARDS and card[8:10] == '= ':
+                    value = card[10:].split('/')[0].strip()
+                    values[CARDS[key]] = float(value.replace('D', 'E'))
+
+
+class BeamIndex(object):
+    """Table of the beams and frequencies of a set of images."""
+
+    def __init__(self, path=None, threads=8):
+        """
+        Keyword Arguments:
+            path {str} -- .npy file the index is kept in; None to keep it in
+                memory only (default: {None})
+            threads {int} -- Number of headers read at the same time (default: {8})
+        """
+        self.path = path
+        self.threads = threads
+        self.rows = {}
+        self.changed = False
+        if path is not None and os.path.exists(path):
+            try:
+                table = np.load(path)
+                for row in table:
+                    self.rows[str(row['filename'])] = tuple(
+                        row[name] for name, _ in COLUMNS)
+            except (IOError, OSError, ValueError):
+                # Unreadable index: start again
+                self.rows = {}
+
+    def _scan(self, filename, stat):
+        values = scan_header(filename)
+        return tuple(values[name] for name, _ in COLUMNS[:-2]) + \
+            (stat.st_mtime_ns, stat.st_size)
+
+    def table(self, files):
+        """Beam and frequency table of files, reading the headers not in the index.
+
+        Arguments:
+            files {list} -- FITS files.
+
+        Returns:
+            table {array} -- Structured array with a row per file, in order,
+                with columns filename and COLUMNS.
+        """
+        names = [os.path.abspath(filename) for filename in files]
+        stats = [os.stat(name) for name in names]
+        stale = [(name, stat) for name, stat in zip(names, stats)
+                 if self.rows.get(name, (None,)*len(COLUMNS))[-2:] !=
+                 (stat.st_mtime_ns, stat.st_size)]
+        if stale:
+            with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                rows = list(pool.map(lambda item: self._scan(*item), stale))
+            for (name, stat), row in zip(stale, rows):
+                self.rows[name] = row
+            self.changed = True
+        width = max([len(name) for name in names] + [1])
+        table = np.zeros(len(names), dtype=[('filename', 'U%d' % width)] + COLUMNS)
+        for i, name in enumerate(names):
+            table[i] = (name,) + tuple(self.rows[name])
+        return table
+
+    def save(self):
+        """Write the index, if anything was added to it."""
+        if self.path is None or not self.changed:
+            return
+        names = sorted(self.rows)
+        width = max([len(name) for name in names] + [1])
+        table = np.zeros(len(names), dtype=[('filename', 'U%d' % width)] + COLUMNS)
+        for i, name in enumerate(names):
+            table[i] = (name,) + tuple(self.rows[name])
+        tmpname = '%s.%d.tmp.npy' % (self.path[:-4], os.getpid())
+        try:
+            np.save(tmpname, table)
+            os.replace(tmpname, self.path)
+            self.changed = False
+        except (IOError, OSError):
+            # Read-only data directory: the index is only kept for this run
+            pass
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""Benchmark the array versions of au2.gauss_factor and au2.gaussianDeconvolve.
+
+Runs the scalar functions once per beam and the array functions once on all
+beams, checks that they agree, and prints the times.
+"""
+
+import time
+
+import numpy as np
+
+import au2
+
+
+def random_beams(nbeams, seed=0):
+    """Random beams and convolving beams, in arcsec and deg.
+
+    Arguments:
+        nbeams {int} -- Number of beams.
+
+    Keyword Arguments:
+        seed {int} -- Random seed (default: {0})
+
+    Returns:
+        orig {tuple} -- (bmaj, bmin, bpa) of the beams.
+        conv {tuple} -- (bmaj, bmin, bpa) of the convolving beams.
+    """
+    rng = np.random.default_rng(seed)
+    bmaj = rng.uniform(5, 60, nbeams)
+    bmin = bmaj*rng.uniform(0.3, 1, nbeams)
+    bpa = rng.uniform(-90, 90, nbeams)
+    cmaj = rng.uniform(1, 30, nbeams)
+    cmin = cmaj*rng.uniform(0.3, 1, nbeams)
+    cpa = rng.uniform(-90, 90, nbeams)
+    return (bmaj, bmin, bpa), (cmaj, cmin, cpa)
+
+
+def max_diff(scalar, array):
+    """Largest differences between the results of the scalar and array versions.
+
+    Arguments:
+        scalar {list} -- Results of the scalar version, one tuple per beam,
+            ending in (bmaj, bmin, bpa).
+        array {tuple} -- Results of the array version.
+
+    Returns:
+        axes {float} -- Largest difference in the axes, relative to the major
+            axis (the minor axis can be the difference of large numbers).
+        pa {float} -- Largest difference in the PA (deg).
+    """
+    scalar = np.array(scalar, dtype=np.float64)[:, -3:].T
+    array = np.array(array[:3], dtype=np.float64)
+    scale = np.abs(array[0])
+    scale[scale == 0] = 1
+    axes = np.max(np.abs(scalar[:2] - array[:2])/scale)
+    pa = np.max(np.abs(scalar[2] - array[2]))
+    return axes, pa
+
+
+def main(args):
+    """Main script.
+    """
+    orig, conv = random_beams(args.nbeams, args.seed)
+    dx = dy = args.pixel
+
+    start = time.time()
+    scalar = [au2.gauss_factor([cmaj, cmin, cpa], beamOrig=[bmaj, bmin, bpa],
+                               dx1=dx, dy1=dy)
+              for bmaj, bmin, bpa, cmaj, cmin, cpa in zip(*(orig + conv))]
+    t_scalar = time.time() - start
+    start = time.time()
+    array = au2.gauss_factor_array(conv, beamOrig=orig, dx1=dx, dy1=dy)
+    t_array = time.time() - start
+    fac = np.array([row[0] for row in scalar])
+    diff = np.max(np.abs(fac - array[0])/np.abs(fac))
+    axes, pa = max_diff(scalar, array[2:])
+    print('gauss_factor:       %d beams, scalar %.4f s, array %.4f s, '
+          'speedup %.0fx, max diff: fac %.1e, axes %.1e, PA %.1e deg' %
+          (args.nbeams, t_scalar, t_array, t_scalar/t_array, diff, axes, pa))
+
+    # Deconvolve the convolving beams from the beams; some are larger
+    # than the beams, which exercises the pointlike and fail cases
+    start = time.time()
+    scalar = [au2.gaussianDeconvolve(bmaj, bmin, bpa, cmaj, cmin, cpa)
+              for bmaj, bmin, bpa, cmaj, cmin, cpa in zip(*(orig + conv))]
+    t_scalar = time.time() - start
+    start = time.time()
+    array = au2.gaussianDeconvolve_array(*(orig + conv), masks=True)
+    t_array = time.time() - start
+    axes, pa = max_diff(scalar, array)
+    print('gaussianDeconvolve: %d beams, scalar %.4f s, array %.4f s, '
+          'speedup %.0fx, max diff: axes %.1e, PA %.1e deg '
+          '(%d pointlike, %d failed)' %
+          (args.nbeams, t_scalar, t_array, t_scalar/t_array, axes, pa,
+           array[3].sum(), array[4].sum()))
+
+
+def cli():
+    """Command-line interface
+    """
+    import argparse
+
+    # Help string to be shown using the -h option
+    descStr = """
+    Time au2.gauss_factor and au2.gaussianDeconvolve against their array
+    versions on random beams, and check that they agree.
+
+    """
+
+    # Parse the command line options
+    parser = argparse.ArgumentParser(description=descStr,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument(
+        '-n',
+        '--nbeams',
+        dest='nbeams',
+        type=int,
+        default=10000,
+        help='Number of beams [10000].')
+
+    parser.add_argument(
+        '--pixel',
+        dest='pixel',
+        type=float,
+        default=2.0,
+        help='Pixel size in arcsec [2.0].')
+
+    parser.add_argument(
+        '--seed',
+        dest='seed',
+        type=int,
+        default=0,
+        help='Random seed [0].')
+
+    args = parser.parse_args()
+
+    main(args)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""Checkpoint manifest for run_cal.py.
+
+The manifest is a JSON file in the output directory recording, for each
+scope (the whole night, a frequency band or a source), the pipeline stages
+that completed and when:
+
+    {"night": {"loaded": "...", "split": "..."},
+     "2100": {"flagged": "...", "primary-calibrated": "...", ...},
+     "j1234-5678.2100": {"target-applied": "..."},
+     "j1234-5678": {"rmsf-plotted": "..."}}
+
+Bands may be calibrated in separate processes, so every update is merged
+into the file under a lock.
+"""
+
+import fcntl
+import json
+import os
+import time
+
+
+class Checkpoint(object):
+    """Record completed pipeline stages, and look them up when resuming."""
+
+    def __init__(self, path, resume=False):
+        """
+        Arguments:
+            path {str} -- JSON manifest file.
+
+        Keyword Arguments:
+            resume {bool} -- Keep the stages recorded by a previous run. If
+                False the manifest is started afresh (default: {False})
+        """
+        self.path = os.path.abspath(path)
+        self.resume = resume
+        if not resume:
+            self._update(lambda stages: stages.clear())
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as manf:
+            try:
+                return json.load(manf)
+            except ValueError:
+                return {}
+
+    def _update(self, func):
+        with open(self.path + '.lock', 'w') as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            stages = self._read()
+            func(stages)
+            tmpname = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmpname, 'w') as manf:
+                json.dump(stages, manf, indent=1, sort_keys=True)
+            os.replace(tmpname, self.path)
+            fcntl.flock(lockf, fcntl.LOCK_UN)
+
+    def done(self, scope, stage):
+        """Check whether a stage is recorded as completed, when resuming."""
+        return self.resume and stage in self._read().get(scope, {})
+
+    def mark(self, scope, stage):
+        """Record a completed stage.
+
+        Arguments:
+            scope {str} -- 'night', a band name or a source name.
+            stage {str} -- Stage name, e.g. 'primary-calibrated'.
+        """
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self._update(lambda stages: stages.setdefault(scope, {}).update({stage: stamp}))
+
+    def clear(self, scope, stage):
+        """Forget a stage, e.g. because an earlier stage it depends on re-ran."""
+        self._update(lambda stages: stages.get(scope, {}).pop(stage, None))
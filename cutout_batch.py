@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+"""Cut out the centre of many QUOCKA images in one go.
+
+Does what cutout_400.py (4D output) and cutout_source_finding.py (2D output,
+for Aegean/Aplpy) do for a single image, for any number of images:
+
+- Images are grouped by their celestial WCS, and the pixel box and the
+  cutout WCS are worked out once per group.
+- Only the pixels in the box are read, through the memory-mapped section of
+  the image.
+- Images are read and written on a thread pool, as the work is all I/O.
+
+Outputs are named like the single-image scripts name them:
+<image>.cutout.fits for <image>.fits.
+"""
+
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+
+import numpy as np
+from astropy.io import fits
+from astropy.nddata.utils import overlap_slices
+from astropy.wcs import WCS
+
+# Header keywords defining the celestial grid of an image
+GRID_KEYS = ['NAXIS1', 'NAXIS2', 'CTYPE1', 'CTYPE2', 'CRVAL1', 'CRVAL2',
+             'CRPIX1', 'CRPIX2', 'CDELT1', 'CDELT2', 'CUNIT1', 'CUNIT2',
+             'CROTA1', 'CROTA2', 'PC1_1', 'PC1_2', 'PC2_1', 'PC2_2',
+             'EQUINOX', 'RADESYS', 'LONPOLE', 'LATPOLE']
+
+
+def cutout_name(filename, outdir=None):
+    """Name of the cutout of an image, as cutout_400.py names it.
+
+    Arguments:
+        filename {str} -- Image file name, ending in .fits.
+
+    Keyword Arguments:
+        outdir {str} -- Directory for the cutout, next to the image if None
+            (default: {None})
+
+    Returns:
+        name {str} -- <image>.cutout.fits
+    """
+    name = filename[:-4]+'cutout.fits'
+    if outdir is not None:
+        name = os.path.join(outdir, os.path.basename(name))
+    return name
+
+
+def cutout_plan(header, size):
+    """Pixel box and WCS of a centred cutout, as Cutout2D makes them.
+
+    Arguments:
+        header {Header} -- Image header (2 celestial axes, then frequency
+            and Stokes).
+        size {int} -- Cutout size in pixels.
+
+    Returns:
+        yslice {slice} -- Rows of the cutout.
+        xslice {slice} -- Columns of the cutout.
+        wcs_header {Header} -- Celestial WCS of the cutout.
+    """
+    shape = (header['NAXIS2'], header['NAXIS1'])
+    yslice, xslice = overlap_slices(shape, (size, size),
+                                    (int(shape[0]/2), int(shape[1]/2)),
+                                    mode='trim')[0]
+    wcs = WCS(header).dropaxis(3).dropaxis(2)
+    wcs.wcs.crpix -= (xslice.start, yslice.start)
+    return yslice, xslice, wcs.to_header()
+
+
+def drop_axes(header):
+    """Remove the frequency and Stokes axes from a header.
+
+    Arguments:
+        header {Header} -- Header of a 4D image.
+
+    Returns:
+        header {Header} -- Header of a 2D image.
+    """
+    header = header.copy()
+    for key in list(header.keys()):
+        stem = key.rstrip('0123456789_')
+        axes = key[len(stem):].replace('_', '')
+        if stem in ('NAXIS', 'CTYPE', 'CRVAL', 'CDELT', 'CRPIX', 'CUNIT',
+                    'CROTA', 'PC') and axes and set(axes) & set('34'):
+            del header[key]
+    header['NAXIS'] = 2
+    return header
+
+
+def scale(data, header):
+    """Apply BSCALE, BZERO and BLANK to raw image data.
+
+    Arguments:
+        data {array} -- Raw data.
+        header {Header} -- Image header.
+
+    Returns:
+        data {array} -- Physical values, float32 for scaled integer data.
+    """
+    bscale = header.get('BSCALE', 1.0)
+    bzero = header.get('BZERO', 0.0)
+    if data.dtype.kind != 'f':
+        blank = header.get('BLANK')
+        if bscale == 1.0 and bzero == 0.0 and blank is None:
+            return data
+        out = data.astype(np.float32)
+        if blank is not None:
+            out[data == blank] = np.nan
+        data = out
+    elif bscale == 1.0 and bzero == 0.0:
+        return data
+    return data*np.float32(bscale) + np.float32(bzero)
+
+
+def write_cutout(filename, size, plans, squeeze=False, outdir=None,
+                 overwrite=False):
+    """Write the cutout of one image.
+
+    Arguments:
+        filename {str} -- Image file name.
+        size {int} -- Cutout size in pixels.
+        plans {dict} -- Cutout plans by grid, shared between calls.
+
+    Keyword Arguments:
+        squeeze {bool} -- Write a 2D image, dropping the frequency and Stokes
+            axes, as cutout_source_finding.py does (default: {False})
+        outdir {str} -- Output directory, next to the image if None
+            (default: {None})
+        overwrite {bool} -- Overwrite existing cutouts (default: {False})
+
+    Returns:
+        outfile {str} -- Name of the cutout.
+    """
+    # astropy refuses to memory-map scaled images, so the raw section is
+    # read and only the cutout is scaled
+    with fits.open(filename, memmap=True, do_not_scale_image_data=True) as hdulist:
+        hdu = hdulist[0]
+        header = hdu.header.copy()
+        grid = tuple(header.get(key) for key in GRID_KEYS)
+        if grid not in plans:
+            # Another thread may compute the same plan; that's harmless
+            plans[grid] = cutout_plan(header, size)
+        yslice, xslice, wcs_header = plans[grid]
+        data = hdu.section[0, 0, yslice, xslice]
+    data = scale(data, header)
+    header.update(wcs_header)
+    if squeeze:
+        header = drop_axes(header)
+    else:
+        data = data.reshape((1, 1) + data.shape)
+    # Let the data set the image size and type
+    for key in ('BSCALE', 'BZERO', 'BLANK'):
+        header.remove(key, ignore_missing=True)
+    outfile = cutout_name(filename, outdir)
+    fits.writeto(outfile, data, header, overwrite=overwrite)
+    return outfile
+
+
+def main(args):
+    """Main script.
+    """
+    files = []
+    for pattern in args.images:
+        files += sorted(glob(pattern)) if any(c in pattern for c in '*?[') \
+            else [pattern]
+    if args.list is not None:
+        with open(args.list) as listf:
+            files += [line.strip() for line in listf if line.strip()]
+    if len(files) == 0:
+        print('No images to cut out')
+        sys.exit(1)
+    if args.outdir is not None and not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    plans = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        futures = [(filename, pool.submit(write_cutout, filename, args.size,
+                                          plans, args.squeeze, args.outdir,
+                                          args.overwrite))
+                   for filename in files]
+        for filename, future in futures:
+            try:
+                outfile = future.result()
+                if args.verbose:
+                    print(outfile)
+            except Exception as err:
+                print('%s: %s' % (filename, err))
+                failed.append(filename)
+    print('%d cutouts written, %d failed, %d grid(s)' %
+          (len(files) - len(failed), len(failed), len(plans)))
+    if failed:
+        sys.exit(1)
+
+
+def cli():
+    """Command-line interface
+    """
+    import argparse
+
+    # Help string to be shown using the -h option
+    descStr = """
+    Cut out the centre of many images in one process.
+
+    cutout_batch.py '*.i.fits' -s 400 replaces running cutout_400.py on
+    each image, and -s 800 --squeeze replaces cutout_source_finding.py.
+
+    """
+
+    # Parse the command line options
+    parser = argparse.ArgumentParser(description=descStr,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument(
+        'images',
+        metavar='images',
+        type=str,
+        nargs='*',
+        help='Image files or (quoted) glob patterns.')
+
+    parser.add_argument(
+        '-l',
+        '--list',
+        dest='list',
+        type=str,
+        default=None,
+        help='(Optional) File listing more images, one per line.')
+
+    parser.add_argument(
+        '-s',
+        '--size',
+        dest='size',
+        type=int,
+        default=400,
+        help='Cutout size in pixels [400].')
+
+    parser.add_argument(
+        '--squeeze',
+        dest='squeeze',
+        action='store_true',
+        help='Write 2D images without the frequency and Stokes axes [False].')
+
+    parser.add_argument(
+        '-o',
+        '--outdir',
+        dest='outdir',
+        type=str,
+        default=None,
+        help='(Optional) Save cutouts to a different directory [next to the images].')
+
+    parser.add_argument(
+        '-j',
+        '--threads',
+        dest='threads',
+        type=int,
+        default=8,
+        help='Number of images read and written at the same time [8].')
+
+    parser.add_argument(
+        '--overwrite',
+        dest='overwrite',
+        action='store_true',
+        help='Overwrite existing cutouts [False].')
+
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        action="store_true",
+        help="verbose output [False].")
+
+    args = parser.parse_args()
+
+    main(args)
+
+
+if __name__ == "__main__":
+    cli()
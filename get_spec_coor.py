@@ -17,19 +17,10 @@ from astropy.io import fits
 import matplotlib.pyplot as plt
 import numpy as np
 import matplotlib as mpl
+from imstats import get_noise
 mpl.use('Agg')
 
 
-def getnoise(img_name):
-    hdu = fits.open(img_name)
-    data = hdu[0].data[0, 0]
-    rms_initial = np.std(data)
-    rms = np.std(
-        data[np.logical_and(data > -2.5*rms_initial, data < 2.5*rms_initial)])
-    hdu.close()
-    return rms
-
-
 # flist = np.genfromtxt('quocka_select.csv', dtype=str)
 filename = sys.argv[1]
 sname = filename[0:-5]
@@ -95,7 +86,7 @@ for i_name in ilist21:
     data_i = i_img[0].data[0, 0]
     peak_i = data_i[peak_y, peak_x]
     # box_i = data_i[img_size-box_r:img_size-box_l, img_size-box_t:img_size-box_b]
-    noise_i = getnoise(i_name)
+    noise_i = get_noise(i_name)[0]
     i_img.close()
     # print(str(peak_x[0])+"  "+str(peak_y[0]))
 
@@ -104,7 +95,7 @@ for i_name in ilist21:
     data_q = q_img[0].data[0, 0]
     peak_q = data_q[peak_y, peak_x]
     # box_q = data_q[img_size-box_r:img_size-box_l, img_size-box_t:img_size-box_b]
-    noise_q = getnoise(q_name)
+    noise_q = get_noise(q_name)[0]
     q_img.close()
 
     u_name = i_name.replace('.i.', '.u.')
@@ -112,7 +103,7 @@ for i_name in ilist21:
     data_u = u_img[0].data[0, 0]
     peak_u = data_u[peak_y, peak_x]
     # box_u = data_u[img_size-box_r:img_size-box_l, img_size-box_t:img_size-box_b]
-    noise_u = getnoise(u_name)
+    noise_u = get_noise(u_name)[0]
     u_img.close()
 
     v_name = i_name.replace('.i.', '.v.')
@@ -120,7 +111,7 @@ for i_name in ilist21:
     data_v = v_img[0].data[0, 0]
     peak_v = data_v[peak_y, peak_x]
     # box_v = data_v[img_size-box_r:img_size-box_l, img_size-box_t:img_size-box_b]
-    noise_v = getnoise(v_name)
+    noise_v = get_noise(v_name)[0]
     v_img.close()
 
     stokes_file.write(str(chan)+' '+str(peak_i)+' '+str(noise_i)+' '+str(peak_q)+' '+str(noise_q)+' '
@@ -140,7 +131,7 @@ for i_name in ilist55:
     data_i = i_img[0].data[0, 0]
     peak_i = data_i[peak_y, peak_x]
     # box_i = data_i[img_size-box_r:img_size-box_l, img_size-box_t:img_size-box_b]
-    noise_i = getnoise(i_name)
+    noise_i = get_noise(i_name)[0]
     i_img.close()
 
     q_name = i_name.replace('.i.', '.q.')
@@ -148,7 +139,7 @@ for i_name in ilist55:
     data_q = q_img[0].data[0, 0]
     peak_q = data_q[peak_y, peak_x]
     # box_q = data_q[img_size-box_r:img_size-box_l, img_size-box_t:img_size-box_b]
-    noise_q = getnoise(q_name)
+    noise_q = get_noise(q_name)[0]
     q_img.close()
 
     u_name = i_name.replace('.i.', '.u.')
@@ -156,7 +147,7 @@ for i_name in ilist55:
     data_u = u_img[0].data[0, 0]
     peak_u = data_u[peak_y, peak_x]
     # box_u = data_u[img_size-box_r:img_size-box_l, img_size-box_t:img_size-box_b]
-    noise_u = getnoise(u_name)
+    noise_u = get_noise(u_name)[0]
     u_img.close()
 
     v_name = i_name.replace('.i.', '.v.')
@@ -164,7 +155,7 @@ for i_name in ilist55:
     data_v = v_img[0].data[0, 0]
     peak_v = data_v[peak_y, peak_x]
     # box_v = data_v[img_size-box_r:img_size-box_l, img_size-box_t:img_size-box_b]
-    noise_v = getnoise(v_name)
+    noise_v = get_noise(v_name)[0]
     v_img.close()
 
     stokes_file.write(str(chan)+' '+str(peak_i)+' '+str(noise_i)+' '+str(peak_q)+' '+str(noise_q)+' '
@@ -183,7 +174,7 @@ for i_name in ilist75:
     data_i = i_img[0].data[0, 0]
     peak_i = data_i[peak_y, peak_x]
     # box_i = data_i[img_size-box_r:img_size-box_l, img_size-box_t:img_size-box_b]
-    noise_i = getnoise(i_name)
+    noise_i = get_noise(i_name)[0]
     i_img.close()
 
     q_name = i_name.replace('.i.', '.q.')
@@ -191,7 +182,7 @@ for i_name in ilist75:
     data_q = q_img[0].data[0, 0]
     peak_q = data_q[peak_y, peak_x]
     # box_q = data_q[img_size-box_r:img_size-box_l, img_size-box_t:img_size-box_b]
-    noise_q = getnoise(q_name)
+    noise_q = get_noise(q_name)[0]
     q_img.close()
 
     u_name = i_name.replace('.i.', '.u.')
@@ -199,7 +190,7 @@ for i_name in ilist75:
     data_u = u_img[0].data[0, 0]
     peak_u = data_u[peak_y, peak_x]
     # box_u = data_u[img_size-box_r:img_size-box_l, img_size-box_t:img_size-box_b]
-    noise_u = getnoise(u_name)
+    noise_u = get_noise(u_name)[0]
     u_img.close()
 
     v_name = i_name.replace('.i.', '.v.')
@@ -207,7 +198,7 @@ for i_name in ilist75:
     data_v = v_img[0].data[0, 0]
     peak_v = data_v[peak_y, peak_x]
     # box_v = data_v[img_size-box_r:img_size-box_l, img_size-box_t:img_size-box_b]
-    noise_v = getnoise(v_name)
+    noise_v = get_noise(v_name)[0]
     v_img.close()
 
     stokes_file.write(str(chan)+' '+str(peak_i)+' '+str(noise_i)+' '+str(peak_q)+' '+str(noise_q)+' '
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""Image noise and peak statistics shared by the QUOCKA scripts.
+
+get_noise() returns the clipped rms, the peak and the minimum of the first
+plane of a FITS image, as the get_noise copies in the scripts used to do:
+the rms of the pixels within +-2.5 times the rms of the whole image. The
+image is memory-mapped and reduced in tiles of rows, combining the per-tile
+moments, so no full-size copies or boolean masks are made. The clip level
+depends on the rms of the whole image, so the tiles are visited twice; the
+second pass reads from the page cache.
+
+Results are cached in memory and in a small SQLite database (.imstats.sqlite)
+in the working directory of the script, keyed by the full path, size and
+modification time of the image, so the quality and spectrum scripts reuse
+what selfcal already measured and a rewritten image is measured again.
+Nothing is written next to the images, so input directories are left alone.
+"""
+
+import os
+import sqlite3
+
+import numpy as np
+from astropy.io import fits
+
+from instrument import stage
+
+CACHE_NAME = '.imstats.sqlite'
+
+# Directory of the cache database, None for the working directory
+CACHE_DIR = None
+
+_memory = {}
+
+
+def _plane(data):
+    while data.ndim > 2:
+        data = data[0]
+    return data
+
+
+def _combine(acc, block):
+    """Add the finite values of block to the running (n, mean, M2, max, min)."""
+    block = block[np.isfinite(block)]
+    if block.size == 0:
+        return acc
+    n, mean, m2, vmax, vmin = acc
+    nb = block.size
+    meanb = block.mean()
+    m2b = ((block - meanb)**2).sum()
+    delta = meanb - mean
+    tot = n + nb
+    return (tot, mean + delta*nb/tot, m2 + m2b + delta**2*n*nb/tot,
+            max(vmax, block.max()), min(vmin, block.min()))
+
+
+def image_stats(filename, clip=2.5, tile=256):
+    """Clipped rms, peak and minimum of an image, without the cache.
+
+    Arguments:
+        filename {str} -- FITS image.
+
+    Keyword Arguments:
+        clip {float} -- Clip level, in units of the rms of the whole image (default: {2.5})
+        tile {int} -- Number of rows reduced at a time (default: {256})
+
+    Returns:
+        rms {float} -- Clipped rms.
+        peak_max {float} -- Maximum.
+        peak_min {float} -- Minimum.
+    """
+    with fits.open(filename, memmap=True, do_not_scale_image_data=True) as hdul:
+        hdu = hdul[0]
+        data = _plane(hdu.data)
+        bscale = hdu.header.get('BSCALE', 1.0)
+        bzero = hdu.header.get('BZERO', 0.0)
+        scaled = bscale != 1.0 or bzero != 0.0
+
+        def tiles():
+            for row in range(0, data.shape[0], tile):
+                block = np.asarray(data[row:row + tile], dtype=np.float64)
+                if scaled:
+                    block = block*bscale + bzero
+                yield block
+
+        full = (0, 0.0, 0.0, -np.inf, np.inf)
+        for block in tiles():
+            full = _combine(full, block)
+        n, mean, m2, peak_max, peak_min = full
+        if n == 0:
+            return np.nan, np.nan, np.nan
+        lim = clip*np.sqrt(m2/n)
+        clipped = (0, 0.0, 0.0, -np.inf, np.inf)
+        for block in tiles():
+            clipped = _combine(clipped, block[(block > -lim) & (block < lim)])
+    n, mean, m2 = clipped[:3]
+    rms = np.sqrt(m2/n) if n > 0 else np.nan
+    return float(rms), float(peak_max), float(peak_min)
+
+
+def _db():
+    dirname = CACHE_DIR if CACHE_DIR is not None else os.getcwd()
+    db = sqlite3.connect(os.path.join(dirname, CACHE_NAME), timeout=60)
+    db.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT, clip REAL, '
+               'size INTEGER, mtime_ns INTEGER, rms REAL, peak_max REAL, '
+               'peak_min REAL, PRIMARY KEY (name, clip))')
+    return db
+
+
+def get_noise(img_name, clip=2.5):
+    """Clipped rms, peak and minimum of an image, cached.
+
+    Arguments:
+        img_name {str} -- FITS image.
+
+    Keyword Arguments:
+        clip {float} -- Clip level, in units of the rms of the whole image (default: {2.5})
+
+    Returns:
+        rms {float} -- Clipped rms.
+        peak_max {float} -- Maximum.
+        peak_min {float} -- Minimum.
+    """
+    path = os.path.abspath(img_name)
+    st = os.stat(path)
+    key = (st.st_size, st.st_mtime_ns)
+    if _memory.get((path, clip), (None,))[0] == key:
+        return _memory[(path, clip)][1]
+    try:
+        with _db() as db:
+            row = db.execute('SELECT size, mtime_ns, rms, peak_max, peak_min '
+                             'FROM stats WHERE name=? AND clip=?',
+                             (path, clip)).fetchone()
+        db.close()
+    except sqlite3.Error:
+        row = None
+    if row is not None and tuple(row[:2]) == key:
+        stats = tuple(row[2:])
+    else:
+        with stage('imstats', source=img_name):
+            stats = image_stats(path, clip)
+        try:
+            with _db() as db:
+                db.execute('INSERT OR REPLACE INTO stats VALUES (?,?,?,?,?,?,?)',
+                           (path, clip) + key + stats)
+            db.close()
+        except sqlite3.Error:
+            # Read-only working directory: just keep the result in memory
+            pass
+    _memory[(path, clip)] = (key, stats)
+    return stats
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""Timing and resource instrumentation for the QUOCKA scripts.
+
+Every external task goes through call() (a drop-in for subprocess.call), and
+heavy Python stages are wrapped in `with stage(name):`. For each step the
+wall time, CPU time, peak RSS and bytes read/written are recorded:
+
+- External tasks are reaped with os.wait4, which gives the resource usage
+  of that child process alone. This stays correct when tasks run
+  concurrently.
+- Python stages are measured with getrusage for the calling thread. Work
+  done in pool worker processes isn't included. The peak RSS of a stage is
+  the peak of the whole process so far.
+- Bytes read/written count block I/O (512-byte blocks), i.e. what actually
+  hit the disk rather than the page cache.
+
+After start(), the records are appended to a timing file as JSON lines. All
+the worker processes of a run append to the same file, and summary() prints
+a table of the whole run from it.
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+
+
+class Recorder(object):
+    """Record the resource usage of pipeline steps."""
+
+    def __init__(self, filename=None):
+        """
+        Keyword Arguments:
+            filename {str} -- JSON lines timing file; None to only keep the
+                records in memory (default: {None})
+        """
+        self.filename = filename
+        self.records = []
+        self._lock = threading.Lock()
+
+    def record(self, step, wall, cpu, maxrss, nread, nwritten, ret=None,
+               source='', band='', kind='task'):
+        """Add a record, appending it to the timing file.
+
+        Arguments:
+            step {str} -- Step name.
+            wall {float} -- Wall time (s).
+            cpu {float} -- CPU time, user + system (s).
+            maxrss {int} -- Peak resident set size (kB).
+            nread {int} -- Bytes read.
+            nwritten {int} -- Bytes written.
+
+        Keyword Arguments:
+            ret {int} -- Exit status of a task (default: {None})
+            source {str} -- Source or dataset the step works on (default: {''})
+            band {str} -- Frequency band (default: {''})
+            kind {str} -- 'task' or 'stage' (default: {'task'})
+        """
+        rec = {'step': step, 'kind': kind, 'source': source, 'band': band,
+               'wall': round(wall, 3), 'cpu': round(cpu, 3), 'maxrss_kb': maxrss,
+               'read_bytes': nread, 'written_bytes': nwritten, 'ret': ret,
+               'pid': os.getpid(), 'end': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        with self._lock:
+            self.records.append(rec)
+            if self.filename is not None:
+                # One write per line, so concurrent processes don't interleave
+                with open(self.filename, 'a') as timef:
+                    timef.write(json.dumps(rec) + '\n')
+
+    def wait(self, proc, start, step=None, source='', band=''):
+        """Reap a started task and record its resource usage.
+
+        Arguments:
+            proc {Popen} -- The task.
+            start {float} -- time.time() when it was started.
+
+        Keyword Arguments:
+            step {str} -- Step name, the task name if not given (default: {None})
+            source {str} -- Source or dataset (default: {''})
+            band {str} -- Frequency band (default: {''})
+
+        Returns:
+            ret {int} -- Exit status.
+        """
+        _, status, ru = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        args = proc.args if isinstance(proc.args, (list, tuple)) else [proc.args]
+        self.record(step or os.path.basename(str(args[0])), time.time() - start,
+                    ru.ru_utime + ru.ru_stime, ru.ru_maxrss,
+                    ru.ru_inblock*512, ru.ru_oublock*512, ret=proc.returncode,
+                    source=source, band=band)
+        return proc.returncode
+
+    def call(self, args, step=None, source='', band='', **kwargs):
+        """Run a task like subprocess.call, recording its resource usage.
+
+        The remaining keyword arguments go to subprocess.Popen.
+        """
+        start = time.time()
+        proc = subprocess.Popen(args, **kwargs)
+        return self.wait(proc, start, step=step, source=source, band=band)
+
+    def capture(self, args, step=None, source='', band=''):
+        """Run a task, recording its resource usage and returning its output.
+
+        Returns:
+            ret {int} -- Exit status.
+            output {str} -- Combined stdout and stderr.
+        """
+        start = time.time()
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, universal_newlines=True)
+        output = proc.stdout.read()
+        proc.stdout.close()
+        return self.wait(proc, start, step=step, source=source, band=band), output
+
+    @contextmanager
+    def stage(self, step, source='', band=''):
+        """Context manager recording the resource usage of a Python stage."""
+        start = time.time()
+        ru0 = resource.getrusage(RUSAGE_THREAD)
+        try:
+            yield
+        finally:
+            ru = resource.getrusage(RUSAGE_THREAD)
+            self.record(step, time.time() - start,
+                        (ru.ru_utime - ru0.ru_utime) +
+                        (ru.ru_stime - ru0.ru_stime),
+                        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                        (ru.ru_inblock - ru0.ru_inblock)*512,
+                        (ru.ru_oublock - ru0.ru_oublock)*512,
+                        source=source, band=band, kind='stage')
+
+    def load(self):
+        """All the records of the run, including those of worker processes."""
+        if self.filename is None or not os.path.exists(self.filename):
+            with self._lock:
+                return list(self.records)
+        with open(self.filename) as timef:
+            return [json.loads(line) for line in timef if line.strip()]
+
+    def summary(self, out=None):
+        """Write a table of the resource usage per step, longest first.
+
+        Keyword Arguments:
+            out {file} -- Where to write the table (default: {sys.stdout})
+        """
+        steps = {}
+        for rec in self.load():
+            tot = steps.setdefault(rec['step'], [0, 0.0, 0.0, 0, 0, 0, 0])
+            tot[0] += 1
+            tot[1] += rec['wall']
+            tot[2] += rec['cpu']
+            tot[3] = max(tot[3], rec['maxrss_kb'])
+            tot[4] += rec['read_bytes']
+            tot[5] += rec['written_bytes']
+            tot[6] += 1 if rec['ret'] else 0
+        lines = ['%-14s %6s %10s %10s %10s %10s %10s %6s' %
+                 ('Step', 'Runs', 'Wall (s)', 'CPU (s)', 'RSS (MB)',
+                  'Read (MB)', 'Write (MB)', 'Fail')]
+        for step in sorted(steps, key=lambda s: -steps[s][1]):
+            runs, wall, cpu, maxrss, nread, nwritten, nfail = steps[step]
+            lines.append('%-14s %6d %10.1f %10.1f %10.1f %10.1f %10.1f %6d' %
+                         (step, runs, wall, cpu, maxrss/1024., nread/2.**20,
+                          nwritten/2.**20, nfail))
+        print('\n'.join(lines), file=out if out is not None else sys.stdout)
+
+
+# Recorder shared by everything in the process (and inherited by forked workers)
+RECORDER = Recorder()
+
+
+def start(name, directory='.'):
+    """Start writing the records of this run to a timing file.
+
+    Arguments:
+        name {str} -- Run name, e.g. the script name.
+
+    Keyword Arguments:
+        directory {str} -- Directory for the timing file (default: {'.'})
+
+    Returns:
+        filename {str} -- timing.<name>.<date-time>.jsonl
+    """
+    RECORDER.filename = os.path.abspath(os.path.join(
+        directory, 'timing.%s.%s.jsonl' % (name, time.strftime('%Y%m%d-%H%M%S'))))
+    return RECORDER.filename
+
+
+def call(args, **kwargs):
+    """Drop-in for subprocess.call. See Recorder.call."""
+    return RECORDER.call(args, **kwargs)
+
+
+def capture(args, **kwargs):
+    """See Recorder.capture."""
+    return RECORDER.capture(args, **kwargs)
+
+
+def stage(step, **kwargs):
+    """See Recorder.stage."""
+    return RECORDER.stage(step, **kwargs)
+
+
+def summary(out=None):
+    """See Recorder.summary."""
+    RECORDER.summary(out)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""Log multiplexer for pipeline subprocesses.
+
+The output of every MIRIAD task is read from a pipe, tagged with
+the source, band and step it belongs to, and written in batches to the
+caller's log (the global log of the script or worker) and to a log per
+source, instead of being synced to one shared file line by line. The
+wall-clock time of every step is recorded, so the scripts can report where
+the time went, and the tasks are reaped through the instrument module so
+their resource usage ends up in the run's timing file.
+
+A call blocks until its task has finished, like subprocess.call; tasks
+run concurrently when they are called from several threads (the task graph
+workers) or processes. Each call flushes what it collected before
+returning, so task output stays in order with the messages the scripts
+write to the same log.
+"""
+
+import subprocess
+import sys
+import threading
+import time
+
+from instrument import RECORDER
+
+
+class LogMux(object):
+    """Run subprocesses, collecting their output into tagged logs."""
+
+    def __init__(self, srclog='%s.steps.log', batch=200, interval=2.0):
+        """
+        Keyword Arguments:
+            srclog {str} -- Name of the per-source log, formatted with the
+                source name; None to only write the global log
+                (default: {'%s.steps.log'})
+            batch {int} -- Number of lines collected before writing (default: {200})
+            interval {float} -- Longest time (s) output is held back while a
+                task runs (default: {2.0})
+        """
+        self.srclog = srclog
+        self.batch = batch
+        self.interval = interval
+        self.timings = []
+        self._srcfiles = {}
+        self._lock = threading.Lock()
+
+    def _srcfile(self, source):
+        if self.srclog is None or not source:
+            return None
+        if source not in self._srcfiles:
+            self._srcfiles[source] = open(self.srclog % source, 'a')
+        return self._srcfiles[source]
+
+    def _write(self, lines, logf, tag, source):
+        if not lines:
+            return
+        with self._lock:
+            if logf is not None:
+                logf.write(''.join('%s %s' % (tag, line) for line in lines))
+                logf.flush()
+            srcf = self._srcfile(source)
+            if srcf is not None:
+                srcf.write(''.join(lines))
+                srcf.flush()
+
+    def _run(self, args, logf, tag, source, band, step):
+        start = time.time()
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        lines = []
+        last = time.time()
+        for line in proc.stdout:
+            lines.append(line.decode(errors='replace'))
+            if len(lines) >= self.batch or time.time() - last > self.interval:
+                self._write(lines, logf, tag, source)
+                lines = []
+                last = time.time()
+        proc.stdout.close()
+        ret = RECORDER.wait(proc, start, step=step, source=source, band=band)
+        self._write(lines, logf, tag, source)
+        return ret
+
+    def call(self, args, logf=None, source='', band='', step=None):
+        """Run a task, like subprocess.call(args, stdout=logf, stderr=logf).
+
+        Arguments:
+            args {list} -- Command line.
+
+        Keyword Arguments:
+            logf {file} -- Global log the tagged output is written to
+                (default: {None})
+            source {str} -- Source (dataset) name the task works on (default: {''})
+            band {str} -- Frequency band (default: {''})
+            step {str} -- Step name, the task name if not given (default: {None})
+
+        Returns:
+            ret {int} -- Exit status.
+        """
+        step = step or args[0]
+        tag = '[%s]' % '|'.join(t for t in (source, band, step) if t)
+        start = time.time()
+        ret = self._run(args, logf, tag, source, band, step)
+        with self._lock:
+            self.timings.append((source, band, step, time.time() - start, ret))
+        return ret
+
+    def step_times(self, band=None):
+        """Total wall time per step.
+
+        Keyword Arguments:
+            band {str} -- Only count the steps of this band (default: {None})
+
+        Returns:
+            times {dict} -- {step: (number of runs, total wall time in s)}
+        """
+        times = {}
+        with self._lock:
+            for source, sband, step, wall, ret in self.timings:
+                if band is not None and sband != band:
+                    continue
+                count, total = times.get(step, (0, 0.0))
+                times[step] = (count + 1, total + wall)
+        return times
+
+    def summary(self, logf=None, band=None):
+        """Write a table of the wall time spent per step, longest first."""
+        times = self.step_times(band)
+        lines = ['%-12s %6s %10s' % ('Step', 'Runs', 'Wall (s)')]
+        for step in sorted(times, key=lambda s: -times[s][1]):
+            count, total = times[step]
+            lines.append('%-12s %6d %10.1f' % (step, count, total))
+        out = logf if logf is not None else sys.stdout
+        print('\n'.join(lines), file=out)
+
+    def close(self):
+        """Close the per-source logs."""
+        with self._lock:
+            for srcf in self._srcfiles.values():
+                srcf.close()
+            self._srcfiles = {}
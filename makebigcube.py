@@ -4,6 +4,7 @@
 from IPython import embed
 import schwimmbad
 import sys
+import tempfile
 from glob import glob
 from tqdm import tqdm
 import matplotlib.pyplot as plt
@@ -13,10 +14,15 @@ from astropy import units as u
 from astropy.io import fits
 from astropy.wcs import WCS
 import au2
+import beamalgebra
+import beamindex
+import instrument
+from instrument import stage
 import scipy.signal
 import numpy as np
 from functools import partial
 import reproject as rpj
+from regrid import apply_weights, get_weights
 import warnings
 from astropy.utils.exceptions import AstropyWarning
 warnings.simplefilter('ignore', category=AstropyWarning)
@@ -51,7 +57,7 @@ def my_ceil(a, precision=0):
     return np.round(a + 0.5 * 10**(-precision), precision)
 
 
-def getmaxbeam(file_dict, tolerance=0.0001, nsamps=200, epsilon=0.0005, verbose=False):
+def getmaxbeam(file_dict, tolerance=0.0001, nsamps=200, epsilon=0.0005, index=None, verbose=False):
     """Find common beam
 
     Arguments:
@@ -61,6 +67,8 @@ def getmaxbeam(file_dict, tolerance=0.0001, nsamps=200, epsilon=0.0005, verbose=
         tolerance {float} -- See common_beam (default: {0.0001})
         nsamps {int} -- See common_beam (default: {200})
         epsilon {float} -- See common_beam (default: {0.0005})
+        index {BeamIndex} -- Beam index of the field, a new one in memory
+            if None (default: {None})
         verbose {bool} -- Verbose output (default: {False})
 
     Returns:
@@ -68,21 +76,14 @@ def getmaxbeam(file_dict, tolerance=0.0001, nsamps=200, epsilon=0.0005, verbose=
     """
     if verbose:
         print('Finding common beam...')
+    if index is None:
+        index = beamindex.BeamIndex()
     stokes = ['i', 'q', 'u', 'v']
-    beam_dict = {}
-    beams = []
-    for stoke in stokes:
-        for i, file in enumerate(file_dict[stoke]):
-            header = fits.getheader(file, memmap=True)
-            if stoke == 'i' and i == 0:
-                target_header = header
-            beam = Beam.from_fits_header(header)
-            beams.append(beam)
-    beams = Beams(
-        [beam.major.value for beam in beams]*u.deg,
-        [beam.minor.value for beam in beams]*u.deg,
-        [beam.pa.value for beam in beams]*u.deg
-    )
+    table = index.table(sum([file_dict[stoke] for stoke in stokes], []))
+    missing = np.isnan(table['bmaj'])
+    if missing.any():
+        raise Exception(f'No beam in {table["filename"][missing][0]}')
+    beams = Beams(table['bmaj']*u.deg, table['bmin']*u.deg, table['bpa']*u.deg)
 
     try:
         cmn_beam = beams.common_beam(
@@ -98,36 +99,21 @@ def getmaxbeam(file_dict, tolerance=0.0001, nsamps=200, epsilon=0.0005, verbose=
         minor=my_ceil(cmn_beam.minor.to(u.arcsec).value, precision=0)*u.arcsec,
         pa=round_up(cmn_beam.pa.to(u.deg), decimals=2)
     )
-    dx = target_header['CDELT1']*-1*u.deg
-    dy = target_header['CDELT2']*u.deg
+    dx = table['cdelt1'][0]*-1*u.deg
+    dy = table['cdelt2'][0]*u.deg
     assert abs(dx) == abs(dy)
     grid = dy
-    conbeams = [cmn_beam.deconvolve(beam) for beam in beams]
-
     # Check that convolving beam will be nyquist sampled
-    min_samps = []
-    for b_idx, conbeam in enumerate(conbeams):
-        # Get maj, min, pa
-        samp = conbeam.minor / grid.to(u.arcsec)
-        if samp < 2:
-            min_samps.append([samp, b_idx])
-
-    if len(min_samps) > 0:
+    idx, cor_beam = beamalgebra.nyquist_correction(
+        [cmn_beam.major.to_value(u.deg), cmn_beam.minor.to_value(u.deg),
+         cmn_beam.pa.to_value(u.deg)],
+        [beams.major.to_value(u.deg), beams.minor.to_value(u.deg),
+         beams.pa.to_value(u.deg)],
+        grid.to_value(u.deg))
+
+    if idx is not None:
         print('Adjusting common beam to be sampled by grid!')
-        worst_idx = np.argmin([samp[0] for samp in min_samps], axis=0)
-        samp_cor_fac, idx = 2 / \
-            min_samps[worst_idx][0], int(
-                min_samps[worst_idx][1])
-        conbeam = conbeams[idx]
-        major = conbeam.major
-        minor = conbeam.minor*samp_cor_fac
-        pa = conbeam.pa
-        # Check for small major!
-        if major < minor:
-            major = minor
-            pa = 0*u.deg
-
-        cor_beam = Beam(major, minor, pa)
+        cor_beam = Beam(cor_beam[0]*u.deg, cor_beam[1]*u.deg, cor_beam[2]*u.deg)
         if verbose:
             print('Smallest common beam is:', cmn_beam)
         cmn_beam = beams[idx].convolve(cor_beam)
@@ -177,6 +163,185 @@ def writecube(data, beam, stoke, field, outdir, verbose=False):
             print("Saved frequencies to", f"{outdir}/{freqfile}")
 
 
+def scratch_cube(shape, dtype, scratch=None):
+    """Memory-mapped array in a temporary file.
+
+    Arguments:
+        shape {tuple} -- Shape of the array.
+        dtype {dtype} -- Data type (in native byte order in the array).
+
+    Keyword Arguments:
+        scratch {str} -- Directory of the file, the system's temporary
+            directory if None (default: {None})
+
+    Returns:
+        cube {memmap} -- Array, removed from disk once it is no longer used.
+    """
+    return np.memmap(tempfile.TemporaryFile(dir=scratch),
+                     dtype=np.dtype(dtype).newbyteorder('='),
+                     mode='w+',
+                     shape=shape)
+
+
+def regrid(pool, cube, input_wcs, target_wcs, shape_out, chunk=None, scratch=None, overlaps=False, verbose=False):
+    """Regrid the channels of a cube onto a new grid.
+
+    Arguments:
+        pool {Pool} -- Pool the channels are regridded on.
+        cube {array} -- Cube (or memory-mapped cube) to regrid.
+        input_wcs {WCS} -- Celestial WCS of the cube.
+        target_wcs {WCS} -- Celestial WCS of the new grid.
+        shape_out {tuple} -- Shape of the new channel images.
+
+    Keyword Arguments:
+        chunk {int} -- Regrid blocks of this many channels into a
+            memory-mapped array in scratch, so only one block of channels is
+            held in memory; all channels in memory if None (default: {None})
+        scratch {str} -- Directory of the memory-mapped array and of the
+            overlap weights, the system's temporary directory if None
+            (default: {None})
+        overlaps {bool} -- Regrid with the overlap weights of the two grids,
+            worked out once and cached in scratch (see regrid.py), instead of
+            running reproject_exact on every channel (default: {False})
+        verbose {bool} -- Verbose output (default: {False})
+
+    Returns:
+        newcube {array} -- Regridded cube.
+    """
+    if overlaps:
+        weights = get_weights(input_wcs, cube.shape[-2:], target_wcs, shape_out,
+                              cachedir=scratch)
+        if chunk is None:
+            return apply_weights(weights, cube, shape_out)
+
+        def regrid_block(block):
+            return apply_weights(weights, block, shape_out)
+    else:
+        worker = partial(
+            rpj.reproject_exact,
+            output_projection=target_wcs,
+            shape_out=shape_out,
+            parallel=False,
+            return_footprint=False
+        )
+        if chunk is None:
+            inputs = [(image, input_wcs) for image in cube]
+            newcube = np.zeros_like(cube)*np.nan
+            out = list(
+                tqdm(
+                    pool.imap(
+                        worker, inputs
+                    ),
+                    total=len(cube),
+                    desc='Regridding channels',
+                    disable=(not verbose)
+                )
+            )
+            newcube[:] = out[:]
+            return newcube
+
+        def regrid_block(block):
+            return pool.imap(worker, [(image, input_wcs) for image in block])
+
+    newcube = scratch_cube((len(cube),) + tuple(shape_out), cube.dtype, scratch)
+    with tqdm(total=len(cube), desc='Regridding channels',
+              disable=(not verbose)) as pbar:
+        for start in range(0, len(cube), chunk):
+            for i, plane in enumerate(regrid_block(cube[start:start + chunk])):
+                newcube[start + i] = plane
+                pbar.update(1)
+            newcube.flush()
+    return newcube
+
+
+def smooth_plane(plane, conbeam):
+    """Convolve a channel image, with its blanked pixels set to 0.
+
+    Arguments:
+        plane {array} -- Channel image.
+        conbeam {array} -- Convolution kernel.
+
+    Returns:
+        smoothed {array} -- Smoothed image.
+    """
+    plane = np.where(np.isfinite(plane), plane, 0)
+    return scipy.signal.convolve(plane, conbeam, mode='same')
+
+
+def smooth(pool, cube, conbeam, chunk=None, scratch=None, verbose=False):
+    """Convolve the channels of a cube with a kernel.
+
+    Arguments:
+        pool {Pool} -- Pool the channels are smoothed on.
+        cube {array} -- Cube (or memory-mapped cube) to smooth.
+        conbeam {array} -- Convolution kernel.
+
+    Keyword Arguments:
+        chunk {int} -- Smooth blocks of this many channels into a
+            memory-mapped array in scratch; all channels in memory if None
+            (default: {None})
+        scratch {str} -- Directory of the memory-mapped array (default: {None})
+        verbose {bool} -- Verbose output (default: {False})
+
+    Returns:
+        smcube {array} -- Smoothed cube.
+    """
+    worker = partial(smooth_plane, conbeam=conbeam)
+    if chunk is None:
+        smcube = np.zeros_like(cube)*np.nan
+        out = list(tqdm(
+            pool.imap(
+                worker, cube
+            ),
+            total=len(cube),
+            desc='Smoothing channels',
+            disable=(not verbose)
+        ))
+        smcube[:] = out[:]
+        return smcube
+
+    smcube = scratch_cube(cube.shape, cube.dtype, scratch)
+    with tqdm(total=len(cube), desc='Smoothing channels',
+              disable=(not verbose)) as pbar:
+        for start in range(0, len(cube), chunk):
+            for i, plane in enumerate(pool.imap(worker, cube[start:start + chunk])):
+                smcube[start + i] = plane
+                pbar.update(1)
+            smcube.flush()
+    return smcube
+
+
+def stack(cubes, facs, chunk=None, scratch=None):
+    """Scale cubes and stack them along the frequency axis.
+
+    Arguments:
+        cubes {list} -- Cubes (or memory-mapped cubes) to stack.
+        facs {list} -- Scaling factor of each cube.
+
+    Keyword Arguments:
+        chunk {int} -- Copy blocks of this many channels into a memory-mapped
+            array in scratch; all channels in memory if None (default: {None})
+        scratch {str} -- Directory of the memory-mapped array (default: {None})
+
+    Returns:
+        bigcube {array} -- Stacked cube.
+    """
+    if chunk is None:
+        return np.vstack([cube*fac for cube, fac in zip(cubes, facs)])
+
+    nchan = sum(len(cube) for cube in cubes)
+    bigcube = scratch_cube((nchan,) + cubes[0].shape[1:],
+                           np.result_type(cubes[0], facs[0]), scratch)
+    offset = 0
+    for cube, fac in zip(cubes, facs):
+        for start in range(0, len(cube), chunk):
+            block = cube[start:start + chunk]
+            bigcube[offset + start:offset + start + len(block)] = block*fac
+        offset += len(cube)
+    bigcube.flush()
+    return bigcube
+
+
 def main(pool, args, verbose=False):
     """Main script
     """
@@ -196,6 +361,9 @@ def main(pool, args, verbose=False):
             outdir = outdir[:-1]
     elif outdir is None:
         outdir = datadir
+    timefile = instrument.start(f'makebigcube.{field}', outdir)
+    if verbose:
+        print('Recording step timings in', timefile)
 
     # Glob out files
     file_dict = {}
@@ -219,12 +387,16 @@ def main(pool, args, verbose=False):
     for stoke in stokes:
         if len(file_dict[stoke]) == 0:
             raise Exception(f'No Stokes {stoke} files found!')
-    # Get common beam
-    big_beam = getmaxbeam(file_dict,
-                          tolerance=args.tolerance,
-                          nsamps=args.nsamps,
-                          epsilon=args.epsilon,
-                          verbose=verbose)
+    # Get common beam, from the beam index makecube keeps next to the cubes
+    index = beamindex.BeamIndex(f'{datadir}/{field}.beamindex.npy')
+    with stage('commonbeam', source=field):
+        big_beam = getmaxbeam(file_dict,
+                              tolerance=args.tolerance,
+                              nsamps=args.nsamps,
+                              epsilon=args.epsilon,
+                              index=index,
+                              verbose=verbose)
+    index.save()
 
     bmaj = args.bmaj
     bmin = args.bmin
@@ -291,53 +463,45 @@ def main(pool, args, verbose=False):
 
         # Regrid
         for band in tqdm(bands, desc='Regridding data', disable=(not verbose)):
-            worker = partial(
-                rpj.reproject_exact,
-                output_projection=target_wcs.celestial,
-                shape_out=datadict[2100]['data'][0].shape,
-                parallel=False,
-                return_footprint=False
-            )
-            input_wcs = datadict[band]['wcs'].celestial
-            inputs = [(image, input_wcs) for image in datadict[band]['data']]
-            newcube = np.zeros_like(datadict[band]['data'])*np.nan
-            out = list(
-                tqdm(
-                    pool.imap(
-                        worker, inputs
-                    ),
-                    total=len(datadict[band]['data']),
-                    desc='Regridding channels',
-                    disable=(not verbose)
+            with stage('regrid', source=f'{field}.{stoke}', band=str(band)):
+                newcube = regrid(pool,
+                                 datadict[band]['data'],
+                                 datadict[band]['wcs'].celestial,
+                                 target_wcs.celestial,
+                                 datadict[2100]['data'][0].shape,
+                                 chunk=args.chunk,
+                                 scratch=args.scratch or outdir,
+                                 overlaps=args.overlaps,
+                                 verbose=verbose)
+                datadict[band].update(
+                    {
+                        "newdata": newcube
+                    }
                 )
-            )
-            newcube[:] = out[:]
-            datadict[band].update(
-                {
-                    "newdata": newcube
-                }
-            )
 
         # Get scaling factors and convolution kernels
-        for band in tqdm(bands, desc='Computing scaling factors', disable=(not verbose)):
-            con_beam = new_beam.deconvolve(datadict[band]['beam'])
-            dx = target_header['CDELT1']*-1*u.deg
-            dy = target_header['CDELT2']*u.deg
-
-            fac, amp, outbmaj, outbmin, outbpa = au2.gauss_factor(
-                [
-                    con_beam.major.to(u.arcsec).value,
-                    con_beam.minor.to(u.arcsec).value,
-                    con_beam.pa.to(u.deg).value
-                ],
-                beamOrig=[
-                    datadict[band]['beam'].major.to(u.arcsec).value,
-                    datadict[band]['beam'].minor.to(u.arcsec).value,
-                    datadict[band]['beam'].pa.to(u.deg).value
-                ],
-                dx1=dx.to(u.arcsec).value,
-                dy1=dy.to(u.arcsec).value
-            )
+        dx = target_header['CDELT1']*-1*u.deg
+        dy = target_header['CDELT2']*u.deg
+        con_beams = [new_beam.deconvolve(datadict[band]['beam'])
+                     for band in bands]
+        facs, amps, outbmajs, outbmins, outbpas = au2.gauss_factor_array(
+            [
+                [con_beam.major.to(u.arcsec).value for con_beam in con_beams],
+                [con_beam.minor.to(u.arcsec).value for con_beam in con_beams],
+                [con_beam.pa.to(u.deg).value for con_beam in con_beams]
+            ],
+            beamOrig=[
+                [datadict[band]['beam'].major.to(u.arcsec).value for band in bands],
+                [datadict[band]['beam'].minor.to(u.arcsec).value for band in bands],
+                [datadict[band]['beam'].pa.to(u.deg).value for band in bands]
+            ],
+            dx1=dx.to(u.arcsec).value,
+            dy1=dy.to(u.arcsec).value
+        )
+        for band, con_beam, fac in tqdm(zip(bands, con_beams, facs),
+                                        total=len(bands),
+                                        desc='Computing convolution kernels',
+                                        disable=(not verbose)):
             pix_scale = dy
             gauss_kern = con_beam.as_kernel(pix_scale)
             conbm = gauss_kern.array/gauss_kern.array.max()
@@ -356,29 +520,18 @@ def main(pool, args, verbose=False):
 
         # Convolve data
         for band in tqdm(bands, desc='Smoothing data', disable=(not verbose)):
-            smooth = partial(
-                scipy.signal.convolve,
-                in2=datadict[band]['conbeam'],
-                mode='same'
-            )
-            sm_data = np.zeros_like(datadict[band]['newdata'])*np.nan
-            cube = np.copy(datadict[band]['newdata'])
-            cube[~np.isfinite(cube)] = 0
-            out = list(tqdm(
-                pool.imap(
-                    smooth, cube
-                ),
-                total=len(datadict[band]['newdata']),
-                desc='Smoothing channels',
-                disable=(not verbose)
-            ))
-            sm_data[:] = out[:]
-            sm_data[~np.isfinite(cube)] = np.nan
-            datadict[band].update(
-                {
-                    'smdata': sm_data,
-                }
-            )
+            with stage('smooth', source=f'{field}.{stoke}', band=str(band)):
+                sm_data = smooth(pool,
+                                 datadict[band]['newdata'],
+                                 datadict[band]['conbeam'],
+                                 chunk=args.chunk,
+                                 scratch=args.scratch or outdir,
+                                 verbose=verbose)
+                datadict[band].update(
+                    {
+                        'smdata': sm_data,
+                    }
+                )
         stoke_dict.update(
             {
                 stoke: datadict
@@ -405,16 +558,19 @@ def main(pool, args, verbose=False):
 
     # Make cubes
     for stoke in tqdm(stokes, desc='Making cubes', disable=(not verbose)):
-        cube = np.vstack([stoke_dict[stoke][band]['smdata']
-                          * stoke_dict[stoke][band]['fac'] for band in bands])
-        freq_cube = np.concatenate(
-            [stoke_dict[stoke][band]['freq'] for band in bands]) * u.Hz
-        stoke_dict[stoke].update(
-            {
-                'cube': cube,
-                'freqs': freq_cube
-            }
-        )
+        with stage('makecube', source=f'{field}.{stoke}'):
+            cube = stack([stoke_dict[stoke][band]['smdata'] for band in bands],
+                         [stoke_dict[stoke][band]['fac'] for band in bands],
+                         chunk=args.chunk,
+                         scratch=args.scratch or outdir)
+            freq_cube = np.concatenate(
+                [stoke_dict[stoke][band]['freq'] for band in bands]) * u.Hz
+            stoke_dict[stoke].update(
+                {
+                    'cube': cube,
+                    'freqs': freq_cube
+                }
+            )
 
     # Show plots
     if args.debug:
@@ -444,14 +600,16 @@ def main(pool, args, verbose=False):
     if not args.dryrun:
         # Save the cubes
         for stoke in tqdm(stokes, desc='Writing cubes', disable=(not verbose)):
-            writecube(stoke_dict[stoke],
-                      new_beam,
-                      stoke,
-                      field,
-                      outdir,
-                      verbose=verbose)
+            with stage('writecube', source=f'{field}.{stoke}'):
+                writecube(stoke_dict[stoke],
+                          new_beam,
+                          stoke,
+                          field,
+                          outdir,
+                          verbose=verbose)
 
     if verbose:
+        instrument.summary()
         print('Done!')
 
 
@@ -558,6 +716,26 @@ def cli():
         default=200,
         help="nsamps for radio_beam.commonbeam.")
 
+    parser.add_argument(
+        "--chunk",
+        dest="chunk",
+        type=int,
+        default=None,
+        help="Regrid, smooth and stack blocks of this many channels into\nmemory-mapped cubes instead of holding all channels in memory [None].")
+
+    parser.add_argument(
+        "--scratch",
+        dest="scratch",
+        type=str,
+        default=None,
+        help="(Optional) Directory for the memory-mapped cubes and the\noverlap weights [outdir].")
+
+    parser.add_argument(
+        "--reuse-overlaps",
+        dest="overlaps",
+        action="store_true",
+        help="Work out the regridding overlaps once per band and reuse them\nfor every channel and Stokes [False].")
+
     group = parser.add_mutually_exclusive_group()
 
     group.add_argument("--ncores", dest="n_cores", default=1,
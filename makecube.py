@@ -10,8 +10,11 @@ from radio_beam.utils import BeamError
 from astropy import units as u
 from astropy.io import fits
 import matplotlib.pyplot as plt
-import au2
-import scipy.signal
+import instrument
+import beamalgebra
+import beamindex
+import smoothing
+from instrument import stage
 import numpy as np
 from functools import partial
 from IPython import embed
@@ -26,7 +29,7 @@ def my_ceil(a, precision=0):
     return np.round(a + 0.5 * 10**(-precision), precision)
 
 
-def getmaxbeam(data_dict, band, cutoff=15*u.arcsec, tolerance=0.0001, nsamps=200, epsilon=0.0005, verbose=False, debug=False):
+def getmaxbeam(data_dict, band, cutoff=15*u.arcsec, tolerance=0.0001, nsamps=200, epsilon=0.0005, index=None, verbose=False, debug=False):
     """Find common beam.
 
     Arguments:
@@ -37,33 +40,32 @@ def getmaxbeam(data_dict, band, cutoff=15*u.arcsec, tolerance=0.0001, nsamps=200
         tolerance {float} -- See common_beam (default: {0.0001})
         nsamps {int} -- See common_beam (default: {200})
         epsilon {float} -- See common_beam (default: {0.0005})
+        index {BeamIndex} -- Beam index of the field, a new one in memory
+            if None (default: {None})
         verbose {bool} -- Verbose output (default: {False})
         debug {bool} -- Show dubugging plots (default: {False})
 
     Returns:
         beam_dict {dict} -- Beam and frequency data.
     """
+    if index is None:
+        index = beamindex.BeamIndex()
     files = data_dict[band]
     stokes = ['i', 'q', 'u', 'v']
     beam_dict = {}
+    tables = {}
     for stoke in stokes:
-        beams = []
-        freqs = []
-        for file in files[stoke]:
-            header = fits.getheader(file, memmap=True)
-            freqs.append(header['CRVAL3'])
-            beam = Beam.from_fits_header(header)
-            beams.append(beam)
-        beams = Beams(
-            [beam.major.value for beam in beams]*u.deg,
-            [beam.minor.value for beam in beams]*u.deg,
-            [beam.pa.value for beam in beams]*u.deg
-        )
+        table = index.table(files[stoke])
+        missing = np.isnan(table['bmaj'])
+        if missing.any():
+            raise Exception(f'No beam in {table["filename"][missing][0]}')
+        beams = Beams(table['bmaj']*u.deg, table['bmin']*u.deg, table['bpa']*u.deg)
         flags = beams.major > cutoff
+        tables[stoke] = table
         beam_dict.update(
             {
                 stoke+'_beams': beams,
-                stoke+'_freqs': np.array(freqs)*u.Hz,
+                stoke+'_freqs': table['crval3']*u.Hz,
                 stoke+'_flags': flags
             }
         )
@@ -116,36 +118,20 @@ def getmaxbeam(data_dict, band, cutoff=15*u.arcsec, tolerance=0.0001, nsamps=200
         pa=round_up(cmn_beam.pa.to(u.deg), decimals=2)
     )
 
-    target_header = fits.getheader(data_dict[band]['i'][0], memmap=True)
-    dx = target_header['CDELT1']*-1*u.deg
-    dy = target_header['CDELT2']*u.deg
+    dx = tables['i']['cdelt1'][0]*-1*u.deg
+    dy = tables['i']['cdelt2'][0]*u.deg
     grid = dy
-    conbeams = [cmn_beam.deconvolve(beam) for beam in big_beams]
-
     # Check that convolving beam will be nyquist sampled
-    min_samps = []
-    for b_idx, conbeam in enumerate(conbeams):
-        # Get maj, min, pa
-        samp = conbeam.minor / grid.to(u.arcsec)
-        if samp < 2:
-            min_samps.append([samp, b_idx])
-
-    if len(min_samps) > 0:
+    idx, cor_beam = beamalgebra.nyquist_correction(
+        [cmn_beam.major.to_value(u.deg), cmn_beam.minor.to_value(u.deg),
+         cmn_beam.pa.to_value(u.deg)],
+        [big_beams.major.to_value(u.deg), big_beams.minor.to_value(u.deg),
+         big_beams.pa.to_value(u.deg)],
+        grid.to_value(u.deg))
+
+    if idx is not None:
         print('Adjusting common beam to be sampled by grid!')
-        worst_idx = np.argmin([samp[0] for samp in min_samps], axis=0)
-        samp_cor_fac, idx = 2 / \
-            min_samps[worst_idx][0], int(
-                min_samps[worst_idx][1])
-        conbeam = conbeams[idx]
-        major = conbeam.major
-        minor = conbeam.minor*samp_cor_fac
-        pa = conbeam.pa
-        # Check for small major!
-        if major < minor:
-            major = minor
-            pa = 0*u.deg
-
-        cor_beam = Beam(major, minor, pa)
+        cor_beam = Beam(cor_beam[0]*u.deg, cor_beam[1]*u.deg, cor_beam[2]*u.deg)
         if verbose:
             print('Smallest common beam is:', cmn_beam)
         cmn_beam = big_beams[idx].convolve(cor_beam)
@@ -221,52 +207,43 @@ def smooth(inps, new_beam, verbose=False):
     Returns:
         newim {array} -- Image smoothed to new resolution.
     """
-    filename, old_beam, flag = inps
-    if verbose:
-        print(f'Getting image data from {filename}')
-    with fits.open(filename, memmap=True, mode='denywrite') as hdu:
-        dx = hdu[0].header['CDELT1']*-1*u.deg
-        dy = hdu[0].header['CDELT2']*u.deg
-        nx, ny = hdu[0].data[0, 0, :,
-                             :].shape[0], hdu[0].data[0, 0, :, :].shape[1]
-        image = np.squeeze(hdu[0].data).astype('float64')
-
-    if flag:
-        newim = np.ones_like(image)*np.nan
-
-    else:
-        con_beam = new_beam.deconvolve(old_beam)
-        fac, amp, outbmaj, outbmin, outbpa = au2.gauss_factor(
-            [
-                con_beam.major.to(u.arcsec).value,
-                con_beam.minor.to(u.arcsec).value,
-                con_beam.pa.to(u.deg).value
-            ],
-            beamOrig=[
-                old_beam.major.to(u.arcsec).value,
-                old_beam.minor.to(u.arcsec).value,
-                old_beam.pa.to(u.deg).value
-            ],
-            dx1=dx.to(u.arcsec).value,
-            dy1=dy.to(u.arcsec).value
-        )
+    return smoothing.smooth_channel([inps], new_beam, verbose=verbose)[0]
 
-        if verbose:
-            print(f'Smoothing so beam is', new_beam)
-            print(f'Using convolving beam', con_beam)
 
-        pix_scale = dy
+def cube_header(freqs, header, beam):
+    """Frequency order and header of a band cube.
 
-        gauss_kern = con_beam.as_kernel(pix_scale)
+    Arguments:
+        freqs {array} -- Frequency list of the channels.
+        header {header} -- Header of a channel image.
+        beam {Beam} -- New common resolution beam.
 
-        conbm1 = gauss_kern.array/gauss_kern.array.max()
+    Returns:
+        sort_idx {array} -- Channel order in the cube.
+        freqs_sorted {array} -- Frequencies in cube order.
+        header {header} -- Header for the cube.
+    """
+    sort_idx = freqs.argsort()
+    freqs_sorted = freqs[sort_idx]
 
-        newim = scipy.signal.convolve(image, conbm1, mode='same')
+    d_freq = np.nanmedian(np.diff(freqs_sorted))
+    del header['HISTORY']
+    header = beam.attach_to_header(header)
+    header['CRVAL3'] = freqs_sorted[0].to_value()
+    header['CDELT3'] = d_freq.to_value()
+    header['COMMENT'] = 'DO NOT rely on this header for correct frequency data!'
+    header['COMMENT'] = 'Use accompanying frequency text file.'
+    return sort_idx, freqs_sorted, header
 
-        newim *= fac
+
+def writefreqs(freqs_sorted, band, stoke, field, outdir, verbose=True):
+    """Write the frequency text file of a band (once, with Stokes I).
+    """
+    if stoke == 'i':
+        freqfile = f"{field}.{band}.bandcube.frequencies.txt"
+        np.savetxt(f"{outdir}/{freqfile}", freqs_sorted.to_value())
         if verbose:
-            sys.stdout.flush()
-    return newim
+            print("Saved frequencies to", f"{outdir}/{freqfile}")
 
 
 def writecube(data, freqs, header, beam, band, stoke, field, outdir, verbose=True):
@@ -288,31 +265,94 @@ def writecube(data, freqs, header, beam, band, stoke, field, outdir, verbose=Tru
     # Make filename
     outfile = f"{field}.{band}.{stoke}.cutout.bandcube.fits"
 
-    # Sort data
-    sort_idx = freqs.argsort()
-    freqs_sorted = freqs[sort_idx]
+    # Sort data and make header
+    sort_idx, freqs_sorted, header = cube_header(freqs, header, beam)
     data_sorted = data[sort_idx, :, :]
 
-    # Make header
-    d_freq = np.nanmedian(np.diff(freqs_sorted))
-    del header['HISTORY']
-    header = beam.attach_to_header(header)
-    header['CRVAL3'] = freqs_sorted[0].to_value()
-    header['CDELT3'] = d_freq.to_value()
-    header['COMMENT'] = 'DO NOT rely on this header for correct frequency data!'
-    header['COMMENT'] = 'Use accompanying frequency text file.'
-
     # Save the data
     fits.writeto(f'{outdir}/{outfile}', data_sorted,
                  header=header, overwrite=True)
     if verbose:
         print("Saved cube to", f'{outdir}/{outfile}')
 
-    if stoke == 'i':
-        freqfile = f"{field}.{band}.bandcube.frequencies.txt"
-        np.savetxt(f"{outdir}/{freqfile}", freqs_sorted.to_value())
+    writefreqs(freqs_sorted, band, stoke, field, outdir, verbose=verbose)
+
+
+def opencube(filename, header, shape, dtype='float64'):
+    """Create a FITS cube on disk and memory-map its data.
+
+    The file has the header and size fits.writeto would give a cube of this
+    shape and type, so planes can be written into it in any order.
+
+    Arguments:
+        filename {str} -- Output file.
+        header {header} -- Cube header.
+        shape {tuple} -- (nchan, ny, nx)
+
+    Keyword Arguments:
+        dtype {str} -- Data type (default: {'float64'})
+
+    Returns:
+        cube {memmap} -- Writable (nchan, ny, nx) view of the data.
+    """
+    stub = fits.PrimaryHDU(data=np.zeros((1, 1, 1), dtype=dtype),
+                           header=header)
+    hdr = stub.header
+    hdr['NAXIS1'], hdr['NAXIS2'], hdr['NAXIS3'] = shape[2], shape[1], shape[0]
+    hdr.tofile(filename, overwrite=True)
+    offset = len(hdr.tostring())
+    nbytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+    with open(filename, 'rb+') as cubef:
+        # Data padded to whole FITS blocks
+        cubef.seek(offset + -(-nbytes // 2880)*2880 - 1)
+        cubef.write(b'\0')
+    return np.memmap(filename, dtype=np.dtype(dtype).newbyteorder('>'),
+                     mode='r+', offset=offset, shape=shape)
+
+
+def streamcubes(channels, freqs, headers, beam, band, stokes, field, outdir, verbose=True):
+    """Write channel planes straight into the cubes as they are made.
+
+    The cube of each Stokes parameter is created on disk in frequency order,
+    and the planes of each channel are written into their slots as soon as
+    they arrive, so only a few planes are held in memory instead of the
+    whole cube (twice).
+
+    Arguments:
+        channels {iterable} -- Smoothed images of each channel, one per
+            Stokes parameter, in the order of freqs.
+        freqs {dict} -- Frequency list of the channels, per Stokes.
+        headers {dict} -- Header of a channel image, per Stokes.
+        beam {Beam} -- New common resolution beam.
+        band {int} -- ATCA band name.
+        stokes {list} -- Stokes parameters of the planes.
+        field {str} -- QUOCKA field name.
+        outdir {str} -- Directory to save output.
+
+    Keyword Arguments:
+        verbose {bool} -- Verbose output (default: {True})
+    """
+    cubes = []
+    for stoke in stokes:
+        outfile = f"{field}.{band}.{stoke}.cutout.bandcube.fits"
+        header = headers[stoke]
+        shape = (len(freqs[stoke]), header['NAXIS2'], header['NAXIS1'])
+        sort_idx, freqs_sorted, header = cube_header(freqs[stoke], header, beam)
+        # Slot in the cube of each input channel
+        slots = np.empty(len(sort_idx), dtype=int)
+        slots[sort_idx] = np.arange(len(sort_idx))
+        cubes.append((outfile, freqs_sorted, slots,
+                      opencube(f'{outdir}/{outfile}', header, shape)))
+
+    for chan, planes in enumerate(channels):
+        for (outfile, freqs_sorted, slots, cube), plane in zip(cubes, planes):
+            cube[slots[chan]] = plane
+
+    for stoke, (outfile, freqs_sorted, slots, cube) in zip(stokes, cubes):
+        cube.flush()
         if verbose:
-            print("Saved frequencies to", f"{outdir}/{freqfile}")
+            print("Saved cube to", f'{outdir}/{outfile}')
+        writefreqs(freqs_sorted, band, stoke, field, outdir, verbose=verbose)
 
 
 def main(pool, args, verbose=False):
@@ -331,6 +371,9 @@ def main(pool, args, verbose=False):
             outdir = outdir[:-1]
     elif outdir is None:
         outdir = datadir
+    timefile = instrument.start(f'makecube.{args.field}', outdir)
+    if verbose:
+        print('Recording step timings in', timefile)
 
     # Glob out files
     data_dict = {}
@@ -352,22 +395,27 @@ def main(pool, args, verbose=False):
         for stoke in stokes:
             if len(data_dict[band][stoke]) == 0:
                 raise Exception(f'No Band {band} Stokes {stoke} files found!')
-    # Get common beams
+    # Get common beams, from the beam index kept next to the images
+    index = beamindex.BeamIndex(f'{datadir}/{args.field}.beamindex.npy',
+                                threads=args.index_threads)
     for band in tqdm(bands,
                      desc='Finding commmon beam per band',
                      disable=(not verbose)):
-        beam_dict = getmaxbeam(data_dict,
-                               band,
-                               tolerance=args.tolerance,
-                               nsamps=args.nsamps,
-                               epsilon=args.epsilon,
-                               verbose=verbose,
-                               debug=args.debug)
+        with stage('commonbeam', source=args.field, band=str(band)):
+            beam_dict = getmaxbeam(data_dict,
+                                   band,
+                                   tolerance=args.tolerance,
+                                   nsamps=args.nsamps,
+                                   epsilon=args.epsilon,
+                                   index=index,
+                                   verbose=verbose,
+                                   debug=args.debug)
         if verbose:
             print(f'Common beam for band {band} is', beam_dict['common_beam'])
         data_dict[band].update(
             beam_dict
         )
+    index.save()
 
     # Do the convolution
     if verbose:
@@ -375,42 +423,53 @@ def main(pool, args, verbose=False):
     for band in bands:
         if verbose:
             print(f'Band: {band}')
-        smooth_partial = partial(smooth,
+        smooth_partial = partial(smoothing.smooth_channel,
                                  new_beam=data_dict[band]['common_beam'],
+                                 workers=args.fft_workers,
                                  verbose=False
                                  )
-        for stoke in stokes:
+        # Smooth the Stokes images of a channel together when every Stokes
+        # has the same channels, otherwise one Stokes at a time
+        stems = [[file[:-len(f'.{stoke}.cutout.fits')]
+                  for file in data_dict[band][stoke]] for stoke in stokes]
+        if all(stem == stems[0] for stem in stems):
+            groups = [stokes]
+        else:
+            groups = [[stoke] for stoke in stokes]
+        for group in groups:
             if verbose:
-                print(f'Stokes: {stoke}')
-            data = list(
-                tqdm(
-                    pool.imap(smooth_partial,
-                              zip(data_dict[band][stoke],
-                                  data_dict[band][stoke+'_beams'],
-                                  data_dict[band][stoke+'_flags'])
-                              ),
-                    total=len(data_dict[band][stoke]),
+                print(f'Stokes: {",".join(group)}')
+            freqs = dict((stoke, data_dict[band][stoke+'_freqs'])
+                         for stoke in group)
+            if args.dryrun:
+                continue
+            head_temps = dict((stoke, fits.getheader(data_dict[band][stoke][0]))
+                              for stoke in group)
+            beam = data_dict[band]['common_beam']
+            # Smooth the channels and write them into the cubes as they come
+            with stage('smooth', source=f'{args.field}.{"".join(group)}', band=str(band)):
+                jobs = zip(*[zip(data_dict[band][stoke],
+                                 data_dict[band][stoke+'_beams'],
+                                 data_dict[band][stoke+'_flags'])
+                             for stoke in group])
+                channels = tqdm(
+                    pool.imap(smooth_partial, jobs),
+                    total=len(data_dict[band][group[0]]),
                     disable=(not verbose),
                     desc='Smoothing channels'
                 )
-            )
-            data = np.array(data)
-            freqs = data_dict[band][stoke+'_freqs']
-            head_temp = fits.getheader(data_dict[band][stoke][0])
-            beam = data_dict[band]['common_beam']
-            if not args.dryrun:
-                # Save the cubes
-                writecube(data,
-                          freqs,
-                          head_temp,
-                          beam,
-                          band,
-                          stoke,
-                          args.field,
-                          outdir,
-                          verbose=verbose)
+                streamcubes(channels,
+                            freqs,
+                            head_temps,
+                            beam,
+                            band,
+                            group,
+                            args.field,
+                            outdir,
+                            verbose=verbose)
 
     if verbose:
+        instrument.summary()
         print('Done!')
 
 
@@ -503,6 +562,20 @@ def cli():
         default=200,
         help="nsamps for radio_beam.commonbeam.")
 
+    parser.add_argument(
+        "--fft-workers",
+        dest="fft_workers",
+        type=int,
+        default=1,
+        help="Threads used by each FFT when smoothing [1].")
+
+    parser.add_argument(
+        "--index-threads",
+        dest="index_threads",
+        type=int,
+        default=8,
+        help="Headers read at the same time when building the beam index [8].")
+
     group = parser.add_mutually_exclusive_group()
 
     group.add_argument("--ncores", dest="n_cores", default=1,
@@ -519,7 +592,10 @@ def cli():
             sys.exit(0)
 
     # make it so we can use imap in serial and mpi mode
-    if not isinstance(pool, schwimmbad.MultiPool):
+    if isinstance(pool, schwimmbad.SerialPool):
+        # Lazy, so each channel is written to the cube as soon as it is made
+        pool.imap = map
+    elif not isinstance(pool, schwimmbad.MultiPool):
         pool.imap = pool.map
 
     verbose = args.verbose
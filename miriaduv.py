@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+"""Direct access to the visibilities and flags of MIRIAD uv datasets.
+
+The visibilities of a dataset are a stream of variable updates (the visdata
+item). Each update starts with a 4-byte header (variable index, 0, code, 0):
+a size update is followed by the new length in bytes, a data update by the
+value, aligned to its element size, and an end-of-record code closes each
+set of synchronised updates. Every record with correlation data has one
+flag bit per channel in the flags item: 31 bits to a big-endian integer,
+after a 4-byte item header, with the bit set for good data. This follows
+uvio.c and maskio.c of the MIRIAD library.
+
+read_uv scans the stream once and returns the correlations, the variables
+asked for and where the flags of each record are; read_layout only finds
+where the flags are. read_flags and
+write_flags work on the flags item in place, so flagging a dataset rewrites
+only its flags (one bit per correlation) and leaves every other item alone.
+"""
+
+import os
+
+import numpy as np
+
+# Element type and size of the variable types of the vartable
+TYPES = {'a': ('S1', 1), 'j': ('>i2', 2), 'i': ('>i4', 4),
+         'r': ('>f4', 4), 'd': ('>f8', 8), 'c': ('>c8', 8)}
+
+UV_ALIGN = 8
+UV_HDR_SIZE = 4
+VAR_SIZE = 0
+VAR_DATA = 1
+VAR_EOR = 2
+
+# Flag bits per integer of the flags item, and bit offset of the first flag
+# (after the item header)
+BITS_PER_INT = 31
+FLAG_OFFSET = BITS_PER_INT
+
+# Item header of an integer item
+INT_ITEM = bytes([0, 0, 0, 2])
+
+
+def _roundup(offset, align):
+    return ((offset + align - 1)//align)*align
+
+
+def read_vartable(vis):
+    """Names and types of the uv variables of a dataset.
+
+    Arguments:
+        vis {str} -- Dataset.
+
+    Returns:
+        variables {list} -- (name, type) of each variable, in index order.
+    """
+    variables = []
+    with open(os.path.join(vis, 'vartable')) as tablef:
+        for line in tablef:
+            sline = line.split()
+            if len(sline) == 2:
+                variables.append((sline[1], sline[0]))
+    return variables
+
+
+def header_item(vis, name):
+    """Value of a numeric item kept in the header of a dataset.
+
+    Small items (vislen, ncorr, ...) are stored in the header item as a
+    16-byte entry (name, with the item size in its last byte) followed by
+    the item, padded to 16 bytes.
+
+    Arguments:
+        vis {str} -- Dataset.
+        name {str} -- Item name.
+
+    Returns:
+        value {int or float} -- Value of the item, None if it isn't there.
+    """
+    dtypes = {2: '>i4', 3: '>i2', 4: '>f4', 5: '>f8', 8: '>i8'}
+    with open(os.path.join(vis, 'header'), 'rb') as headf:
+        header = headf.read()
+    offset = 0
+    while offset + 16 <= len(header):
+        entry = header[offset:offset + 16]
+        size = entry[15]
+        offset += 16
+        if entry[:15].split(b'\0')[0].decode('ascii', errors='replace') == name:
+            item = header[offset:offset + size]
+            if len(item) < UV_HDR_SIZE or item[3] not in dtypes:
+                return None
+            dtype = np.dtype(dtypes[item[3]])
+            start = _roundup(UV_HDR_SIZE, dtype.itemsize)
+            return np.frombuffer(item, dtype=dtype, count=1, offset=start)[0].item()
+        offset += _roundup(size, 16)
+    return None
+
+
+def _records(vis, names):
+    """Scan the visdata stream of a dataset.
+
+    Yields, for every record with correlation data, the memory-mapped
+    stream, the type, position, length in bytes and scale of the
+    correlations, and the current values of the variables in names.
+    """
+    variables = read_vartable(vis)
+    index = dict((name, i) for i, (name, _) in enumerate(variables))
+    if 'corr' not in index:
+        raise ValueError('%s has no correlation data' % vis)
+    filename = os.path.join(vis, 'visdata')
+    vislen = header_item(vis, 'vislen')
+    if vislen is None:
+        vislen = os.path.getsize(filename)
+    stream = np.memmap(filename, dtype=np.uint8, mode='r')[:vislen]
+
+    icorr = index['corr']
+    ctype = variables[icorr][1]
+    if ctype not in ('r', 'j', 'c'):
+        raise ValueError('%s: unsupported corr type %s' % (vis, ctype))
+    tscale = index.get('tscale')
+    wanted = dict((index[name], name) for name in names if name in index)
+    lengths = [0]*len(variables)
+    current = dict((name, None) for name in names)
+    scale = 1.0
+
+    updated = None
+    offset = 0
+    while offset < vislen:
+        var, code = int(stream[offset]), int(stream[offset + 2])
+        if code == VAR_SIZE:
+            lengths[var] = int(np.frombuffer(stream, dtype='>i4', count=1,
+                                             offset=offset + UV_HDR_SIZE)[0])
+            offset += UV_ALIGN
+        elif code == VAR_DATA:
+            dtype, size = TYPES[variables[var][1]]
+            start = offset + _roundup(UV_HDR_SIZE, size)
+            length = lengths[var]
+            if var == icorr:
+                updated = (start, length)
+            elif var == tscale:
+                scale = float(np.frombuffer(stream, dtype='>f4', count=1,
+                                            offset=start)[0])
+            if var in wanted:
+                value = np.frombuffer(stream, dtype=dtype, count=length//size,
+                                      offset=start)
+                if dtype == 'S1':
+                    value = b''.join(value).rstrip(b'\0').decode()
+                elif len(value) == 1:
+                    value = value[0].item()
+                else:
+                    value = tuple(value.tolist())
+                current[wanted[var]] = value
+            offset = _roundup(start + length, UV_ALIGN)
+        elif code == VAR_EOR:
+            if updated is not None:
+                yield stream, ctype, updated[0], updated[1], scale, current
+                updated = None
+            offset += UV_ALIGN
+        else:
+            raise ValueError('%s: bad record code %d at offset %d' %
+                             (vis, code, offset))
+
+
+def _nchan(ctype, length):
+    return length//8 if ctype == 'c' else length//(2*TYPES[ctype][1])
+
+
+def read_layout(vis):
+    """Where the flags of the correlation records of a dataset are.
+
+    Only the record headers are read, not the visibilities.
+
+    Arguments:
+        vis {str} -- Dataset.
+
+    Returns:
+        offsets {array} -- Position of the first flag of each record in
+            the flags item.
+        nchan {int} -- Number of channels per record.
+    """
+    offsets = []
+    nchan = None
+    nflags = 0
+    for stream, ctype, start, length, scale, current in _records(vis, ()):
+        n = _nchan(ctype, length)
+        if nchan is not None and n != nchan:
+            raise ValueError('%s: the number of channels changes' % vis)
+        nchan = n
+        offsets.append(nflags)
+        nflags += n
+    return np.array(offsets, dtype=np.int64), nchan or 0
+
+
+def read_uv(vis, names=('time', 'baseline', 'pol')):
+    """Read the correlation records of a dataset, in one pass.
+
+    Only the records uvread returns are read: those in which the corr
+    variable was written.
+
+    Arguments:
+        vis {str} -- Dataset.
+
+    Keyword Arguments:
+        names {list} -- Variables to return the value of at each record
+            (default: {('time', 'baseline', 'pol')})
+
+    Returns:
+        corr {array} -- Correlations, complex, shape (nrecord, nchan).
+        values {dict} -- Value of each of names at each record (the first
+            element for scalars, a tuple otherwise; None if not set yet).
+        offsets {array} -- Position of the first flag of each record in
+            the flags item.
+    """
+    corr = []
+    offsets = []
+    values = dict((name, []) for name in names)
+    nflags = 0
+    for stream, ctype, start, length, scale, current in _records(vis, names):
+        if ctype == 'c':
+            data = np.frombuffer(stream, dtype='>c8', count=length//8,
+                                 offset=start).astype(np.complex64)
+        else:
+            dtype, size = TYPES[ctype]
+            pairs = np.frombuffer(stream, dtype=dtype, count=length//size,
+                                  offset=start).astype(np.float32)
+            if ctype == 'j':
+                pairs = pairs*scale
+            data = pairs[0::2] + 1j*pairs[1::2]
+        if corr and len(data) != len(corr[0]):
+            raise ValueError('%s: the number of channels changes' % vis)
+        corr.append(data.astype(np.complex64))
+        offsets.append(nflags)
+        nflags += len(data)
+        for name in names:
+            values[name].append(current[name])
+    if len(corr) == 0:
+        return np.zeros((0, 0), dtype=np.complex64), values, np.zeros(0, dtype=np.int64)
+    return np.array(corr), values, np.array(offsets, dtype=np.int64)
+
+
+def _flag_bits(offsets, nchan):
+    """Integer and bit of the flags item holding each channel flag."""
+    pos = offsets[:, None] + np.arange(nchan)[None, :] + FLAG_OFFSET
+    return pos//BITS_PER_INT, pos % BITS_PER_INT
+
+
+def read_flags(vis, offsets, nchan):
+    """Channel flags of correlation records.
+
+    Arguments:
+        vis {str} -- Dataset.
+        offsets {array} -- Position of the first flag of each record (see
+            read_uv).
+        nchan {int} -- Number of channels per record.
+
+    Returns:
+        flags {array} -- Boolean flags (True = bad), shape (nrecord, nchan).
+    """
+    filename = os.path.join(vis, 'flags')
+    if not os.path.exists(filename):
+        # No flags item: every correlation is good
+        return np.zeros((len(offsets), nchan), dtype=bool)
+    words = np.fromfile(filename, dtype='>i4')
+    idx, bit = _flag_bits(offsets, nchan)
+    # Flags past the end of the item are good
+    good = np.ones(idx.shape, dtype=bool)
+    inside = idx < len(words)
+    good[inside] = (words[idx[inside]] >> bit[inside]) & 1 == 1
+    return ~good
+
+
+def write_flags(vis, offsets, flags):
+    """Flag correlations in place. Flags are only ever added.
+
+    Arguments:
+        vis {str} -- Dataset.
+        offsets {array} -- Position of the first flag of each record (see
+            read_uv).
+        flags {array} -- Boolean flags (True = bad), shape (nrecord, nchan).
+
+    Returns:
+        nflag {int} -- Number of correlations newly flagged.
+    """
+    filename = os.path.join(vis, 'flags')
+    nchan = flags.shape[1]
+    idx, bit = _flag_bits(offsets, nchan)
+    nwords = int(idx.max()) + 1 if idx.size else 1
+    exists = os.path.exists(filename)
+    if exists:
+        words = np.fromfile(filename, dtype='>i4').astype(np.int32)
+    else:
+        words = np.array([np.frombuffer(INT_ITEM, dtype='>i4')[0]], dtype=np.int32)
+    nold = len(words)
+    if nold < nwords:
+        # Missing flags are good
+        words = np.concatenate([words, np.full(nwords - nold, 2**BITS_PER_INT - 1,
+                                               dtype=np.int32)])
+    before = words.copy()
+    clear = flags & ((words[idx] >> bit) & 1 == 1)
+    np.bitwise_and.at(words, idx[clear], ~(np.int32(1) << bit[clear].astype(np.int32)))
+    changed = np.nonzero(words != before)[0]
+    if exists and len(changed) == 0:
+        return 0
+    if exists and nold == len(words):
+        # Only rewrite the integers that changed
+        out = np.memmap(filename, dtype='>i4', mode='r+')
+        out[changed] = words[changed]
+        out.flush()
+        del out
+    else:
+        words.astype('>i4').tofile(filename)
+    return int(clear.sum())
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""Exact-overlap regridding with reusable weights.
+
+reproject_exact works out, for every input pixel, the solid angle it shares
+with each output pixel, and sets every output pixel to the overlap-weighted
+mean of the input pixels (NaN if any of them is NaN). The overlaps only
+depend on the input and output WCS, which every channel and Stokes of a
+band share. This module works them out once, as a sparse matrix W (output pixels x input pixels),
+and regrids a block of channels at once as
+
+    W @ data / W @ 1
+
+This gives reproject_exact's result to rounding.
+
+Weights are cached in memory and on disk (regrid.<key>.npz in the cache
+directory), keyed by the two celestial WCS and image shapes.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import scipy.sparse
+from astropy import units as u
+
+try:
+    from reproject.spherical_intersect._overlap_wrapper import compute_overlap
+except ImportError:
+    from reproject.spherical_intersect.overlap import compute_overlap
+
+from instrument import stage
+
+_memory = {}
+
+
+def weights_key(wcs_in, shape_in, wcs_out, shape_out):
+    """Cache key of the weights between two grids.
+
+    Arguments:
+        wcs_in {WCS} -- Celestial WCS of the input images.
+        shape_in {tuple} -- Shape (ny, nx) of the input images.
+        wcs_out {WCS} -- Celestial WCS of the output images.
+        shape_out {tuple} -- Shape (ny, nx) of the output images.
+
+    Returns:
+        key {str} -- Hex digest.
+    """
+    sha = hashlib.sha1()
+    for wcs, shape in ((wcs_in, shape_in), (wcs_out, shape_out)):
+        sha.update(wcs.to_header_string(relax=True).encode())
+        sha.update(repr(tuple(int(n) for n in shape)).encode())
+    return sha.hexdigest()
+
+
+def _corners(wcs, shape, frame=None):
+    """World positions of the pixel corners of a grid (deg), and the frame."""
+    ny, nx = shape
+    xp, yp = np.meshgrid(np.arange(nx + 1.0) - 0.5, np.arange(ny + 1.0) - 0.5)
+    world = wcs.pixel_to_world(xp, yp)
+    if frame is not None:
+        world = world.transform_to(frame)
+    sph = world.represent_as('unitspherical')
+    return world, sph.lon.to_value(u.rad), sph.lat.to_value(u.rad)
+
+
+def _quads(lon, lat, rows, cols):
+    """Corners (N, 4) of the pixels at rows, cols.
+
+    The overlap is only exact to ~1e-10 and depends on the order of the
+    corners; this is the order reproject_exact uses.
+    """
+    jj = np.stack([rows + 1, rows + 1, rows, rows], axis=-1)
+    ii = np.stack([cols, cols + 1, cols + 1, cols], axis=-1)
+    return lon[jj, ii], lat[jj, ii]
+
+
+def overlap_weights(wcs_in, shape_in, wcs_out, shape_out, rows=64):
+    """Overlap of every input pixel with every output pixel.
+
+    Arguments:
+        wcs_in {WCS} -- Celestial WCS of the input images.
+        shape_in {tuple} -- Shape (ny, nx) of the input images.
+        wcs_out {WCS} -- Celestial WCS of the output images.
+        shape_out {tuple} -- Shape (ny, nx) of the output images.
+
+    Keyword Arguments:
+        rows {int} -- Input rows handled at a time (default: {64})
+
+    Returns:
+        weights {csr_matrix} -- Overlap solid angles (sr), shape
+            (output pixels, input pixels), both flattened in C order.
+    """
+    ny_in, nx_in = shape_in
+    ny_out, nx_out = shape_out
+    world_out, olon, olat = _corners(wcs_out, shape_out)
+    world_in, ilon, ilat = _corners(wcs_in, shape_in, frame=world_out.frame)
+    # Input pixel corners on the output grid
+    xp_inout, yp_inout = wcs_out.world_to_pixel(world_in)
+
+    out_rows, in_cols, data = [], [], []
+    for start in range(0, ny_in, rows):
+        j, i = np.mgrid[start:min(start + rows, ny_in), 0:nx_in]
+        j = j.ravel()
+        i = i.ravel()
+        # Output pixels under the bounding box of each input pixel
+        xc, yc = _quads(xp_inout, yp_inout, j, i)
+        with np.errstate(invalid='ignore'):
+            good = np.all(np.isfinite(xc) & np.isfinite(yc), axis=1)
+        j, i, xc, yc = j[good], i[good], xc[good], yc[good]
+        x0 = np.clip(np.floor(xc.min(axis=1) + 0.5), 0, nx_out).astype(int)
+        x1 = np.clip(np.floor(xc.max(axis=1) + 0.5), -1, nx_out - 1).astype(int)
+        y0 = np.clip(np.floor(yc.min(axis=1) + 0.5), 0, ny_out).astype(int)
+        y1 = np.clip(np.floor(yc.max(axis=1) + 0.5), -1, ny_out - 1).astype(int)
+        nx = np.maximum(x1 - x0 + 1, 0)
+        ny = np.maximum(y1 - y0 + 1, 0)
+        count = nx*ny
+        if count.sum() == 0:
+            continue
+        # One entry per (input pixel, candidate output pixel)
+        pix = np.repeat(np.arange(len(j)), count)
+        local = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        oi = x0[pix] + local % nx[pix]
+        oj = y0[pix] + local//nx[pix]
+        qlon, qlat = _quads(ilon, ilat, j[pix], i[pix])
+        plon, plat = _quads(olon, olat, oj, oi)
+        overlap = compute_overlap(qlon, qlat, plon, plat)[0]
+        # Pixels that only touch have zero overlap, but reproject_exact
+        # still adds them in, which spreads NaNs to them: keep the zeros
+        keep = np.isfinite(overlap)
+        out_rows.append(oj[keep]*nx_out + oi[keep])
+        in_cols.append(j[pix][keep]*nx_in + i[pix][keep])
+        data.append(overlap[keep])
+
+    if data:
+        out_rows = np.concatenate(out_rows)
+        in_cols = np.concatenate(in_cols)
+        data = np.concatenate(data)
+    # Explicit zeros are kept by the conversion
+    return scipy.sparse.csr_matrix((data, (out_rows, in_cols)),
+                                   shape=(ny_out*nx_out, ny_in*nx_in))
+
+
+def get_weights(wcs_in, shape_in, wcs_out, shape_out, cachedir=None):
+    """Overlap weights between two grids, cached.
+
+    Arguments:
+        wcs_in {WCS} -- Celestial WCS of the input images.
+        shape_in {tuple} -- Shape (ny, nx) of the input images.
+        wcs_out {WCS} -- Celestial WCS of the output images.
+        shape_out {tuple} -- Shape (ny, nx) of the output images.
+
+    Keyword Arguments:
+        cachedir {str} -- Directory of the weights files; only kept in
+            memory if None (default: {None})
+
+    Returns:
+        weights {csr_matrix} -- See overlap_weights.
+    """
+    key = weights_key(wcs_in, shape_in, wcs_out, shape_out)
+    if key in _memory:
+        return _memory[key]
+    filename = None
+    weights = None
+    if cachedir is not None:
+        filename = os.path.join(cachedir, 'regrid.%s.npz' % key)
+        if os.path.exists(filename):
+            try:
+                weights = scipy.sparse.load_npz(filename).tocsr()
+            except (IOError, OSError, ValueError):
+                weights = None
+    if weights is None:
+        with stage('regridweights'):
+            weights = overlap_weights(wcs_in, shape_in, wcs_out, shape_out)
+        if filename is not None:
+            tmpname = '%s.%d.tmp.npz' % (filename[:-4], os.getpid())
+            try:
+                scipy.sparse.save_npz(tmpname, weights)
+                os.replace(tmpname, filename)
+            except (IOError, OSError):
+                # Read-only directory: just keep the weights in memory
+                pass
+    _memory[key] = weights
+    return weights
+
+
+def apply_weights(weights, cube, shape_out):
+    """Regrid a block of channels with overlap weights.
+
+    Arguments:
+        weights {csr_matrix} -- See overlap_weights.
+        cube {array} -- Channels, shape (nchan, ny_in, nx_in).
+        shape_out {tuple} -- Shape (ny, nx) of the output images.
+
+    Returns:
+        newcube {array} -- Regridded channels, shape (nchan, ny, nx), NaN
+            where an input NaN or no input pixel overlaps.
+    """
+    nchan = len(cube)
+    data = np.asarray(cube, dtype=np.float64).reshape(nchan, -1).T
+    total = np.asarray(weights.sum(axis=1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        newcube = (weights @ data)/total
+    return newcube.T.reshape((nchan,) + tuple(shape_out))
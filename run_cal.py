@@ -4,7 +4,6 @@ import argparse
 import configparser
 import glob
 import os
-from subprocess import call
 from numpy import unique
 from astropy.io import fits
 from astropy.wcs import WCS
@@ -13,43 +12,185 @@ from astropy.coordinates import SkyCoord, search_around_sky
 import astropy.units as u
 import numpy as np
 import shutil
+from functools import partial
+from scheduler import get_workers, process_pool, run_jobs, merge_logs
+from taskgraph import TaskGraph
+from stepcache import StepCache
+from badchans import flag_badchans
+from checkpoint import Checkpoint
+from logmux import LogMux
+from sumthreshold import flag_miriad
+import instrument
+from instrument import call, stage
 
 
 def logprint(s2p, lf):
     print(s2p, file=lf)
     print(s2p)
 
+# Persistent cache of the in-place calibration steps, set up in main()
+STEPCACHE = None
+
+# Log multiplexer for the MIRIAD output, set up in main() if tagged_logs is on
+MUX = None
+
+# Run a MIRIAD task working on dataset vis (<source>.<band>). With the log
+# multiplexer its output is tagged and also goes to the dataset's own log.
+
+
+def run_task(args, vis, logf):
+    if MUX is not None:
+        return MUX.call(args, logf, source=vis, band=vis[-4:])
+    return call(args, stdout=logf, stderr=logf, source=vis, band=vis[-4:])
+
+# Run a MIRIAD task that modifies vis in place. With the step cache enabled the
+# task is skipped if it was already applied to the unchanged dataset.
+
+
+def run_step(args, vis, logf, deps=()):
+    if STEPCACHE is not None:
+        return STEPCACHE.call(args, vis, logf, deps=deps,
+                              runner=lambda args, logf: run_task(args, vis, logf))
+    return run_task(args, vis, logf)
+
+# Checkpoint manifest of the completed stages, set up in main()
+CHECKPOINT = None
+
+# Record a completed stage in the checkpoint manifest.
+
+
+def checkpoint(scope, stage, ok=True):
+    if CHECKPOINT is not None and ok:
+        CHECKPOINT.mark(scope, stage)
+
+# Check whether a stage can be skipped because --resume was given and the
+# manifest records it as completed (and no earlier stage it depends on had to
+# rerun). Otherwise the stage is cleared from the manifest, so that it's only
+# recorded again once it completes.
+
+
+def resumed(scope, stage, logf, rerun=False):
+    if CHECKPOINT is None:
+        return False
+    if not rerun and CHECKPOINT.done(scope, stage):
+        logprint('Resuming: %s already %s' % (scope, stage), logf)
+        return True
+    CHECKPOINT.clear(scope, stage)
+    return False
+
 # Pgflagging lines, following the ATCA users guide. Pgflagging needs to be done on all the calibrators and targets.
 
 
 def flag(src, logf):
-    call(['pgflag', 'vis=%s' % src, 'stokes=i,q,u,v', 'flagpar=8,5,5,3,6,3',
-          'command=<b', 'options=nodisp'], stdout=logf, stderr=logf)
-    call(['pgflag', 'vis=%s' % src, 'stokes=i,v,u,q', 'flagpar=8,2,2,3,6,3',
-          'command=<b', 'options=nodisp'], stdout=logf, stderr=logf)
-    call(['pgflag', 'vis=%s' % src, 'stokes=i,v,q,u', 'flagpar=8,2,2,3,6,3',
-          'command=<b', 'options=nodisp'], stdout=logf, stderr=logf)
+    ret = run_step(['pgflag', 'vis=%s' % src, 'stokes=i,q,u,v', 'flagpar=8,5,5,3,6,3',
+                    'command=<b', 'options=nodisp'], src, logf)
+    ret = run_step(['pgflag', 'vis=%s' % src, 'stokes=i,v,u,q', 'flagpar=8,2,2,3,6,3',
+                    'command=<b', 'options=nodisp'], src, logf) or ret
+    ret = run_step(['pgflag', 'vis=%s' % src, 'stokes=i,v,q,u', 'flagpar=8,2,2,3,6,3',
+                    'command=<b', 'options=nodisp'], src, logf) or ret
+    return ret
 
 # pgflagging, stokes V only.
 
 
 def flag_v(src, logf):
-    call(['pgflag', 'vis=%s' % src, 'stokes=i,q,u,v', 'flagpar=8,5,5,3,6,3',
-          'command=<b', 'options=nodisp'], stdout=logf, stderr=logf)
+    return run_step(['pgflag', 'vis=%s' % src, 'stokes=i,q,u,v', 'flagpar=8,5,5,3,6,3',
+                    'command=<b', 'options=nodisp'], src, logf)
 
 
-# change nfbin to 2
-NFBIN = 2
+# Passes of the native SumThreshold flagger, equivalent to the three pgflag
+# calls of flag(). pgflag flags on the last Stokes parameter listed.
+NATIVE_PASSES = [('v', (8, 5, 5, 3, 6, 3)),
+                 ('u', (8, 2, 2, 3, 6, 3)),
+                 ('q', (8, 2, 2, 3, 6, 3))]
+
+# Native flagging: the visibilities are read once, all the passes
+# (rounds x NATIVE_PASSES) are applied in memory, and the new flags are
+# written to the flags item of the dataset in place, one bit per correlation.
+# Every other item (uv variables, calibration tables, history) is left as
+# it is. The flagging is CPU-bound NumPy work, so with a process pool it runs
+# there rather than in the task graph thread, which would hold the GIL.
+
+
+def flag_native(src, logf, rounds=1, pool=None):
+    passes = NATIVE_PASSES*rounds
+
+    def runner(args, logf):
+        if pool is None:
+            nflag = flag_miriad_job(src, passes)
+        else:
+            nflag = pool.submit(flag_miriad_job, src, passes,
+                                instrument.RECORDER.filename).result()
+        logprint('SumThreshold flagged %d correlations in %s' %
+                 (nflag, src), logf)
+        return 0
+
+    args = ['sumthreshold', 'vis=%s' % src] + \
+        ['%s:%s' % (stokes, ','.join(str(p) for p in flagpar))
+         for stokes, flagpar in passes]
+    if STEPCACHE is not None:
+        return STEPCACHE.call(args, src, logf, runner=runner)
+    return runner(args, logf)
+
 
-# Get the noise of an image
+# Native flagging of one dataset, in the calling process or a worker of the
+# flagging pool (which records the stage in the run's timing file).
 
 
-def get_noise(img_name):
-    hdu = fits.open(img_name)
-    data = hdu[0].data[0, 0]
-    rms = np.std(data)
-    hdu.close()
-    return rms
+def flag_miriad_job(src, passes, timefile=None):
+    if timefile is not None:
+        instrument.RECORDER.filename = timefile
+    with stage('sumthreshold', source=src, band=src[-4:]):
+        return flag_miriad(src, passes)
+
+
+# change nfbin to 2
+NFBIN = 2
+
+# Datasets made by uvsplit (source.frequency)
+SPLIT_GLOB = '[j012]*.[257]???'
+
+# Apply the secondary gains to a compact target, flag it and average it.
+# Each target is an independent branch of the task graph once the secondary's
+# gain table exists, and writes to its own working log. The native flagger
+# runs in pool if given. Returns the log name and the tasks added.
+
+
+def add_target_tasks(graph, t, seccalname, flagger='pgflag', pool=None):
+    wlogname = '%s.work.log' % t
+    slogname = '%s.log.txt' % t
+
+    def fstats(logf):
+        logprint('Writing source flag and pol info to %s' % slogname, logf)
+        slogf = open(slogname, 'w', 1)
+        call(['uvfstats', 'vis=%s' % t], stdout=slogf, stderr=slogf)
+        call(['uvfstats', 'vis=%s' % t, 'mode=channel'],
+             stdout=slogf, stderr=slogf)
+        slogf.close()
+
+    # Move on to the target!
+    tasks = []
+    tasks.append(graph.add('%s.gpcopy' % t,
+                           func=partial(run_task, ['gpcopy', 'vis=%s' % seccalname, 'out=%s' % t], t),
+                           inputs=[seccalname], updates=[t], log=wlogname))
+    if flagger == 'native':
+        # Both flagging rounds in a single read of the data
+        tasks.append(graph.add('%s.flag' % t, func=partial(flag_native, t, rounds=2, pool=pool),
+                               updates=[t], log=wlogname))
+    else:
+        tasks.append(graph.add('%s.flag1' % t, func=partial(flag, t),
+                               updates=[t], log=wlogname))
+        tasks.append(graph.add('%s.flag2' % t, func=partial(flag, t),
+                               updates=[t], log=wlogname))
+    tasks.append(graph.add('%s.uvfstats' % t, func=fstats, inputs=[t],
+                           outputs=[slogname], log=wlogname))
+
+    # Apply the solutions before we do selfcal
+    t_pscal = t + '.pscal'
+    tasks.append(graph.add('%s.uvaver' % t,
+                           func=partial(run_task, ['uvaver', 'vis=%s' % t, 'out=%s' % t_pscal], t),
+                           inputs=[t], outputs=[t_pscal], log=wlogname))
+    return wlogname, tasks
 
 # Using the SUMSS catalogue to generate regions for selfcal. This part is obsolete.
 # def gen_regions(img_name):
@@ -102,174 +243,107 @@ def get_noise(img_name):
 # 	np.savetxt(img_name+'.region', boxes_lines, fmt='%s')
 
 
-def main(args, cfg):
-    # Initiate log file with options used
-    logf = open(args.log_file, 'w', 1)  # line buffered
-    logprint('Input settings:', logf)
-    logprint(args, logf)
-    logprint(cfg.items('input'), logf)
-    logprint(cfg.items('output'), logf)
-    logprint(cfg.items('observation'), logf)
-    logprint('', logf)
+# State of the run the band workers need: the checkpoint manifest, whether
+# the step cache and the log multiplexer are on, and the timing file. It is
+# passed to the workers explicitly, so they don't depend on inheriting the
+# module globals of main() through fork.
 
-    gwcp = cfg.get('input', 'dir')+'/'+cfg.get('input', 'date')+'*'
-    atfiles = sorted(glob.glob(gwcp))
-    if_use = cfg.getint('input', 'if_use')
-    outdir = cfg.get('output', 'dir')
-    rawclobber = cfg.getboolean('output', 'rawclobber')
-    outclobber = cfg.getboolean('output', 'clobber')
-    skipcal = cfg.getboolean('output', 'skipcal')
-    prical = cfg.get('observation', 'primary')
-    seccal = cfg.get('observation', 'secondary')
-    polcal = cfg.get('observation', 'polcal')
-    seccal_ext = cfg.get('observation', 'sec_ext')
-    target_ext = cfg.get('observation', 'ext')
 
-    if not os.path.exists(outdir):
-        logprint('Creating directory %s' % outdir, logf)
-        os.makedirs(outdir)
-    for line in open(args.setup_file):
-        if line[0] == '#':
-            continue
-        sline = line.split()
-        for a in atfiles:
-            if sline[0] in a:
-                logprint('Ignoring setup file %s' % sline[0], logf)
-                atfiles.remove(a)
-    uvlist = ','.join(atfiles)
+def run_state():
+    return {'pid': os.getpid(), 'checkpoint': CHECKPOINT,
+            'stepcache': STEPCACHE is not None, 'tagged_logs': MUX is not None,
+            'timefile': instrument.RECORDER.filename}
 
-    if not os.path.exists(outdir+'/dat.uv') or rawclobber:
-        logprint('Running ATLOD...', logf)
-        if if_use > 0:
-            call(['atlod', 'in=%s' % uvlist, 'out=%s/dat.uv' % outdir, 'ifsel=%s' % if_use,
-                  'options=birdie,noauto,xycorr,rfiflag,notsys'], stdout=logf, stderr=logf)
-        else:
-            call(['atlod', 'in=%s' % uvlist, 'out=%s/dat.uv' % outdir,
-                  'options=birdie,noauto,xycorr,rfiflag'], stdout=logf, stderr=logf)
-    else:
-        logprint('Skipping atlod step', logf)
-    os.chdir(outdir)
-    logprint('Running UVSPLIT...', logf)
-    if outclobber:
-        logprint('Output files will be clobbered if necessary', logf)
-        call(['uvsplit', 'vis=dat.uv', 'options=mosaic,clobber'],
-             stdout=logf, stderr=logf)
-    else:
-        call(['uvsplit', 'vis=dat.uv', 'options=mosaic'],
-             stdout=logf, stderr=logf)
-    slist = sorted(glob.glob('[j012]*.[257]???'))
-    logprint('Working on %d sources' % len(slist), logf)
-    bandfreq = unique([x[-4:] for x in slist])
-    logprint('Frequency bands to process: %s' % (','.join(bandfreq)), logf)
+# Set up the globals of a band worker from run_state() of main(). Nothing
+# changes in the process that made the state.
 
-    src_to_plot = []
 
-    for frqb in bandfreq:
-        logprint(
-            '\n\n##########\nWorking on frequency: %s\n##########\n\n' % (frqb), logf)
-        pricalname = '__NOT_FOUND__'
-        ext_seccalname = '__NOT_FOUND__'
-        seccalnames = []
-        polcalnames = []
-        targetnames = []
-        ext_targetnames = []
-        for i, source in enumerate(slist):
-            frqid = source[-4:]
-            if frqid not in frqb:
-                continue
-            if prical in source:
-                pricalname = source
-            elif any([sc in source for sc in seccal.split(',')]):
-                seccalnames.append(source)
-            elif seccal_ext in source:
-                ext_seccalname = source
-            elif any([pc in source for pc in polcal.split(',')]):
-                polcalnames.append(source)
-            elif any([es in source for es in target_ext.split(',')]):
-                ext_targetnames.append(source)
-            else:
-                targetnames.append(source)
-                src_to_plot.append(source[:-5])
-        if pricalname == '__NOT_FOUND__':
-            logprint('Error: primary cal (%s) not found' % prical, logf)
-            logf.close()
-            exit(1)
-        if len(seccalnames) == 0:
-            logprint('Error: secondary cal (%s) not found' % seccal, logf)
-            logf.close()
-            exit(1)
-        if ext_seccalname == '__NOT_FOUND__' and seccal_ext != 'NONE':
-            logprint('Error: extended-source secondary cal (%s) not found' %
-                     seccal_ext, logf)
-            logf.close()
-            exit(1)
-        elif seccal_ext == 'NONE':
-            ext_seccalname = '(NONE)'
-        logprint('Identified primary cal: %s' % pricalname, logf)
-        logprint('Identified %d secondary cals' % len(seccalnames), logf)
-        logprint('Identified %d polarization calibrators' %
-                 len(polcalnames), logf)
-        logprint('Identified %d compact targets to calibrate' %
-                 len(targetnames), logf)
-        logprint('Identified secondary cal for extended sources: %s' %
-                 ext_seccalname, logf)
-        logprint('Identified %d extended targets to calibrate' %
-                 len(ext_targetnames), logf)
-        if skipcal:
-            logprint(
-                'Skipping flagging and calibration steps on user request.', logf)
+def setup_worker(state):
+    global STEPCACHE, CHECKPOINT, MUX
+    if state is None or state['pid'] == os.getpid():
+        return
+    CHECKPOINT = state['checkpoint']
+    STEPCACHE = StepCache() if state['stepcache'] else None
+    MUX = LogMux() if state['tagged_logs'] else None
+    instrument.RECORDER.filename = state['timefile']
+
+# Flag and calibrate one frequency band: bad channels, primary, secondaries and
+# the compact targets. Each band works on its own source.<band> datasets, so
+# bands can run in separate worker processes, set up from state; the output
+# goes to a band log that main() merges into the main log.
+
+
+def calibrate_band(frqb, slist, prical, pricalname, seccalnames, targetnames, workers,
+                   flagger='pgflag', state=None):
+    setup_worker(state)
+    blogname = 'band.%s.log' % frqb
+    logf = open(blogname, 'w', 1)
+    logprint('Initial flagging round proceeding...', logf)
+    bandsrc = []
+    for i, source in enumerate(slist):
+        # only flag data corresponding to the data that we're dealing with (resolves issue #4)
+        if frqb not in source:
             continue
-        logprint('Initial flagging round proceeding...', logf)
-        for i, source in enumerate(slist):
-            # only flag data corresponding to the data that we're dealing with (resolves issue #4)
-            if frqb not in source:
-                continue
-            logprint('\nFLAGGING: %d / %d = %s' %
-                     (i+1, len(slist), source), logf)
-            ####
-            # This part may be largely obsolete with options=rfiflag in ATLOD.
-            # However, options=rfiflag doesn't cover all the badchans, so we'll still do this. -XZ
-            for line in open('../badchans_%s.txt' % frqid):
-                sline = line.split()
-                lc, uc = sline[0].split('-')
-                dc = int(uc)-int(lc)+1
-                call(['uvflag', 'vis=%s' % source, 'line=chan,%d,%s' %
-                      (dc, lc), 'flagval=flag'], stdout=logf, stderr=logf)
-            ####
-            # call(['pgflag','vis=%s'%source,'stokes=xx,yy,yx,xy','flagpar=20,10,10,3,5,3,20','command=<be','options=nodisp'])
+        logprint('\nFLAGGING: %d / %d = %s' %
+                 (i+1, len(slist), source), logf)
+        bandsrc.append(source)
+    ####
+    # This part may be largely obsolete with options=rfiflag in ATLOD.
+    # However, options=rfiflag doesn't cover all the badchans, so we'll still do this. -XZ
+    # Each channel range is flagged on all the band's sources in one go.
+    # On --resume, completed stages are skipped up to the first one that has to
+    # run again, since every later stage depends on its output.
+    rerun = False
+    if not resumed(frqb, 'flagged', logf):
+        rerun = True
+        ret, counts = flag_badchans(bandsrc, frqb, logf, cache=STEPCACHE)
+        for (lc, uc), nflag in sorted(counts.items()):
+            if nflag is None:
+                logprint('Bad channels %d-%d: flagged' % (lc, uc), logf)
+            else:
+                logprint('Bad channels %d-%d: flagged %d correlations' %
+                         (lc, uc, nflag), logf)
+        if ret:
+            logprint('Error: flagging the bad channels failed', logf)
+        checkpoint(frqb, 'flagged', not ret)
+    ####
+    # call(['pgflag','vis=%s'%source,'stokes=xx,yy,yx,xy','flagpar=20,10,10,3,5,3,20','command=<be','options=nodisp'])
 # 			call(['uvflag','vis=%s'%source,'select=amplitude(2),polarization(xy,yx)','flagval=flag'],stdout=logf,stderr=logf)
 # 			call(['uvpflag','vis=%s'%source,'polt=xy,yx','pols=xx,xy,yx,yy','options=or'],stdout=logf,stderr=logf)
 # 			call(['pgflag','vis=%s'%source,'stokes=v','flagpar=7,4,12,3,5,3,20','command=<be','options=nodisp'],stdout=logf,stderr=logf)
 
-            # First round of pgflag for all sources. Maybe not for now?
+    # First round of pgflag for all sources. Maybe not for now?
 # 			flag(source, logf)
 
+    if not resumed(frqb, 'primary-calibrated', logf, rerun):
+        rerun = True
         # Flagging/calibrating the primary calibrator 1934-638.
         logprint('Calibration of primary cal (%s) proceeding ...' %
                  prical, logf)
         # Only select data above elevation=40.
-        call(['uvflag', 'vis=%s' % pricalname, 'select=-elevation(40,90)',
-              'flagval=flag'], stdout=logf, stderr=logf)
-        flag_v(pricalname, logf)
+        ret = run_step(['uvflag', 'vis=%s' % pricalname, 'select=-elevation(40,90)',
+                        'flagval=flag'], pricalname, logf)
+        ret = flag_v(pricalname, logf) or ret
         # XZ: this part is modified to fix the "no 1934" issue on 2019-06-23. Comment the following three lines if used otherwise.
         if pricalname == '2052-474.2100':
-            call(['mfcal', 'vis=%s' % pricalname, 'flux=1.6025794,2.211,-0.3699236',
-                  'interval=0.1,1,30'], stdout=logf, stderr=logf)
+            ret = run_step(['mfcal', 'vis=%s' % pricalname, 'flux=1.6025794,2.211,-0.3699236',
+                            'interval=0.1,1,30'], pricalname, logf) or ret
         else:
-            call(['mfcal', 'vis=%s' % pricalname, 'interval=0.1,1,30'],
-                 stdout=logf, stderr=logf)
-        flag(pricalname, logf)
-        call(['gpcal', 'vis=%s' % pricalname, 'interval=0.1', 'nfbin=%d' %
-              NFBIN, 'options=xyvary'], stdout=logf, stderr=logf)
-        flag(pricalname, logf)
+            ret = run_step(['mfcal', 'vis=%s' % pricalname, 'interval=0.1,1,30'],
+                           pricalname, logf) or ret
+        ret = flag(pricalname, logf) or ret
+        ret = run_step(['gpcal', 'vis=%s' % pricalname, 'interval=0.1', 'nfbin=%d' %
+                        NFBIN, 'options=xyvary'], pricalname, logf) or ret
+        ret = flag(pricalname, logf) or ret
         if pricalname == '2052-474.2100':
-            call(['mfboot', 'vis=%s' % pricalname,
-                  'flux=1.6025794,2.211,-0.3699236'], stdout=logf, stderr=logf)
+            ret = run_step(['mfboot', 'vis=%s' % pricalname,
+                            'flux=1.6025794,2.211,-0.3699236'], pricalname, logf) or ret
+        checkpoint(frqb, 'primary-calibrated', not ret)
 
 # 		pricalname_c1 = pricalname + '_c1'
 # 		call(['uvaver', 'vis=%s'%pricalname, 'out=%s'%pricalname_c1],stdout=logf,stderr=logf)
 
-        # Second round of flagging/calibrating
+    # Second round of flagging/calibrating
 
 # 		flag(pricalname, logf)
 # 		call(['mfcal','vis=%s'%pricalname_c1,'interval=0.1,1,30'],stdout=logf,stderr=logf)
@@ -283,25 +357,29 @@ def main(args, cfg):
 # 		call(['pgflag','vis=%s'%pricalname,'stokes=v','flagpar=7,4,12,3,5,3,20','command=<be','options=nodisp'],stdout=logf,stderr=logf)
 # 		call([ 'gpcal', 'vis=%s'%pricalname, 'interval=0.1', 'nfbin=16', 'options=xyvary','select=elevation(40,90)'],stdout=logf,stderr=logf)
 
+    # The merged gains end up in the first secondary
+    if not resumed(frqb, 'secondary-calibrated', logf, rerun):
+        rerun = True
+        ret = 0
         # Move on to the secondary calibrator
         for seccalname in seccalnames:
             logprint('Transferring to compact-source secondary %s...' %
                      seccalname, logf)
-            call(['gpcopy', 'vis=%s' % pricalname, 'out=%s' %
-                  seccalname], stdout=logf, stderr=logf)
+            ret = run_step(['gpcopy', 'vis=%s' % pricalname, 'out=%s' %
+                            seccalname], seccalname, logf, deps=[pricalname]) or ret
 # 			call(['puthd','in=%s/interval'%seccalname,'value=100000'],stdout=logf,stderr=logf)
             # flag twice, gpcal twice
-            flag(seccalname, logf)
-            call(['gpcal', 'vis=%s' % seccalname, 'interval=0.1', 'nfbin=%d' %
-                  NFBIN, 'options=xyvary,qusolve'], stdout=logf, stderr=logf)
-            flag(seccalname, logf)
+            ret = flag(seccalname, logf) or ret
+            ret = run_step(['gpcal', 'vis=%s' % seccalname, 'interval=0.1', 'nfbin=%d' %
+                            NFBIN, 'options=xyvary,qusolve'], seccalname, logf) or ret
+            ret = flag(seccalname, logf) or ret
 # 			call(['gpedit','vis=%s'%seccalname,'options=phase'],stdout=logf,stderr=logf)
 # 			flag(seccalname, logf)
 # 			call(['gpcal','vis=%s'%seccalname,'interval=0.1','nfbin=%d'%NFBIN,'options=xyvary,qusolve'],stdout=logf,stderr=logf)
 # 			call(['gpedit','vis=%s'%seccalname,'options=phase'],stdout=logf,stderr=logf)
             # boot the flux
-            call(['gpboot', 'vis=%s' % seccalname, 'cal=%s' %
-                  pricalname], stdout=logf, stderr=logf)
+            ret = run_step(['gpboot', 'vis=%s' % seccalname, 'cal=%s' %
+                            pricalname], seccalname, logf, deps=[pricalname]) or ret
 
 # 			call(['puthd','in=%s/interval'%seccalname,'value=100000'],stdout=logf,stderr=logf)
 # 			call(['pgflag','vis=%s'%seccalname,'stokes=v','flagpar=7,4,12,3,5,3,20','command=<be','options=nodisp'],stdout=logf,stderr=logf)
@@ -324,12 +402,14 @@ def main(args, cfg):
         while len(seccalnames) > 1:
             logprint('Merging gain table for %s into %s ...' %
                      (seccalnames[-1], seccalnames[0]), logf)
-            call(['gpcopy', 'vis=%s' % seccalnames[-1], 'out=%s' %
-                  seccalnames[0], 'mode=merge'], stdout=logf, stderr=logf)
+            ret = run_step(['gpcopy', 'vis=%s' % seccalnames[-1], 'out=%s' %
+                            seccalnames[0], 'mode=merge'], seccalnames[0], logf,
+                           deps=[seccalnames[-1]]) or ret
             del seccalnames[-1]
-        seccalname = seccalnames[0]
-        logprint('Using gains from %s ...' % (seccalname), logf)
-        # For now, we don't worry about extended sources
+        checkpoint(frqb, 'secondary-calibrated', not ret)
+    seccalname = seccalnames[0]
+    logprint('Using gains from %s ...' % (seccalname), logf)
+    # For now, we don't worry about extended sources
 # 		if seccal_ext != 'NONE':
 # 			logprint('Transferring to extended-source secondary...',logf)
 # 			call(['gpcopy','vis=%s'%pricalname,'out=%s'%ext_seccalname],stdout=logf,stderr=logf)
@@ -344,30 +424,29 @@ def main(args, cfg):
 # 				logprint('Working on source %s'%t,logf)
 # 				call(['gpcopy','vis=%s'%ext_seccalname,'out=%s'%t],stdout=logf,stderr=logf)
 # 				call(['pgflag','vis=%s'%t,'stokes=v','flagpar=7,4,12,3,5,3,20','command=<be','options=nodisp'],stdout=logf,stderr=logf)
-        logprint(
-            '\n\n##########\nApplying calibration to compact sources...\n##########\n\n', logf)
-        for t in targetnames:
-            logprint('Working on source %s' % t, logf)
-            slogname = '%s.log.txt' % t
-            slogf = open(slogname, 'w', 1)
-
-            # Move on to the target!
-            call(['gpcopy', 'vis=%s' % seccalname, 'out=%s' %
-                  t], stdout=logf, stderr=logf)
-            flag(t, logf)
-            flag(t, logf)
-# 			call(['pgflag','vis=%s'%t,'stokes=v','flagpar=7,4,12,3,5,3,20','command=<be','options=nodisp'],stdout=logf,stderr=logf)
-
-            logprint('Writing source flag and pol info to %s' % slogname, logf)
-            call(['uvfstats', 'vis=%s' % t], stdout=slogf, stderr=slogf)
-            call(['uvfstats', 'vis=%s' % t, 'mode=channel'],
-                 stdout=slogf, stderr=slogf)
-            slogf.close()
-
-            # Apply the solutions before we do selfcal
-            t_pscal = t + '.pscal'
-            call(['uvaver', 'vis=%s' % t, 'out=%s' %
-                  t_pscal], stdout=logf, stderr=logf)
+    logprint(
+        '\n\n##########\nApplying calibration to compact sources...\n##########\n\n', logf)
+    targets = TaskGraph(workers=workers, logf=logf)
+    pool = process_pool(workers) if flagger == 'native' else None
+    worklogs = []
+    applied = {}
+    for t in targetnames:
+        if resumed(t, 'target-applied', logf, rerun):
+            continue
+        logprint('Working on source %s' % t, logf)
+        wlogname, tasks = add_target_tasks(targets, t, seccalname, flagger, pool)
+        worklogs.append(wlogname)
+        applied[t] = tasks
+        # The RMSF has to be plotted again from the new data
+        if CHECKPOINT is not None:
+            CHECKPOINT.clear(t[:-5], 'rmsf-plotted')
+    targets.run()
+    if pool is not None:
+        pool.shutdown()
+    merge_logs(worklogs, logf)
+    for t, tasks in applied.items():
+        checkpoint(t, 'target-applied',
+                   all(task.status in ('ran', 'skipped') for task in tasks))
 
 # 			# Phase selfcal. Generate model first.
 # 			t_map = t + '.map'
@@ -465,7 +544,7 @@ def main(args, cfg):
 # 			os.remove(t_dirty)
 # 			os.remove(region_name)
 
-            # Looks like one round of amp selfcal is sufficient
+    # Looks like one round of amp selfcal is sufficient
 # 			#second round of amp selfcal
 # 			t_p2a2 = t + '_p2a2.fits'
 # 			call(['selfcal', 'vis=%s'%t_ascal, 'model=%s'%t_model, 'clip=0.005', 'interval=0.5', 'nfbin=4', 'options=amp,mfs'], stdout=logf,stderr=logf)
@@ -477,8 +556,190 @@ def main(args, cfg):
 # 			call(['fits', 'op=xyout', 'in=%s'%t_restor, 'out=%s'%t_p2a2], stdout=logf,stderr=logf)
 # 			call(['rm', '%s'%t_map, '%s'%t_beam, '%s'%t_restor], stdout=logf,stderr=logf)
 # 			call(['rm', '%s'%t_model], stdout=logf,stderr=logf)
+    if MUX is not None:
+        logprint('\nWall time per step for band %s:' % frqb, logf)
+        MUX.summary(logf, band=frqb)
+        MUX.close()
+    logf.close()
+    return blogname
+
+
+def main(args, cfg):
+    global STEPCACHE, CHECKPOINT, MUX
+    # Initiate log file with options used
+    logf = open(args.log_file, 'a' if args.resume else 'w', 1)  # line buffered
+    logprint('Input settings:', logf)
+    logprint(args, logf)
+    logprint(cfg.items('input'), logf)
+    logprint(cfg.items('output'), logf)
+    logprint(cfg.items('observation'), logf)
+    if cfg.has_section('execution'):
+        logprint(cfg.items('execution'), logf)
+    logprint('', logf)
+
+    gwcp = cfg.get('input', 'dir')+'/'+cfg.get('input', 'date')+'*'
+    atfiles = sorted(glob.glob(gwcp))
+    if_use = cfg.getint('input', 'if_use')
+    outdir = cfg.get('output', 'dir')
+    rawclobber = cfg.getboolean('output', 'rawclobber')
+    outclobber = cfg.getboolean('output', 'clobber')
+    skipcal = cfg.getboolean('output', 'skipcal')
+    prical = cfg.get('observation', 'primary')
+    seccal = cfg.get('observation', 'secondary')
+    polcal = cfg.get('observation', 'polcal')
+    seccal_ext = cfg.get('observation', 'sec_ext')
+    target_ext = cfg.get('observation', 'ext')
+    workers = get_workers(cfg.getint('execution', 'workers', fallback=1))
+    use_stepcache = cfg.getboolean('execution', 'stepcache', fallback=False)
+    parallel_bands = cfg.getboolean(
+        'execution', 'parallel_bands', fallback=False)
+    flagger = cfg.get('execution', 'flagger', fallback='pgflag')
+    tagged_logs = cfg.getboolean('execution', 'tagged_logs', fallback=False)
+
+    if not os.path.exists(outdir):
+        logprint('Creating directory %s' % outdir, logf)
+        os.makedirs(outdir)
+    # The manifest of completed stages lives with the data
+    CHECKPOINT = Checkpoint(os.path.join(outdir, 'checkpoint.json'),
+                            resume=args.resume)
+    logprint('Recording step timings in %s' %
+             instrument.start('run_cal', outdir), logf)
+    if args.resume:
+        logprint('Resuming from the last completed stages', logf)
+    for line in open(args.setup_file):
+        if line[0] == '#':
+            continue
+        sline = line.split()
+        for a in atfiles:
+            if sline[0] in a:
+                logprint('Ignoring setup file %s' % sline[0], logf)
+                atfiles.remove(a)
+    uvlist = ','.join(atfiles)
+
+    # Loading and splitting are skipped on a re-run if their products are up to date
+    load = TaskGraph(stampdir=outdir+'/.taskgraph', logf=logf)
+    if if_use > 0:
+        atlod_args = ['atlod', 'in=%s' % uvlist, 'out=%s/dat.uv' % outdir, 'ifsel=%s' % if_use,
+                      'options=birdie,noauto,xycorr,rfiflag,notsys']
+    else:
+        atlod_args = ['atlod', 'in=%s' % uvlist, 'out=%s/dat.uv' % outdir,
+                      'options=birdie,noauto,xycorr,rfiflag']
+    if not resumed('night', 'loaded', logf):
+        # Everything downstream depends on the loaded data
+        CHECKPOINT.resume = False
+        logprint('Running ATLOD...', logf)
+        load.add('atlod', args=atlod_args, inputs=atfiles, outputs=[outdir+'/dat.uv'],
+                 log=logf, force=rawclobber)
+        if not load.run():
+            logprint('Error: ATLOD failed', logf)
+            logf.close()
+            exit(1)
+        checkpoint('night', 'loaded')
+    os.chdir(outdir)
+    if not resumed('night', 'split', logf):
+        CHECKPOINT.resume = False
+        logprint('Running UVSPLIT...', logf)
+        split = TaskGraph(logf=logf)
+        # The split datasets are only known once uvsplit has run: those of
+        # the last run are its outputs, so it runs again if any has gone
+        products = os.path.join(split.stampdir, 'uvsplit.products')
+        split_outputs = []
+        if os.path.exists(products):
+            with open(products) as prodf:
+                split_outputs = prodf.read().split()
+        if outclobber:
+            logprint('Output files will be clobbered if necessary', logf)
+            split.add('uvsplit', args=['uvsplit', 'vis=dat.uv', 'options=mosaic,clobber'],
+                      inputs=['dat.uv'], outputs=split_outputs, log=logf, force=True)
+        else:
+            split.add('uvsplit', args=['uvsplit', 'vis=dat.uv', 'options=mosaic'],
+                      inputs=['dat.uv'], outputs=split_outputs, log=logf,
+                      force=len(split_outputs) == 0)
+        ret = split.run()
+        if ret:
+            with open(products, 'w') as prodf:
+                prodf.write('\n'.join(sorted(glob.glob(SPLIT_GLOB))) + '\n')
+        checkpoint('night', 'split', ret)
+    if use_stepcache:
+        logprint('Skipping calibration steps already applied to unchanged data', logf)
+        STEPCACHE = StepCache()
+    if tagged_logs:
+        MUX = LogMux()
+    slist = sorted(glob.glob(SPLIT_GLOB))
+    logprint('Working on %d sources' % len(slist), logf)
+    bandfreq = unique([x[-4:] for x in slist])
+    logprint('Frequency bands to process: %s' % (','.join(bandfreq)), logf)
+
+    src_to_plot = []
+    bands = []
+
+    for frqb in bandfreq:
+        logprint(
+            '\n\n##########\nWorking on frequency: %s\n##########\n\n' % (frqb), logf)
+        pricalname = '__NOT_FOUND__'
+        ext_seccalname = '__NOT_FOUND__'
+        seccalnames = []
+        polcalnames = []
+        targetnames = []
+        ext_targetnames = []
+        for i, source in enumerate(slist):
+            frqid = source[-4:]
+            if frqid not in frqb:
+                continue
+            if prical in source:
+                pricalname = source
+            elif any([sc in source for sc in seccal.split(',')]):
+                seccalnames.append(source)
+            elif seccal_ext in source:
+                ext_seccalname = source
+            elif any([pc in source for pc in polcal.split(',')]):
+                polcalnames.append(source)
+            elif any([es in source for es in target_ext.split(',')]):
+                ext_targetnames.append(source)
+            else:
+                targetnames.append(source)
+                src_to_plot.append(source[:-5])
+        if pricalname == '__NOT_FOUND__':
+            logprint('Error: primary cal (%s) not found' % prical, logf)
+            logf.close()
+            exit(1)
+        if len(seccalnames) == 0:
+            logprint('Error: secondary cal (%s) not found' % seccal, logf)
+            logf.close()
+            exit(1)
+        if ext_seccalname == '__NOT_FOUND__' and seccal_ext != 'NONE':
+            logprint('Error: extended-source secondary cal (%s) not found' %
+                     seccal_ext, logf)
+            logf.close()
+            exit(1)
+        elif seccal_ext == 'NONE':
+            ext_seccalname = '(NONE)'
+        logprint('Identified primary cal: %s' % pricalname, logf)
+        logprint('Identified %d secondary cals' % len(seccalnames), logf)
+        logprint('Identified %d polarization calibrators' %
+                 len(polcalnames), logf)
+        logprint('Identified %d compact targets to calibrate' %
+                 len(targetnames), logf)
+        logprint('Identified secondary cal for extended sources: %s' %
+                 ext_seccalname, logf)
+        logprint('Identified %d extended targets to calibrate' %
+                 len(ext_targetnames), logf)
+        if skipcal:
+            logprint(
+                'Skipping flagging and calibration steps on user request.', logf)
+            continue
+        bands.append((frqb, slist, prical, pricalname,
+                      seccalnames, targetnames, workers, flagger, run_state()))
+
+    if len(bands) > 1 and parallel_bands:
+        logprint('Calibrating %d frequency bands in parallel' % len(bands), logf)
+    bandlogs = run_jobs(calibrate_band, bands,
+                        workers=len(bands) if parallel_bands else 1)
+    merge_logs(bandlogs, logf)
 
     for t in sorted(unique(src_to_plot)):
+        if resumed(t, 'rmsf-plotted', logf):
+            continue
         logprint('Plotting RMSF for %s' % t, logf)
         if int(bandfreq[0]) < 3500:
             call(['uvspec', 'vis=%s.????' % t, 'axis=rm', 'options=nobase,avall', 'nxy=1,2',
@@ -489,23 +750,30 @@ def main(args, cfg):
                   t], stdout=logf, stderr=logf)
             call(['uvspec', 'vis=%s.cx' % t, 'axis=rm', 'options=nobase,avall', 'nxy=1,2',
                   'interval=100000', 'xrange=-3500,3500', 'device=junk.eps/vcps'], stdout=logf, stderr=logf)
-        call(['epstool', '--copy', '--bbox', 'junk.eps',
-              '%s.eps' % t], stdout=logf, stderr=logf)
+        ret = call(['epstool', '--copy', '--bbox', 'junk.eps',
+                    '%s.eps' % t], stdout=logf, stderr=logf)
         os.remove('junk.eps')
+        checkpoint(t, 'rmsf-plotted', not ret)
 
+    logprint('\nResource usage per step:', logf)
+    instrument.summary(logf)
+    instrument.summary()
     logprint('DONE!', logf)
     logf.close()
 
 
-ap = argparse.ArgumentParser()
-ap.add_argument('config_file', help='Input configuration file')
-ap.add_argument('-s', '--setup_file',
-                help='Name of text file with setup correlator file names included so that they can be ignored during the processing [default setup.txt]', default='setup.txt')
-ap.add_argument('-l', '--log_file',
-                help='Name of output log file [default log.txt]', default='log.txt')
-args = ap.parse_args()
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('config_file', help='Input configuration file')
+    ap.add_argument('-s', '--setup_file',
+                    help='Name of text file with setup correlator file names included so that they can be ignored during the processing [default setup.txt]', default='setup.txt')
+    ap.add_argument('-l', '--log_file',
+                    help='Name of output log file [default log.txt]', default='log.txt')
+    ap.add_argument('-r', '--resume', action='store_true',
+                    help='Continue from the last completed stages recorded in the checkpoint manifest (checkpoint.json in the output directory)')
+    args = ap.parse_args()
 
-cfg = configparser.RawConfigParser()
-cfg.read(args.config_file)
+    cfg = configparser.RawConfigParser()
+    cfg.read(args.config_file)
 
-main(args, cfg)
+    main(args, cfg)
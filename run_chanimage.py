@@ -11,48 +11,73 @@ import argparse
 import configparser
 import glob
 import os
-from subprocess import call
+import shutil
 import numpy as np
 from astropy.io import fits
+from astropy.nddata.utils import overlap_slices
+import instrument
+from instrument import call
+from imstats import get_noise
+from scheduler import run_jobs, memory_workers
 
-sourcename = sys.argv[1]
-mfsdir = '../../scal_makeup/'
-vislist = sorted(glob.glob(sourcename+'.????'))
-print(vislist)
-
-
-def getnoise(img_name):
-    hdu = fits.open(img_name)
-    data = hdu[0].data[0, 0]
-    rms_initial = np.std(data)
-    rms = np.std(
-        data[np.logical_and(data > -2.5*rms_initial, data < 2.5*rms_initial)])
-    peak_min = np.amin(data)
-    hdu.close()
-    return rms, peak_min
-
-
-for vis in vislist:
-    freqband = vis.split('.')[-1]
-    if freqband == '2100':
-        selstring = ''
-        imsize = 4096
-        cellsize = 1
-# 	imsize = 500
-    elif freqband == '5500':
-        selstring = 'select=-ant(6)'
-        imsize = 4096
-        cellsize = 0.7
-# 	imsize = 1200
-    elif freqband == '7500':
-        selstring = 'select=-ant(6)'
-        imsize = 4096
-        cellsize = 0.5
-# 	imsize = 1600
-    else:
-        print('Which frequency is this?')
-        exit(1)
+# Per band: select string, image size and cell size (arcsec)
+BANDS = {'2100': ('', 4096, 1),                   # imsize = 500
+         '5500': ('select=-ant(6)', 4096, 0.7),   # imsize = 1200
+         '7500': ('select=-ant(6)', 4096, 0.5)}   # imsize = 1600
 
+STOKES = ['i', 'q', 'u', 'v']
+
+# Number of channels in each band
+NCHAN = 2048
+
+# Memory (bytes) needed to image one channel group: the four Stokes maps and
+# the double-size beam as single-precision planes, twice over for the
+# working copies of invert and clean.
+
+
+def group_memory(imsize):
+    return 2*4*imsize**2*(len(STOKES) + 4)
+
+# Smallest even image size of at least n pixels whose only prime factors are
+# 2, 3 and 5, so the FFTs in invert stay fast.
+
+
+def fft_size(n):
+    size = max(int(np.ceil(n)), 2)
+    while True:
+        rest = size
+        for prime in (2, 3, 5):
+            while rest % prime == 0:
+                rest //= prime
+        if rest == 1 and size % 2 == 0:
+            return size
+        size += 1
+
+# Image size holding a cutout of the given size (pixels) with a margin of
+# guard beams around it, taking the beam from the selfcal MFS image.
+
+
+def cutout_imsize(cutout, mfsimage, cellsize, guard=5):
+    bmaj = fits.getheader(mfsimage).get('BMAJ')
+    margin = 0 if bmaj is None else int(np.ceil(guard*bmaj*3600/cellsize))
+    return fft_size(cutout + 2*margin)
+
+# Number of channels to image together so that the peak of the MFS image
+# reaches snr in Stokes I, assuming the noise scales as 1/sqrt(channels).
+# Kept between width and max_width.
+
+
+def snr_width(peak, imnoise, snr, width=10, max_width=100):
+    if peak <= 0:
+        return max_width
+    need = int(np.ceil(NCHAN*(snr*imnoise/peak)**2))
+    return int(np.clip(need, width, max_width))
+
+# Make the clean mask of a band from the MFS image made by selfcal.
+# Returns the noise and peak of that image and the name of the mask.
+
+
+def make_mask(sourcename, freqband, selstring, imsize, cellsize, mfsdir):
     call(['invert', 'vis=%s.%s' % (sourcename, freqband),
           'map=%s.d.%s.mfs.i' % (sourcename, freqband),
           'beam=%s.beam.%s.mfs' % (sourcename, freqband),
@@ -67,7 +92,8 @@ for vis in vislist:
     # call(['fits','op=xyout','in=%s.d.%s.mfs.i'%(sourcename,freqband),'out=%s.d.%s.mfs.i.fits'%(sourcename,freqband)],
     # stdin=None, stdout=None, stderr=None, shell=False)
     # imnoise = getnoise('%s.d.%s.mfs.i.fits'%(sourcename,freqband))
-    imnoise, peak_min = getnoise(mfsdir+sourcename+'.'+freqband+'.p2.fits')
+    imnoise, peak_max, peak_min = get_noise(
+        mfsdir+sourcename+'.'+freqband+'.p2.fits')
     mask_level = np.amax([10*imnoise, -peak_min*1.5])
     maskname = '%s.%s.mask' % (sourcename, freqband)
     regridname = '%s.%s.regrid' % (sourcename, freqband)
@@ -109,47 +135,197 @@ for vis in vislist:
 # 	call(['rm','-rf','%s.model.%s.mfs'%(sourcename,freqband)])
 # 	call(['rm','-rf','%s.restor.%s.mfs'%(sourcename,freqband)])
 # #     call(['rm','-rf','%s.restor.%s.mfs.fits'%(sourcename,freqband)])
+    return imnoise, peak_max, maskname
+
+
+def image_group(sourcename, freqband, i, width, imsize, cellsize, selstring,
+                imnoise, maskname, scratch_root='.chanscratch', cutout=None,
+                keep_full=False):
+    """Image one group of channels in Stokes I, Q, U and V.
+
+    The maps, beam, models and restored images are made in a scratch
+    directory of their own, so groups can be imaged side by side. The
+    restored images are written to <source>.<band>.<chan>.<stokes>.fits,
+    or, with a cutout size, only the centre of them is written to
+    <source>.<band>.<chan>.<stokes>.cutout.fits, the file cutout_400.py
+    would make.
+
+    Arguments:
+        sourcename {str} -- Source name.
+        freqband {str} -- Band name.
+        i {int} -- First channel of the group.
+        width {int} -- Number of channels in the group.
+        imsize {int} -- Image size (pixels).
+        cellsize {float} -- Cell size (arcsec).
+        selstring {str} -- MIRIAD select keyword, or ''.
+        imnoise {float} -- Noise of the MFS image, sets the clean cutoff.
+        maskname {str} -- Clean mask.
+
+    Keyword Arguments:
+        scratch_root {str} -- Directory holding the per-group scratch
+            directories (default: {'.chanscratch'})
+        cutout {int} -- Size of the centred cutout in pixels, None to write
+            the whole image (default: {None})
+        keep_full {bool} -- Write the whole image as well as the cutout
+            (default: {False})
+
+    Returns:
+        group {str} -- <source>.<band>.<chan>
+        missing {list} -- Stokes parameters that were not imaged.
+    """
+    group = '%s.%s.%04d' % (sourcename, freqband, i)
+    scratch = os.path.join(scratch_root, group)
+    if os.path.exists(scratch):
+        shutil.rmtree(scratch)
+    os.makedirs(scratch)
+    beam = os.path.join(scratch, 'beam')
+    maps = dict((stokes, os.path.join(scratch, 'd.%s' % stokes))
+                for stokes in STOKES)
+    call(['invert', 'vis=%s.%s' % (sourcename, freqband),
+          'map=%s' % ','.join(maps[stokes] for stokes in STOKES),
+          'beam=%s' % beam,
+          'imsize=%s' % (imsize), 'cell=%s' % (
+        cellsize), 'robust=0.5', 'stokes=i,q,u,v', selstring,
+        'options=mfs,double', 'line=chan,%d,%d' % (width, i)],
+        stdin=None, stdout=None, stderr=None, shell=False)
+
+    if cutout is not None:
+        # The pixels Cutout2D takes in cutout_400.py, as a 1-based MIRIAD box
+        yslice, xslice = overlap_slices((imsize, imsize), (cutout, cutout),
+                                        (imsize//2, imsize//2), mode='trim')[0]
+        cutout_box = '%d,%d,%d,%d' % (xslice.start + 1, yslice.start + 1,
+                                      xslice.stop, yslice.stop)
+
+    missing = []
+    for stokes in STOKES:
+        if not os.path.exists(maps[stokes]):
+            missing.append(stokes)
+            continue
+        model = os.path.join(scratch, 'model.%s' % stokes)
+        restor = os.path.join(scratch, 'restor.%s' % stokes)
+        sub = os.path.join(scratch, 'cutout.%s' % stokes)
+        call(['clean', 'map=%s' % maps[stokes],
+              'beam=%s' % beam,
+              'out=%s' % model,
+              'cutoff=%f' % (5.*imnoise), 'niters=1500', 'region=mask(%s)' % (maskname)],
+             stdin=None, stdout=None, stderr=None, shell=False)
+        call(['restor', 'map=%s' % maps[stokes],
+              'beam=%s' % beam,
+              'model=%s' % model,
+              'out=%s' % restor],
+             stdin=None, stdout=None, stderr=None, shell=False)
+        # call(['rm','-rf','%s.%s.%04d.%s.fits'%(sourcename,freqband,i,stokes)])
+        outputs = []
+        if cutout is None or keep_full:
+            call(['fits', 'in=%s' % restor,
+                  'out=%s.%s.fits' % (group, stokes), 'op=xyout'],
+                 stdin=None, stdout=None, stderr=None, shell=False)
+            outputs.append('%s.%s.fits' % (group, stokes))
+        if cutout is not None:
+            call(['imsub', 'in=%s' % restor, 'region=boxes(%s)' % cutout_box,
+                  'out=%s' % sub], stdin=None, stdout=None, stderr=None, shell=False)
+            call(['fits', 'in=%s' % sub,
+                  'out=%s.%s.cutout.fits' % (group, stokes), 'op=xyout'],
+                 stdin=None, stdout=None, stderr=None, shell=False)
+            outputs.append('%s.%s.cutout.fits' % (group, stokes))
+        if not all(os.path.exists(name) for name in outputs):
+            missing.append(stokes)
+        for name in (maps[stokes], model, restor, sub):
+            if os.path.exists(name):
+                shutil.rmtree(name)
+
+    # Keep the scratch directory of a failed group for inspection
+    if len(missing) == 0:
+        shutil.rmtree(scratch)
+    return group, missing
+
+
+def main(args):
+    sourcename = args.sourcename
+    print('Recording step timings in %s' %
+          instrument.start('run_chanimage.%s' % sourcename))
+    mfsdir = args.mfsdir
+    vislist = sorted(glob.glob(sourcename+'.????'))
+    print(vislist)
+
+    jobs = []
+    masks = []
+    for vis in vislist:
+        freqband = vis.split('.')[-1]
+        if freqband not in BANDS:
+            print('Which frequency is this?')
+            exit(1)
+        selstring, imsize, cellsize = BANDS[freqband]
+        if args.imsize:
+            imsize = args.imsize
+        elif args.cutout:
+            imsize = cutout_imsize(args.cutout, mfsdir+sourcename+'.'+freqband+'.p2.fits',
+                                   cellsize, args.guard)
+        if args.cutout and args.cutout > imsize:
+            print('Cutout of %d pixels larger than the %d pixel image of %s' %
+                  (args.cutout, imsize, vis))
+            exit(1)
+        imnoise, peak, maskname = make_mask(sourcename, freqband, selstring,
+                                            imsize, cellsize, mfsdir)
+        masks.append(maskname)
+        width = args.width
+        if args.snr:
+            width = snr_width(peak, imnoise, args.snr, args.width, args.max_width)
+        print('%s: imsize %d, %d channels per image' % (vis, imsize, width))
+        jobs += [(sourcename, freqband, i, min(width, NCHAN + 1 - i), imsize,
+                  cellsize, selstring, imnoise, maskname, args.scratch,
+                  args.cutout, args.keep_full)
+                 for i in range(1, NCHAN + 1, width)]
+
+    workers = 1
+    if args.jobs != 1 and len(jobs) > 0:
+        job_bytes = args.mem_per_job*2**30 if args.mem_per_job else \
+            max(group_memory(job[4]) for job in jobs)
+        workers = memory_workers(job_bytes, args.jobs)
+        print('Imaging %d channel groups with %d workers (%.1f GB each)' %
+              (len(jobs), workers, job_bytes/2.**30))
+    results = run_jobs(image_group, jobs, workers=workers)
+
+    for maskname in masks:
+        call(['rm', '-rf', '%s' % (maskname)])
+    if os.path.isdir(args.scratch) and len(os.listdir(args.scratch)) == 0:
+        os.rmdir(args.scratch)
+
+    instrument.summary()
+    failed = [(group, missing) for group, missing in results if missing]
+    for group, missing in failed:
+        print('%s: no %s image' % (group, ','.join(missing)))
+    if failed:
+        print('%d of %d channel groups incomplete' % (len(failed), len(results)))
+
 
-    for i in range(1, 2049, 10):
-        call(['invert', 'vis=%s.%s' % (sourcename, freqband),
-              'map=%s.d.%s.%04d.i' % (sourcename, freqband, i)+',%s.d.%s.%04d.q' % (sourcename, freqband, i) +
-              ',%s.d.%s.%04d.u' % (sourcename, freqband, i) +
-              ',%s.d.%s.%04d.v' % (sourcename, freqband, i),
-              'beam=%s.beam.%s.%04d' % (sourcename, freqband, i),
-              'imsize=%s' % (imsize), 'cell=%s' % (
-            cellsize), 'robust=0.5', 'stokes=i,q,u,v', selstring,
-            'options=mfs,double', 'line=chan,10,'+str(i)],
-            stdin=None, stdout=None, stderr=None, shell=False)
-
-        for stokes in ['i', 'q', 'u', 'v']:
-            if not os.path.exists('%s.d.%s.%04d.%s' % (sourcename, freqband, i, stokes)):
-                continue
-            else:
-                call(['clean', 'map=%s.d.%s.%04d.%s' % (sourcename, freqband, i, stokes),
-                      'beam=%s.beam.%s.%04d' % (sourcename, freqband, i),
-                      'out=%s.model.%s.%04d.%s' % (
-                          sourcename, freqband, i, stokes),
-                      'cutoff=%f' % (5.*imnoise), 'niters=1500', 'region=mask(%s)' % (maskname)],
-                     stdin=None, stdout=None, stderr=None, shell=False)
-                call(['restor', 'map=%s.d.%s.%04d.%s' % (sourcename, freqband, i, stokes),
-                      'beam=%s.beam.%s.%04d' % (sourcename, freqband, i),
-                      'model=%s.model.%s.%04d.%s' % (
-                          sourcename, freqband, i, stokes),
-                      'out=%s.%s.%04d.%s' % (sourcename, freqband, i, stokes)],
-                     stdin=None, stdout=None, stderr=None, shell=False)
-                # call(['rm','-rf','%s.%s.%04d.%s.fits'%(sourcename,freqband,i,stokes)])
-                call(['fits', 'in=%s.%s.%04d.%s' % (sourcename, freqband, i, stokes),
-                      'out=%s.%s.%04d.%s.fits' % (sourcename, freqband, i, stokes), 'op=xyout'],
-                     stdin=None, stdout=None, stderr=None, shell=False)
-                call(['rm', '-rf', '%s.d.%s.%04d.%s' %
-                      (sourcename, freqband, i, stokes)])
-                call(['rm', '-rf', '%s.d.%s.%04d.%s.fits' %
-                      (sourcename, freqband, i, stokes)])
-                call(['rm', '-rf', '%s.model.%s.%04d.%s' %
-                      (sourcename, freqband, i, stokes)])
-                call(['rm', '-rf', '%s.%s.%04d.%s' %
-                      (sourcename, freqband, i, stokes)])
-
-        call(['rm', '-rf', '%s.beam.%s.%04d' % (sourcename, freqband, i)])
-    call(['rm', '-rf', '%s' % (maskname)])
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(
+        description='Make channel images of a QUOCKA source from calibrated MIRIAD data')
+    ap.add_argument('sourcename', help='Source name (with <source>.<band> datasets in the current directory)')
+    ap.add_argument('--mfsdir', help='Directory with the selfcal MFS images [default ../../scal_makeup/]',
+                    default='../../scal_makeup/')
+    ap.add_argument('--imsize', type=int,
+                    help='Image size in pixels for every band [default 4096, or sized from --cutout]')
+    ap.add_argument('--cutout', type=int,
+                    help='Only write centred cutouts of this many pixels (e.g. 400, as cutout_400.py makes), imaging what they need plus --guard beams around them')
+    ap.add_argument('--keep-full', action='store_true',
+                    help='With --cutout, also write the whole channel images')
+    ap.add_argument('--guard', type=float,
+                    help='Margin around the cutout in beams, from the beam of the MFS image [default 5]', default=5)
+    ap.add_argument('-w', '--width', type=int,
+                    help='Channels imaged together [default 10]; the smallest width with --snr', default=10)
+    ap.add_argument('--snr', type=float,
+                    help='Widen the channel groups until the peak of the MFS image reaches this Stokes I SNR per image')
+    ap.add_argument('--max-width', type=int,
+                    help='Largest number of channels imaged together with --snr [default 100]', default=100)
+    ap.add_argument('-j', '--jobs', type=int,
+                    help='Largest number of channel groups imaged concurrently, 0 for as many as cores and memory allow [default 1]',
+                    default=1)
+    ap.add_argument('--mem-per-job', type=float,
+                    help='Memory needed per channel group in GB, used to limit the concurrency [default estimated from the image size]')
+    ap.add_argument('--scratch', help='Directory for the per-group scratch directories [default .chanscratch]',
+                    default='.chanscratch')
+    args = ap.parse_args()
 
+    main(args)
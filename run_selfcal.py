@@ -2,17 +2,26 @@
 
 # Doing selfcal on a quocka field
 
+import argparse
 import glob
+import json
 import os
 import sys
-from subprocess import call
 import numpy as np
 import shutil
 from astropy.io import fits
+from logmux import LogMux
+from scheduler import run_jobs, merge_logs
+import instrument
+from imstats import get_noise
 
 # change nfbin to 2
 NFBIN = 2
 
+# Log multiplexer for the MIRIAD output of this process, set up by run_job
+# with --tagged-logs
+MUX = None
+
 # Print a log file
 
 
@@ -20,196 +29,415 @@ def logprint(s2p, lf):
     print(s2p, file=lf)
     print(s2p)
 
-# Get the rms and peak flux of an image. RMS is estimated using a clipped version of the image data.
+# Run a MIRIAD task on dataset vis. With the log multiplexer its output is
+# tagged and also goes to the dataset's own log.
+
+
+def run_task(args, vis, logf):
+    if MUX is not None:
+        return MUX.call(args, logf, source=vis, band=vis[-4:])
+    return instrument.call(args, stdout=logf, stderr=logf, source=vis, band=vis[-4:])
+
+
+# Selfcal rounds: (image name, dataset suffix, selfcal interval, options)
+ROUNDS = [('p1', 'pscal', '5', 'phase,mfs'),
+          ('p2', 'pscal', '0.5', 'phase,mfs'),
+          ('p2a1', 'ascal', '5', 'amp,mfs')]
+
+# Default adaptive policy: a round must improve the rms or the dynamic range
+# by at least min_gain (fractionally) for selfcal to go on, and amp selfcal
+# is only done on fields whose p2 image reaches a dynamic range of amp_dr.
+ADAPTIVE = {'min_gain': 0.05, 'amp_dr': 100.0}
+
+
+
+class ImagingPlan(object):
+    """Plan the imaging of one selfcal job, reusing what is still valid.
+
+    The map and beam are only made again when the dataset has changed since
+    they were made (a selfcal writes new gains). The image size and cell of
+    the first map are kept for the later ones, so that models line up, and
+    the diagnostic clean of each round starts from the model selfcal used,
+    so it only has to clean what the masked clean left.
+    """
+
+    def __init__(self, t, logf, scratch='.', reuse_model=True):
+        """
+        Arguments:
+            t {str} -- Dataset name (<field>.<band>).
+            logf {file} -- Log file.
+
+        Keyword Arguments:
+            scratch {str} -- Directory for the temporary datasets (default: {'.'})
+            reuse_model {bool} -- Start the diagnostic clean from the selfcal
+                model (default: {True})
+        """
+        self.t = t
+        self.logf = logf
+        self.reuse_model = reuse_model
+        self.tmp = dict((name, os.path.join(scratch, '%s.%s' % (t, name)))
+                        for name in ('map', 'beam', 'model', 'restor', 'mask', 'scmodel'))
+        self.geometry = ['imsize=2,2,beam', 'cell=5,5,res']
+        self.made = None
+
+    def _state(self, vis):
+        # Size and modification time of every item of the dataset but its history
+        return tuple((item, st.st_size, st.st_mtime_ns) for item, st in
+                     sorted((item, os.stat(os.path.join(vis, item)))
+                            for item in os.listdir(vis) if item != 'history'))
+
+    def remove(self, *names):
+        """Remove temporary datasets, if they exist."""
+        for name in names:
+            if os.path.exists(self.tmp[name]):
+                shutil.rmtree(self.tmp[name])
+
+    def invert(self, vis):
+        """Make the map and beam of vis, unless they are up to date."""
+        key = (vis, self._state(vis), tuple(self.geometry))
+        if key == self.made and os.path.exists(self.tmp['map']):
+            logprint("Map and beam of %s are up to date" % vis, self.logf)
+            return
+        self.remove('map', 'beam')
+        run_task(['invert', 'vis=%s' % vis, 'map=%s' % self.tmp['map'], 'beam=%s' % self.tmp['beam'], 'robust=0.5',
+                  'stokes=i', 'options=mfs,double,sdb'] + self.geometry, self.t, self.logf)
+        self.made = key
+
+    def pin(self, fits_name):
+        """Make the later maps with the image size and cell of fits_name."""
+        header = fits.getheader(fits_name)
+        self.geometry = ['imsize=%d,%d' % (header['NAXIS1'], header['NAXIS2']),
+                         'cell=%.6f,%.6f' % (abs(header['CDELT1'])*3600, abs(header['CDELT2'])*3600)]
+        if self.made is not None:
+            self.made = self.made[:2] + (tuple(self.geometry),)
+
+    def image(self, fits_out, clean_level, sigma):
+        """Clean the map down to clean_level (with a 2 sigma final cutoff),
+        restore it and export the restored image.
+
+        Returns:
+            rms {float} -- Clipped rms of the image.
+            peak_max {float} -- Peak of the image.
+            peak_min {float} -- Minimum of the image.
+        """
+        self.remove('model', 'restor')
+        start = []
+        if self.reuse_model and os.path.exists(self.tmp['scmodel']):
+            start = ['model=%s' % self.tmp['scmodel']]
+        run_task(['mfclean', 'map=%s' % self.tmp['map'], 'beam=%s' % self.tmp['beam'], 'out=%s' % self.tmp['model'],
+                  'niters=10000', 'cutoff=%s,%s' % (clean_level, 2*sigma), "region='perc(90)'"] + start,
+                 self.t, self.logf)
+        run_task(['restor', 'map=%s' % self.tmp['map'], 'beam=%s' % self.tmp['beam'], 'model=%s' %
+                  self.tmp['model'], 'out=%s' % self.tmp['restor']], self.t, self.logf)
+        run_task(['fits', 'op=xyout', 'in=%s' % self.tmp['restor'], 'out=%s' %
+                  fits_out], self.t, self.logf)
+        return get_noise(fits_out)
+
+    def selfcal(self, vis, sigma, peak_min, interval, options):
+        """Clean the map within a mask made from the last restored image, and
+        selfcal vis against that model.
+
+        Returns:
+            clean_level {float} -- Clean level for the next image.
+        """
+        mask_level = np.amax([10*sigma, -peak_min*1.5])
+        clean_level = 5.0*sigma
+        run_task(['maths', 'exp=<%s>' % self.tmp['restor'], 'mask=<%s>.gt.%s' %
+                  (self.tmp['restor'], mask_level), 'out=%s' % self.tmp['mask']], self.t, self.logf)
+        self.remove('restor', 'model', 'scmodel')
+        run_task(['mfclean', 'map=%s' % self.tmp['map'], 'beam=%s' % self.tmp['beam'], 'out=%s' % self.tmp['scmodel'],
+                  'niters=1500', 'cutoff=%s,%s' % (clean_level, 2*sigma), 'region=mask(%s)' % self.tmp['mask']],
+                 self.t, self.logf)
+        run_task(['selfcal', 'vis=%s' % vis, 'model=%s' % self.tmp['scmodel'], 'interval=%s' % interval,
+                  'nfbin=1', 'options=%s' % options], self.t, self.logf)
+        self.remove('mask')
+        return clean_level
+
+# Dynamic range of an image, 0 if its rms isn't positive (e.g. a blank image).
+
+
+def dynamic_range(peak, rms):
+    return peak/rms if rms > 0 else 0.0
+
+# Fractional improvement of an image over the previous one: the larger of the
+# drop in rms and the rise in dynamic range. Measures the previous image
+# doesn't have (zero or non-finite) are left out, and 0 is returned if neither
+# can be compared.
+
 
+def improvement(prev, cur):
+    gains = []
+    if prev['rms'] > 0 and np.isfinite(cur['rms']):
+        gains.append((prev['rms'] - cur['rms'])/prev['rms'])
+    if prev['dr'] > 0 and np.isfinite(cur['dr']):
+        gains.append(cur['dr']/prev['dr'] - 1)
+    return max(gains) if gains else 0.0
 
-def get_noise(img_name):
-    hdu = fits.open(img_name)
-    data = hdu[0].data[0, 0]
-# 	dimen = data.shape
-# 	mask = np.ones(dimen)
-# 	mask[int(dimen[0]/2)-200:int(dimen[0]/2)+200, int(dimen[1]/2)-200:int(dimen[1]/2)+200] = 0
-# 	mask = mask.astype(bool)
-# 	rms = np.std(data[mask])
-    rms_initial = np.std(data)
-    rms = np.std(
-        data[np.logical_and(data > -2.5*rms_initial, data < 2.5*rms_initial)])
-    peak_max = np.amax(data)
-    peak_min = np.amin(data)
-    hdu.close()
-    return rms, peak_max, peak_min
+# Items of a dataset written by selfcal: the gain table, and the header (which
+# holds the small items describing it, such as interval, nsols and ngains).
+GAIN_ITEMS = ('header', 'gains', 'gainsf')
 
+# Copy the gain items of vis to the directory backup, so that a selfcal round
+# can be undone.
 
-sourcename = sys.argv[1]
-vislist = [sourcename+'.2100', sourcename+'.5500', sourcename+'.7500']
 
-logf = open(sourcename+'.scal.log', 'w', 1)
+def save_gains(vis, backup):
+    if os.path.exists(backup):
+        shutil.rmtree(backup)
+    os.makedirs(backup)
+    for item in GAIN_ITEMS:
+        if os.path.exists(os.path.join(vis, item)):
+            shutil.copy2(os.path.join(vis, item), backup)
 
-for t in vislist:
+# Put back the gain items saved by save_gains, removing those that didn't
+# exist then.
+
+
+def restore_gains(vis, backup):
+    for item in GAIN_ITEMS:
+        saved = os.path.join(backup, item)
+        if os.path.exists(saved):
+            shutil.copy2(saved, os.path.join(vis, item))
+        elif os.path.exists(os.path.join(vis, item)):
+            os.remove(os.path.join(vis, item))
+    shutil.rmtree(backup)
+
+
+# Selfcal one band of a field (t = <field>.<band>). The .pscal dataset is
+# calibrated in place and the images are written next to it, while the
+# temporary map/beam/model/restor/mask datasets go to a scratch directory so
+# that jobs running side by side don't collide. See ImagingPlan for what is
+# reused between rounds.
+#
+# Without a policy the fixed p0 -> p1 -> p2 -> p2a1 sequence is run. With an
+# adaptive policy (see ADAPTIVE) the rms and dynamic range are measured after
+# each round, and selfcal stops once a round no longer improves the image,
+# skipping amp selfcal. A round that makes the image worse is undone: the
+# gains from before it are restored, and its image is marked as rejected and
+# renamed to <t>.<round>.rejected.fits.
+# p2.fits is always written, as the later scripts use it: after an early stop
+# it is a copy of the last image kept. The rounds and the decision are
+# recorded in <t>.scal.json.
+
+
+def selfcal(t, logf, scratch='.', adaptive=None, reuse_model=True):
+    plan = ImagingPlan(t, logf, scratch, reuse_model)
     t_pscal = t + '.pscal'
-    t_map = t + '.map'
-    t_beam = t + '.beam'
-    t_model = t + '.model'
-    t_restor = t + '.restor'
-    t_p0 = t + '.p0.fits'
     t_dirty = t + '.dirty.fits'
-    t_mask = t + '.mask'
 
     logprint("***** Start selfcal: %s *****" % t, logf)
     logprint("Generate the dirty image:", logf)
     # Generate a MFS image without selfcal.
-    call(['invert', 'vis=%s' % t_pscal, 'map=%s' % t_map, 'beam=%s' % t_beam, 'robust=0.5', 'stokes=i',
-          'options=mfs,double,sdb', 'imsize=2,2,beam', 'cell=5,5,res'], stdout=logf, stderr=logf)
-    call(['fits', 'op=xyout', 'in=%s' % t_map, 'out=%s' %
-          t_dirty], stdout=logf, stderr=logf)
+    plan.invert(t_pscal)
+    run_task(['fits', 'op=xyout', 'in=%s' % plan.tmp['map'], 'out=%s' %
+              t_dirty], t, logf)
+    plan.pin(t_dirty)
     sigma, peak_max, peak_min = get_noise(t_dirty)
-    # sigma5 = 0.0005
-    # sigma2 = 0.0002
-
     clean_level = 5.0*sigma
-
     logprint("RMS of dirty image: %s" % sigma, logf)
-    # logprint("Peak flux density of dirty image: %s"%peak_max, logf)
+
     logprint("Generate a cleaned image:", logf)
-    call(['mfclean', 'map=%s' % t_map, 'beam=%s' % t_beam, 'out=%s' % t_model, 'niters=10000',
-          'cutoff=%s,%s' % (clean_level, 2*sigma), "region='perc(90)'"], stdout=logf, stderr=logf)
-    call(['restor', 'map=%s' % t_map, 'beam=%s' % t_beam, 'model=%s' %
-          t_model, 'out=%s' % t_restor], stdout=logf, stderr=logf)
-    call(['fits', 'op=xyout', 'in=%s' % t_restor, 'out=%s' %
-          t_p0], stdout=logf, stderr=logf)
-    sigma, peak_max, peak_min = get_noise(t_p0)
-    # dynamic_range = peak_flux/sigma
-    # logprint("RMS of p0 image: %s"%sigma, logf)
-    # logprint("Peak flux density of p0 image: %s"%peak_flux, logf)
-    # if dynamic_range >= 100:
-    # 	logprint("Wow this is a bright source!", logf)
-    # 	bool_bright = 1
-    # elif 100 > dynamic_range >= 20:
-    # 	logprint("This is a moderate source.", logf)
-    # 	bool_bright = 0
-    # else:
-    # 	logprint("This is a faint source. Selfcal might not be a good idea...", logf)
-    # 	exit(1)
-
-    # First round of phase selfcal.
-    # Generate a mask
-    logprint("***** First round of phase selfcal *****", logf)
-    # sigma2 = 2.0*sigma
-    # if bool_bright == True:
-    # 	# mask_level = np.amax([50.0*sigma, 0.4*peak_flux])
-    # 	mask_level = 10.0*sigma
-    # 	clean_level = 3.0*sigma
-    # else:
-    # 	# mask_level = np.amax([20.0*sigma, 0.4*peak_flux])
-    # 	mask_level = 10.0*sigma
-    # 	clean_level = 3.0*sigma
-    mask_level = np.amax([10*sigma, -peak_min*1.5])
-    clean_level = 5.0*sigma
-    call(['maths', 'exp=<%s>' % t_restor, 'mask=<%s>.gt.%s' %
-          (t_restor, mask_level), 'out=%s' % t_mask], stdout=logf, stderr=logf)
-    shutil.rmtree(t_restor)
-    shutil.rmtree(t_model)
-    call(['mfclean', 'map=%s' % t_map, 'beam=%s' % t_beam, 'out=%s' % t_model, 'niters=1500',
-          'cutoff=%s,%s' % (clean_level, 2*sigma), 'region=mask(%s)' % t_mask], stdout=logf, stderr=logf)
-    call(['selfcal', 'vis=%s' % t_pscal, 'model=%s' % t_model, 'interval=5',
-          'nfbin=1', 'options=phase,mfs'], stdout=logf, stderr=logf)
-    shutil.rmtree(t_map)
-    shutil.rmtree(t_beam)
-    shutil.rmtree(t_mask)
-    shutil.rmtree(t_model)
-    # os.remove(t_dirty)
-
-    t_p1 = t + '.p1.fits'
-    call(['invert', 'vis=%s' % t_pscal, 'map=%s' % t_map, 'beam=%s' % t_beam, 'robust=0.5', 'stokes=i',
-          'options=mfs,double,sdb', 'imsize=2,2,beam', 'cell=5,5,res'], stdout=logf, stderr=logf)
-    call(['mfclean', 'map=%s' % t_map, 'beam=%s' % t_beam, 'out=%s' % t_model, 'niters=10000',
-          'cutoff=%s,%s' % (clean_level, 2*sigma), "region='perc(90)'"], stdout=logf, stderr=logf)
-    call(['restor', 'map=%s' % t_map, 'beam=%s' % t_beam, 'model=%s' %
-          t_model, 'out=%s' % t_restor], stdout=logf, stderr=logf)
-    call(['fits', 'op=xyout', 'in=%s' % t_restor, 'out=%s' %
-          t_p1], stdout=logf, stderr=logf)
-    sigma, peak_max, peak_min = get_noise(t_p1)
-    # logprint("RMS of p1 image: %s"%sigma, logf)
-    # logprint("Peak flux density of p1 image: %s"%peak_flux, logf)
-
-    # Second round.
-    logprint("***** Second round of phase selfcal *****", logf)
-    mask_level = np.amax([10*sigma, -peak_min*1.5])
-    clean_level = 5.0*sigma
+    sigma, peak_max, peak_min = plan.image(t + '.p0.fits', clean_level, sigma)
 
-    call(['maths', 'exp=<%s>' % t_restor, 'mask=<%s>.gt.%s' %
-          (t_restor, mask_level), 'out=%s' % t_mask], stdout=logf, stderr=logf)
-    shutil.rmtree(t_restor)
-    shutil.rmtree(t_model)
-    call(['mfclean', 'map=%s' % t_map, 'beam=%s' % t_beam, 'out=%s' % t_model, 'niters=1500',
-          'cutoff=%s,%s' % (clean_level, 2*sigma), 'region=mask(%s)' % t_mask], stdout=logf, stderr=logf)
-
-    call(['selfcal', 'vis=%s' % t_pscal, 'model=%s' % t_model, 'interval=0.5',
-          'nfbin=1', 'options=phase,mfs'], stdout=logf, stderr=logf)
-    shutil.rmtree(t_map)
-    shutil.rmtree(t_beam)
-    shutil.rmtree(t_mask)
-    shutil.rmtree(t_model)
-
-    t_p2 = t + '.p2.fits'
-    call(['invert', 'vis=%s' % t_pscal, 'map=%s' % t_map, 'beam=%s' % t_beam, 'robust=0.5', 'stokes=i',
-          'options=mfs,double,sdb', 'imsize=2,2,beam', 'cell=5,5,res'], stdout=logf, stderr=logf)
-    call(['mfclean', 'map=%s' % t_map, 'beam=%s' % t_beam, 'out=%s' % t_model, 'niters=10000',
-          'cutoff=%s,%s' % (clean_level, 2*sigma), "region='perc(90)'"], stdout=logf, stderr=logf)
-    call(['restor', 'map=%s' % t_map, 'beam=%s' % t_beam, 'model=%s' %
-          t_model, 'out=%s' % t_restor], stdout=logf, stderr=logf)
-    call(['fits', 'op=xyout', 'in=%s' % t_restor, 'out=%s' %
-          t_p2], stdout=logf, stderr=logf)
-    sigma, peak_max, peak_min = get_noise(t_p2)
-    # logprint("RMS of p2 image: %s"%sigma, logf)
-    # logprint("Peak flux density of p2 image: %s"%peak_flux, logf)
-
-    # move on to amp selfcal.
-    logprint("***** One round of amp+phase selfcal *****", logf)
-    # sigma2 = 2.0*sigma
-    # if bool_bright == True:
-    # 	mask_level = 10.0*sigma
-    # 	clean_level = 3.0*sigma
-    # else:
-    # 	mask_level = 10.0*sigma
-    # 	clean_level = 3.0*sigma
-
-    mask_level = np.amax([10*sigma, -peak_min*1.5])
-    clean_level = 5.0*sigma
+    images = [{'image': 'p0', 'rms': sigma, 'peak': peak_max,
+               'dr': dynamic_range(peak_max, sigma)}]
+    logprint("p0: rms %s, dynamic range %.1f" % (sigma, images[-1]['dr']), logf)
+    stop = None
+    for name, suffix, interval, options in ROUNDS:
+        if adaptive is not None and name == 'p2a1' and images[-1]['dr'] < adaptive['amp_dr']:
+            stop = 'dynamic range %.1f of %s below %s, no amp selfcal' % (
+                images[-1]['dr'], images[-1]['image'], adaptive['amp_dr'])
+            break
+        if 'amp' in options:
+            logprint("***** One round of amp+phase selfcal *****", logf)
+        else:
+            logprint("***** %s round of phase selfcal *****" %
+                     ('First' if name == 'p1' else 'Second'), logf)
+        vis = '%s.%s' % (t, suffix)
+        if suffix != 'pscal':
+            # Amp selfcal works on a copy of the phase-calibrated data
+            if os.path.exists(vis):
+                shutil.rmtree(vis)
+            run_task(['uvaver', 'vis=%s' % t_pscal, 'out=%s' %
+                      vis], t, logf)
+        backup = os.path.join(scratch, '%s.gains' % os.path.basename(vis))
+        if adaptive is not None:
+            save_gains(vis, backup)
+        clean_level = plan.selfcal(vis, sigma, peak_min, interval, options)
+        plan.invert(vis)
+        sigma, peak_max, peak_min = plan.image(
+            '%s.%s.fits' % (t, name), clean_level, sigma)
+        dr = dynamic_range(peak_max, sigma)
+        images.append({'image': name, 'rms': sigma, 'peak': peak_max, 'dr': dr,
+                       'gain': improvement(images[-1], {'rms': sigma, 'dr': dr})})
+        logprint("%s: rms %s, dynamic range %.1f, improvement %.1f%%" %
+                 (name, sigma, images[-1]['dr'], 100*images[-1]['gain']), logf)
+        if adaptive is not None and images[-1]['gain'] < 0:
+            restore_gains(vis, backup)
+            # Keep the image for inspection, under a name no stage uses
+            os.rename('%s.%s.fits' % (t, name), '%s.%s.rejected.fits' % (t, name))
+            images[-1]['rejected'] = True
+            stop = '%s made the image worse, gains restored' % name
+            break
+        if adaptive is not None:
+            shutil.rmtree(backup)
+        if adaptive is not None and images[-1]['gain'] < adaptive['min_gain'] and name != 'p2a1':
+            stop = 'improvement of %s below %.1f%%' % (name, 100*adaptive['min_gain'])
+            break
+    plan.remove(*plan.tmp)
+
+    final = [image['image'] for image in images if not image.get('rejected')][-1]
+    if final in ('p0', 'p1'):
+        shutil.copyfile('%s.%s.fits' % (t, final), t + '.p2.fits')
+        logprint("%s.p2.fits is a copy of %s.%s.fits" % (t, t, final), logf)
+    if stop is not None:
+        logprint("Selfcal stopped after %s: %s" % (final, stop), logf)
+    record = {'mode': 'fixed' if adaptive is None else 'adaptive',
+              'policy': adaptive, 'images': images, 'final': final,
+              'stopped': stop}
+    with open(t + '.scal.json', 'w') as jsonf:
+        json.dump(record, jsonf, indent=1)
+    return record
+
+
+def run_job(field, band, scratch_root='.scratch', adaptive=None, reuse_model=True,
+            tagged_logs=False):
+    """Selfcal one band of a field in its own scratch directory.
+
+    Arguments:
+        field {str} -- QUOCKA field name.
+        band {str} -- Band name, e.g. '2100'.
+
+    Keyword Arguments:
+        scratch_root {str} -- Directory holding the per-job scratch
+            directories (default: {'.scratch'})
+        adaptive {dict} -- Adaptive selfcal policy, None for the fixed
+            sequence (default: {None})
+        reuse_model {bool} -- Start the diagnostic cleans from the selfcal
+            model (default: {True})
+        tagged_logs {bool} -- Tag the task output and also write it to a
+            log per dataset (default: {False})
+
+    Returns:
+        t {str} -- Dataset name (<field>.<band>).
+        status {str} -- 'ok', 'missing', 'error' or the number of failed tasks.
+    """
+    global MUX
+    t = '%s.%s' % (field, band)
+    if not os.path.exists(t + '.pscal'):
+        return t, 'missing'
+    if tagged_logs:
+        MUX = LogMux()
+    scratch = os.path.join(scratch_root, t)
+    if os.path.exists(scratch):
+        shutil.rmtree(scratch)
+    os.makedirs(scratch)
+    logf = open(t + '.scal.log', 'w', 1)
+    try:
+        selfcal(t, logf, scratch, adaptive, reuse_model)
+        nfail = sum(1 for rec in instrument.RECORDER.records
+                    if rec['kind'] == 'task' and rec['source'] == t and rec['ret'])
+        status = 'ok' if nfail == 0 else '%d tasks failed' % nfail
+    except Exception as err:
+        logprint('Error: selfcal of %s stopped: %s' % (t, err), logf)
+        status = 'error'
+    logf.close()
+    if MUX is not None:
+        MUX.close()
+    # Keep the scratch directory of a failed job for inspection
+    if status == 'ok':
+        shutil.rmtree(scratch)
+    return t, status
+
+
+def main(args):
+    bands = args.bands.split(',')
+    fields = list(args.fields)
+    for pattern in args.glob or []:
+        for pscal in sorted(glob.glob(pattern + '.[257]???.pscal')):
+            fields.append(os.path.basename(pscal)[:-len('.2100.pscal')])
+    fields = sorted(set(fields), key=fields.index)
+    if len(fields) == 0:
+        print('No fields to selfcal')
+        sys.exit(1)
+    timefile = instrument.start('run_selfcal.%s' % fields[0] if len(fields) == 1
+                                else 'run_selfcal')
+    print('Recording step timings in %s' % timefile)
+
+    adaptive = None
+    if args.adaptive:
+        adaptive = {'min_gain': args.min_gain, 'amp_dr': args.amp_dr}
+    jobs = [(field, band, args.scratch, adaptive, not args.fresh_clean, args.tagged_logs)
+            for field in fields for band in bands]
+    results = run_jobs(run_job, jobs, workers=args.jobs)
+
+    # One log and one selfcal record per field, bands in order
+    for field in fields:
+        records = {}
+        for band in bands:
+            jsonname = '%s.%s.scal.json' % (field, band)
+            if os.path.exists(jsonname):
+                with open(jsonname) as jsonf:
+                    records[band] = json.load(jsonf)
+                os.remove(jsonname)
+        if records:
+            with open(field + '.scal.json', 'w') as jsonf:
+                json.dump(records, jsonf, indent=1)
+        lognames = ['%s.%s.scal.log' % (field, band) for band in bands]
+        if not any(os.path.exists(logname) for logname in lognames):
+            continue
+        logf = open(field + '.scal.log', 'w', 1)
+        merge_logs(lognames, logf)
+        logf.close()
+    if os.path.isdir(args.scratch) and len(os.listdir(args.scratch)) == 0:
+        os.rmdir(args.scratch)
+
+    print('\nResource usage per step:')
+    instrument.summary()
+    print('\nSelfcal jobs:')
+    nbad = 0
+    for t, status in results:
+        field, band = t.rsplit('.', 1)
+        note = ''
+        if status == 'ok' and os.path.exists(field + '.scal.json'):
+            with open(field + '.scal.json') as jsonf:
+                record = json.load(jsonf).get(band)
+            if record is not None and record['stopped'] is not None:
+                note = ' (stopped after %s)' % record['final']
+        print('%-24s %s%s' % (t, status, note))
+        if status not in ('ok', 'missing'):
+            nbad += 1
+    print('%d jobs, %d ok, %d missing, %d failed' %
+          (len(results), len([r for r in results if r[1] == 'ok']),
+           len([r for r in results if r[1] == 'missing']), nbad))
+    sys.exit(1 if nbad > 0 else 0)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(
+        description='Selfcal QUOCKA fields, one job per field and band')
+    ap.add_argument('fields', nargs='*',
+                    help='Field names (with <field>.<band>.pscal datasets in the current directory)')
+    ap.add_argument('-g', '--glob', action='append',
+                    help='Glob pattern of field names, matched against the .pscal datasets (may be repeated)')
+    ap.add_argument('-b', '--bands',
+                    help='Comma-separated bands to selfcal [default 2100,5500,7500]', default='2100,5500,7500')
+    ap.add_argument('-j', '--jobs', type=int,
+                    help='Number of jobs run concurrently, 0 uses every core [default 1]', default=1)
+    ap.add_argument('-a', '--adaptive', action='store_true',
+                    help='Stop selfcal once a round no longer improves the image, and only do amp selfcal on bright fields')
+    ap.add_argument('--min-gain', type=float,
+                    help='Adaptive mode: smallest fractional improvement of rms or dynamic range for selfcal to go on [default %s]' % ADAPTIVE['min_gain'],
+                    default=ADAPTIVE['min_gain'])
+    ap.add_argument('--amp-dr', type=float,
+                    help='Adaptive mode: smallest p2 dynamic range for amp selfcal [default %s]' % ADAPTIVE['amp_dr'],
+                    default=ADAPTIVE['amp_dr'])
+    ap.add_argument('--fresh-clean', action='store_true',
+                    help='Clean every diagnostic image from scratch instead of starting from the selfcal model')
+    ap.add_argument('--scratch',
+                    help='Directory for the per-job scratch directories [default .scratch]', default='.scratch')
+    ap.add_argument('--tagged-logs', action='store_true',
+                    help='Tag the MIRIAD output with its dataset and step, and also write it to <dataset>.steps.log')
+    args = ap.parse_args()
 
-    call(['maths', 'exp=<%s>' % t_restor, 'mask=<%s>.gt.%s' %
-          (t_restor, mask_level), 'out=%s' % t_mask], stdout=logf, stderr=logf)
-    shutil.rmtree(t_restor)
-    shutil.rmtree(t_model)
-    call(['mfclean', 'map=%s' % t_map, 'beam=%s' % t_beam, 'out=%s' % t_model, 'niters=1500',
-          'cutoff=%s,%s' % (clean_level, 2*sigma), 'region=mask(%s)' % t_mask], stdout=logf, stderr=logf)
-    t_ascal = t + '.ascal'
-    call(['uvaver', 'vis=%s' % t_pscal, 'out=%s' %
-          t_ascal], stdout=logf, stderr=logf)
-
-    # do the first round of amp selfcal with model generated using phase selfcal.
-    call(['selfcal', 'vis=%s' % t_ascal, 'model=%s' % t_model,
-          'interval=5', 'nfbin=1', 'options=amp,mfs'], stdout=logf, stderr=logf)
-    shutil.rmtree(t_map)
-    shutil.rmtree(t_beam)
-    shutil.rmtree(t_mask)
-    shutil.rmtree(t_model)
-
-    t_p2a1 = t + '.p2a1.fits'
-    call(['invert', 'vis=%s' % t_ascal, 'map=%s' % t_map, 'beam=%s' % t_beam, 'robust=0.5', 'stokes=i',
-          'options=mfs,double,sdb', 'imsize=2,2,beam', 'cell=5,5,res'], stdout=logf, stderr=logf)
-    call(['mfclean', 'map=%s' % t_map, 'beam=%s' % t_beam, 'out=%s' % t_model, 'niters=10000',
-          'cutoff=%s,%s' % (clean_level, 2*sigma), "region='perc(90)'"], stdout=logf, stderr=logf)
-    call(['restor', 'map=%s' % t_map, 'beam=%s' % t_beam, 'model=%s' %
-          t_model, 'out=%s' % t_restor], stdout=logf, stderr=logf)
-    call(['fits', 'op=xyout', 'in=%s' % t_restor, 'out=%s' %
-          t_p2a1], stdout=logf, stderr=logf)
-    # sigma, peak_flux = get_noise(t_p2a1)
-    # logprint("RMS of p2a1 image: %s"%sigma, logf)
-    # logprint("Peak flux density of p2a1 image: %s"%peak_flux, logf)
-    shutil.rmtree(t_map)
-    shutil.rmtree(t_beam)
-    shutil.rmtree(t_restor)
-    shutil.rmtree(t_model)
-
-logf.close()
+    main(args)
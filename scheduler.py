@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Process-pool helpers for running independent QUOCKA pipeline jobs"""
+
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+
+def get_workers(workers):
+    """Resolve a worker count from the config.
+
+    Arguments:
+        workers {int} -- Requested number of workers (0 means all cores).
+
+    Returns:
+        workers {int} -- Number of worker processes to use.
+    """
+    if workers is None or workers < 1:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def available_memory():
+    """Memory available for new work, in bytes.
+
+    Returns:
+        nbytes {int} -- MemAvailable from /proc/meminfo, or the free physical
+            memory where that isn't available.
+    """
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except (IOError, OSError, ValueError):
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+
+
+def memory_workers(job_bytes, workers=0, fraction=0.8):
+    """Number of workers that fit in the available memory.
+
+    Arguments:
+        job_bytes {int} -- Memory needed by one job, in bytes.
+
+    Keyword Arguments:
+        workers {int} -- Upper limit, 0 means all cores (default: {0})
+        fraction {float} -- Fraction of the available memory to use (default: {0.8})
+
+    Returns:
+        workers {int} -- Number of worker processes to use, at least 1.
+    """
+    fit = int(available_memory()*fraction // max(job_bytes, 1))
+    return max(1, min(get_workers(workers), fit))
+
+
+def process_pool(workers=0):
+    """Process pool for CPU-bound Python work submitted from threads.
+
+    The workers are spawned rather than forked, since forking a process that
+    runs threads (e.g. a task graph) can copy locks held by other threads.
+
+    Keyword Arguments:
+        workers {int} -- Number of worker processes, 0 means all cores
+            (default: {0})
+
+    Returns:
+        pool {ProcessPoolExecutor} -- The pool; shut it down when done.
+    """
+    return ProcessPoolExecutor(max_workers=get_workers(workers),
+                               mp_context=multiprocessing.get_context('spawn'))
+
+
+def run_jobs(func, jobs, workers=1):
+    """Run func(*job) for every job, fanning out over a process pool.
+
+    With a single worker (or a single job) everything runs in the calling
+    process, so the serial behaviour is unchanged.
+
+    Arguments:
+        func {callable} -- Picklable module-level function.
+        jobs {list} -- List of argument tuples.
+
+    Keyword Arguments:
+        workers {int} -- Number of worker processes (default: {1})
+
+    Returns:
+        results {list} -- Return values, in the same order as jobs.
+    """
+    workers = get_workers(workers)
+    if workers == 1 or len(jobs) <= 1:
+        return [func(*job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+        futures = [pool.submit(func, *job) for job in jobs]
+        return [future.result() for future in futures]
+
+
+def merge_logs(lognames, logf, remove=True):
+    """Append per-worker logs to the main log, in the given order.
+
+    Arguments:
+        lognames {list} -- Log file names, in the order they should appear.
+        logf {file} -- Open main log file.
+
+    Keyword Arguments:
+        remove {bool} -- Delete the worker logs once merged (default: {True})
+    """
+    for logname in lognames:
+        if not os.path.exists(logname):
+            continue
+        with open(logname) as wlogf:
+            shutil.copyfileobj(wlogf, logf)
+        logf.flush()
+        if remove:
+            os.remove(logname)
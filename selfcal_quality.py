@@ -5,127 +5,85 @@ from astropy.utils.data import get_pkg_data_filename
 from astropy.wcs import WCS
 import matplotlib.pyplot as plt
 import glob
+import json
+import os
 import sys
 from astropy.io import fits
 import numpy as np
 import matplotlib as mpl
+from imstats import get_noise
 mpl.use('Agg')
 
-# Get the noise of an image
-
-
-def get_noise(img_name):
-    hdu = fits.open(img_name)
-    data = hdu[0].data[0, 0]
-    rms_initial = np.std(data)
-    rms = np.std(
-        data[np.logical_and(data > -2.5*rms_initial, data < 2.5*rms_initial)])
-    peak_max = np.amax(data)
-    peak_min = np.amin(data)
-    hdu.close()
-    return rms, peak_max, peak_min
-
 
 sourcename = sys.argv[1]
 vislist = [sourcename+'.2100', sourcename+'.5500', sourcename+'.7500']
 
-for t in vislist:
-    t_p0 = t + '.p0.fits'
-    t_p1 = t + '.p1.fits'
-    t_p2 = t + '.p2.fits'
-    t_p2a1 = t + '.p2a1.fits'
-    sigma_p0, peak_max_p0, peak_min_p0 = get_noise(t_p0)
-    sigma_p1, peak_max_p1, peak_min_p1 = get_noise(t_p1)
-    sigma_p2, peak_max_p2, peak_min_p2 = get_noise(t_p2)
-    sigma_p2a1, peak_max_p2a1, peak_min_p2a1 = get_noise(t_p2a1)
-
-    mask_p0 = np.amax([10*sigma_p0, -peak_min_p0*1.5])
-    mask_p1 = np.amax([10*sigma_p1, -peak_min_p1*1.5])
-    mask_p2 = np.amax([10*sigma_p2, -peak_min_p2*1.5])
-
-    fig = plt.figure(figsize=(8, 6))
-
-    filename = t_p0
-    hdu = fits.open(filename)
-    data = hdu[0].data[0, 0]
-    centre_pix_y = int(data.shape[0]/2)
-    centre_pix_x = int(data.shape[1]/2)
-    wcs = WCS(hdu[0].header).dropaxis(3).dropaxis(2)
-    cutout = Cutout2D(hdu[0].data[0, 0], position=(
-        centre_pix_x, centre_pix_y), size=(400, 400), wcs=wcs)
-
-    ax = fig.add_subplot(2, 2, 1)
-    plt.imshow(cutout.data, vmin=-10.0*sigma_p2, vmax=30.0 *
-               sigma_p2, origin='lower', cmap='cubehelix')
-    plt.contour(cutout.data, levels=[mask_p0])
-    plt.xticks([])
-    plt.yticks([])
-    ax.set_title('mask level %s sigma \n rms %s' %
-                 (int(mask_p0/sigma_p0), sigma_p0))
-    hdu.close()
-
-    filename = t_p1
-    hdu = fits.open(filename)
-    data = hdu[0].data[0, 0]
-    centre_pix_y = int(data.shape[0]/2)
-    centre_pix_x = int(data.shape[1]/2)
-    wcs = WCS(hdu[0].header).dropaxis(3).dropaxis(2)
-    cutout = Cutout2D(hdu[0].data[0, 0], position=(
-        centre_pix_x, centre_pix_y), size=(400, 400), wcs=wcs)
-
-    ax = fig.add_subplot(2, 2, 2)
-    plt.imshow(cutout.data, vmin=-10.0*sigma_p2, vmax=30.0 *
-               sigma_p2, origin='lower', cmap='cubehelix')
-    plt.contour(cutout.data, levels=[mask_p1])
-    plt.xticks([])
-    plt.yticks([])
-    ax.set_title('mask level %s sigma \n rms %s' %
-                 (int(mask_p1/sigma_p1), sigma_p1))
-    hdu.close()
+# Selfcal decisions of run_selfcal.py (adaptive mode may stop early)
+records = {}
+if os.path.exists(sourcename+'.scal.json'):
+    with open(sourcename+'.scal.json') as jsonf:
+        records = json.load(jsonf)
 
-    filename = t_p2
-    hdu = fits.open(filename)
-    data = hdu[0].data[0, 0]
-    centre_pix_y = int(data.shape[0]/2)
-    centre_pix_x = int(data.shape[1]/2)
-    wcs = WCS(hdu[0].header).dropaxis(3).dropaxis(2)
-    cutout = Cutout2D(hdu[0].data[0, 0], position=(
-        centre_pix_x, centre_pix_y), size=(400, 400), wcs=wcs)
+# Images in the order they are made, and their panel in the figure
+stages = ['p0', 'p1', 'p2', 'p2a1']
 
-    ax = fig.add_subplot(2, 2, 3)
-    plt.imshow(cutout.data, vmin=-10.0*sigma_p2, vmax=30.0 *
-               sigma_p2, origin='lower', cmap='cubehelix')
-    plt.contour(cutout.data, levels=[mask_p2])
-    plt.xticks([])
-    plt.yticks([])
-    ax.set_title('mask level %s sigma \n rms %s' %
-                 (int(mask_p2/sigma_p2), sigma_p2))
-    hdu.close()
-
-    filename = t_p2a1
-    hdu = fits.open(filename)
-    data = hdu[0].data[0, 0]
-    centre_pix_y = int(data.shape[0]/2)
-    centre_pix_x = int(data.shape[1]/2)
-    wcs = WCS(hdu[0].header).dropaxis(3).dropaxis(2)
-    cutout = Cutout2D(hdu[0].data[0, 0], position=(
-        centre_pix_x, centre_pix_y), size=(400, 400), wcs=wcs)
+for t in vislist:
+    record = records.get(t.split('.')[-1])
+    present = [stage for stage in stages
+               if os.path.exists('%s.%s.fits' % (t, stage))]
+    if record is not None:
+        # After an early stop p2 is only a copy of the final image, and the
+        # images of rejected rounds aren't kept
+        made = [image['image'] for image in record['images']
+                if not image.get('rejected')]
+        present = [stage for stage in present if stage in made]
+    if 'p0' not in present:
+        print('%s: no selfcal images, skipping' % t)
+        continue
+    stats = dict((stage, get_noise('%s.%s.fits' % (t, stage)))
+                 for stage in present)
+    phase = [stage for stage in present if stage != 'p2a1']
+    sigma_ref = stats[phase[-1]][0]
+    sigma_p0, peak_max_p0, peak_min_p0 = stats['p0']
 
-    ax = fig.add_subplot(2, 2, 4)
-    plt.imshow(cutout.data, vmin=-10.0*sigma_p2, vmax=30.0 *
-               sigma_p2, origin='lower', cmap='cubehelix')
-    plt.xticks([])
-    plt.yticks([])
-    ax.set_title('Final rms %s' % sigma_p2a1)
-    hdu.close()
+    fig = plt.figure(figsize=(8, 6))
 
-    if sigma_p0 > sigma_p1 > sigma_p2:
-        plt.suptitle('%s: peak flux %s, min flux %s' % (
-            t, peak_max_p0, peak_min_p0), color='tab:green', fontsize=15)
+    for n, stage in enumerate(stages):
+        if stage not in stats:
+            continue
+        sigma, peak_max, peak_min = stats[stage]
+        hdu = fits.open('%s.%s.fits' % (t, stage))
+        data = hdu[0].data[0, 0]
+        centre_pix_y = int(data.shape[0]/2)
+        centre_pix_x = int(data.shape[1]/2)
+        wcs = WCS(hdu[0].header).dropaxis(3).dropaxis(2)
+        cutout = Cutout2D(hdu[0].data[0, 0], position=(
+            centre_pix_x, centre_pix_y), size=(400, 400), wcs=wcs)
+
+        ax = fig.add_subplot(2, 2, n+1)
+        plt.imshow(cutout.data, vmin=-10.0*sigma_ref, vmax=30.0 *
+                   sigma_ref, origin='lower', cmap='cubehelix')
+        plt.xticks([])
+        plt.yticks([])
+        if stage == 'p2a1':
+            ax.set_title('Final rms %s' % sigma)
+        else:
+            mask = np.amax([10*sigma, -peak_min*1.5])
+            plt.contour(cutout.data, levels=[mask])
+            ax.set_title('mask level %s sigma \n rms %s' %
+                         (int(mask/sigma), sigma))
+        hdu.close()
+
+    title = '%s: peak flux %s, min flux %s' % (t, peak_max_p0, peak_min_p0)
+    if record is not None and record['stopped'] is not None:
+        title += '\nstopped after %s' % record['final']
+    # Good if every phase selfcal round that was run lowered the rms
+    sigmas = [stats[stage][0] for stage in phase]
+    if len(sigmas) > 1 and all(a > b for a, b in zip(sigmas, sigmas[1:])):
+        plt.suptitle(title, color='tab:green', fontsize=15)
         plt.savefig('%s_0_scal_qua.png' % t, dpi=300, bbox_inches='tight')
     else:
-        plt.suptitle('%s: peak flux %s, min flux %s' %
-                     (t, peak_max_p0, peak_min_p0), color='tab:red', fontsize=15)
+        plt.suptitle(title, color='tab:red', fontsize=15)
         plt.savefig('%s_1_scal_qua.png' % t, dpi=300, bbox_inches='tight')
 
     plt.close()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""Smoothing engine for QUOCKA channel images.
+
+The images of one channel in Stokes I, Q, U and V normally share a beam, so
+they need the same convolving kernel. smooth_channel() groups the images of a
+channel by beam and convolves each group as one batched real FFT, with the
+kernel's FFT and the flux scaling factor (au2.gauss_factor) computed once per
+beam and kept in a small cache.
+
+The result is the same as scipy.signal.convolve(image, kernel, mode='same')
+on each image, which is what makecube.smooth used to do.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+import scipy.fft
+from astropy import units as u
+from astropy.io import fits
+
+import au2
+
+# Kernels kept per process. A kernel is only reused by images with the same
+# beam, which mostly means the Stokes images of one channel, so few are needed.
+CACHE_SIZE = 32
+
+_kernels = OrderedDict()
+
+
+def read_plane(filename):
+    """Read a channel image and its pixel size.
+
+    Arguments:
+        filename {str} -- FITS image.
+
+    Returns:
+        image {array} -- 2D image (float64).
+        dx {Quantity} -- Pixel size along RA.
+        dy {Quantity} -- Pixel size along Dec.
+    """
+    with fits.open(filename, memmap=True, mode='denywrite') as hdu:
+        dx = hdu[0].header['CDELT1']*-1*u.deg
+        dy = hdu[0].header['CDELT2']*u.deg
+        image = np.squeeze(hdu[0].data).astype('float64')
+    return image, dx, dy
+
+
+def kernel(old_beam, new_beam, dx, dy, shape, verbose=False):
+    """FFT of the convolving kernel and flux factor, cached.
+
+    Arguments:
+        old_beam {Beam} -- Beam of the images.
+        new_beam {Beam} -- Target resolution.
+        dx {Quantity} -- Pixel size along RA.
+        dy {Quantity} -- Pixel size along Dec.
+        shape {tuple} -- Image shape (ny, nx).
+
+    Keyword Arguments:
+        verbose {bool} -- Verbose output (default: {False})
+
+    Returns:
+        kfft {array} -- rfftn of the kernel, on the padded grid.
+        fshape {tuple} -- Padded FFT grid.
+        start {tuple} -- Offset of the 'same' output in the full convolution.
+        fac {float} -- Flux scaling factor.
+    """
+    key = (old_beam.major.to_value(u.deg), old_beam.minor.to_value(u.deg),
+           old_beam.pa.to_value(u.deg), new_beam.major.to_value(u.deg),
+           new_beam.minor.to_value(u.deg), new_beam.pa.to_value(u.deg),
+           dx.to_value(u.deg), dy.to_value(u.deg), tuple(shape))
+    if key in _kernels:
+        _kernels.move_to_end(key)
+        return _kernels[key]
+
+    con_beam = new_beam.deconvolve(old_beam)
+    fac, amp, outbmaj, outbmin, outbpa = au2.gauss_factor(
+        [
+            con_beam.major.to(u.arcsec).value,
+            con_beam.minor.to(u.arcsec).value,
+            con_beam.pa.to(u.deg).value
+        ],
+        beamOrig=[
+            old_beam.major.to(u.arcsec).value,
+            old_beam.minor.to(u.arcsec).value,
+            old_beam.pa.to(u.deg).value
+        ],
+        dx1=dx.to(u.arcsec).value,
+        dy1=dy.to(u.arcsec).value
+    )
+    if verbose:
+        print(f'Smoothing so beam is', new_beam)
+        print(f'Using convolving beam', con_beam)
+
+    gauss_kern = con_beam.as_kernel(dy)
+    conbm1 = gauss_kern.array/gauss_kern.array.max()
+    full = [n + k - 1 for n, k in zip(shape, conbm1.shape)]
+    fshape = tuple(scipy.fft.next_fast_len(n, real=True) for n in full)
+    start = tuple((k - 1)//2 for k in conbm1.shape)
+    kfft = scipy.fft.rfftn(conbm1, fshape)
+
+    _kernels[key] = (kfft, fshape, start, fac)
+    if len(_kernels) > CACHE_SIZE:
+        _kernels.popitem(last=False)
+    return _kernels[key]
+
+
+def convolve(images, old_beam, new_beam, dx, dy, workers=1, verbose=False):
+    """Smooth a stack of images sharing a beam to a new resolution.
+
+    Arguments:
+        images {array} -- Images, shape (n, ny, nx).
+        old_beam {Beam} -- Beam of the images.
+        new_beam {Beam} -- Target resolution.
+        dx {Quantity} -- Pixel size along RA.
+        dy {Quantity} -- Pixel size along Dec.
+
+    Keyword Arguments:
+        workers {int} -- Threads used by each FFT (default: {1})
+        verbose {bool} -- Verbose output (default: {False})
+
+    Returns:
+        newims {array} -- Smoothed images, shape (n, ny, nx).
+    """
+    shape = images.shape[-2:]
+    kfft, fshape, start, fac = kernel(old_beam, new_beam, dx, dy, shape,
+                                      verbose=verbose)
+    axes = (-2, -1)
+    spec = scipy.fft.rfftn(images, fshape, axes=axes, workers=workers)
+    spec *= kfft
+    full = scipy.fft.irfftn(spec, fshape, axes=axes, workers=workers)
+    newims = full[..., start[0]:start[0] + shape[0],
+                  start[1]:start[1] + shape[1]]
+    return newims*fac
+
+
+def smooth_channel(inps, new_beam, workers=1, verbose=False):
+    """Smooth the images of one channel to a new resolution.
+
+    Images with the same beam and flag are convolved together.
+
+    Arguments:
+        inps {list} -- (filename, old_beam, flag) of each image, e.g. one
+            per Stokes parameter.
+        new_beam {Beam} -- Target resolution.
+
+    Keyword Arguments:
+        workers {int} -- Threads used by each FFT (default: {1})
+        verbose {bool} -- Verbose output (default: {False})
+
+    Returns:
+        newims {list} -- Smoothed images, in the order of inps. Flagged
+            images are all NaN.
+    """
+    planes = []
+    for filename, old_beam, flag in inps:
+        if verbose:
+            print(f'Getting image data from {filename}')
+        planes.append(read_plane(filename))
+
+    newims = [None]*len(inps)
+    groups = OrderedDict()
+    for idx, ((filename, old_beam, flag), (image, dx, dy)) in enumerate(zip(inps, planes)):
+        if flag:
+            newims[idx] = np.ones_like(image)*np.nan
+            continue
+        key = (old_beam.major.to_value(u.deg), old_beam.minor.to_value(u.deg),
+               old_beam.pa.to_value(u.deg), dx.to_value(u.deg),
+               dy.to_value(u.deg), image.shape)
+        groups.setdefault(key, []).append(idx)
+
+    for idxs in groups.values():
+        old_beam = inps[idxs[0]][1]
+        dx, dy = planes[idxs[0]][1:]
+        stack = np.stack([planes[idx][0] for idx in idxs])
+        smoothed = convolve(stack, old_beam, new_beam, dx, dy,
+                            workers=workers, verbose=verbose)
+        for idx, newim in zip(idxs, smoothed):
+            newims[idx] = newim
+    return newims
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""Persistent cache of MIRIAD steps already applied to a dataset.
+
+Most calibration steps (uvflag, pgflag, mfcal, gpcal, ...) modify their
+visibility dataset in place, so a step can't be recognised from the
+dataset contents alone. Instead the cache keeps, for every dataset, the
+chain of steps applied to it since it was created. Each link is keyed by the
+task name, its parameters, the fingerprint of any other dataset it reads
+(e.g. the primary for gpcopy/gpboot) and the previous link. On a re-run a
+step is skipped when its key matches the recorded chain at the same position
+and the dataset still has the fingerprint recorded after the last step.
+Changing any parameter re-runs that step and everything after it.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import threading
+
+from instrument import call
+
+
+def fingerprint(vis):
+    """Fingerprint a MIRIAD dataset from the names, sizes and mtimes of its items.
+
+    Arguments:
+        vis {str} -- Dataset directory (or file).
+
+    Returns:
+        fp {str} -- Hex digest, or None if the dataset doesn't exist.
+    """
+    if not os.path.exists(vis):
+        return None
+    sha = hashlib.sha1()
+    if os.path.isdir(vis):
+        entries = sorted(os.scandir(vis), key=lambda entry: entry.name)
+        for entry in entries:
+            st = entry.stat()
+            sha.update(('%s:%d:%d;' % (entry.name, st.st_size,
+                                       st.st_mtime_ns)).encode())
+    else:
+        st = os.stat(vis)
+        sha.update(('%d:%d' % (st.st_size, st.st_mtime_ns)).encode())
+    return sha.hexdigest()
+
+
+class StepCache(object):
+    """Skip MIRIAD steps that were already applied to an unchanged dataset."""
+
+    def __init__(self, path='.stepcache.json'):
+        """
+        Keyword Arguments:
+            path {str} -- JSON file holding the cache (default: {'.stepcache.json'})
+        """
+        self.path = path
+        self.entries = self._read()
+        self._cursor = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as cachef:
+            try:
+                return json.load(cachef)
+            except ValueError:
+                return {}
+
+    def save(self):
+        """Write the entries touched by this process back to disk.
+
+        Several processes may share the cache file, so merge under a lock.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            with open(self.path + '.lock', 'w') as lockf:
+                fcntl.flock(lockf, fcntl.LOCK_EX)
+                entries = self._read()
+                for vis in self._dirty:
+                    entries[vis] = self.entries[vis]
+                tmpname = '%s.%d.tmp' % (self.path, os.getpid())
+                with open(tmpname, 'w') as cachef:
+                    json.dump(entries, cachef, indent=1, sort_keys=True)
+                os.replace(tmpname, self.path)
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+            self._dirty = set()
+
+    def key(self, args, vis, deps=()):
+        """Key of the next step on vis, chained to the previous step of this run."""
+        applied = self._cursor.get(vis, [])
+        prev = applied[-1] if applied else self.entries[vis]['base']
+        sha = hashlib.sha1(prev.encode())
+        sha.update('\0'.join(args).encode())
+        for dep in deps:
+            sha.update(('\0%s=%s' % (dep, fingerprint(dep))).encode())
+        return sha.hexdigest()
+
+    def call(self, args, vis, logf, deps=(), runner=None):
+        """Run a MIRIAD task modifying vis, unless it was already applied.
+
+        Arguments:
+            args {list} -- Command line, e.g. ['gpcal', 'vis=...', 'interval=0.1'].
+            vis {str or list} -- Dataset(s) modified by the task. A task
+                modifying several datasets is skipped only if it was applied
+                to all of them.
+            logf {file} -- Log file for the task output.
+
+        Keyword Arguments:
+            deps {list} -- Other datasets the task reads (default: {()})
+            runner {callable} -- Called as runner(args, logf) to run the task
+                instead of subprocess.call (default: {None})
+
+        Returns:
+            ret {int} -- Exit status (0 if skipped).
+        """
+        vislist = [vis] if isinstance(vis, str) else list(vis)
+        todo = []
+        with self._lock:
+            for ds in vislist:
+                fp = fingerprint(ds)
+                state = self.entries.get(ds)
+                if state is None or (ds not in self._cursor and state['fingerprint'] != fp):
+                    # New dataset, or changed outside the cache: start a new chain
+                    state = {'base': fp or '', 'steps': [], 'fingerprint': fp}
+                    self.entries[ds] = state
+                key = self.key(args, ds, deps)
+                applied = self._cursor.setdefault(ds, [])
+                pos = len(applied)
+                steps = state['steps']
+                done = (fp == state['fingerprint'] and pos < len(steps)
+                        and steps[pos] == key)
+                todo.append((ds, state, key, pos, done))
+            skip = all(item[4] for item in todo)
+            if skip:
+                for ds, state, key, pos, done in todo:
+                    self._cursor[ds].append(key)
+        if skip:
+            msg = 'Skipping %s on %s: already applied' % (args[0], ','.join(vislist))
+            if logf is not None:
+                print(msg, file=logf)
+            print(msg)
+            return 0
+        if runner is None:
+            ret = call(args, stdout=logf, stderr=logf)
+        else:
+            ret = runner(args, logf)
+        with self._lock:
+            for ds, state, key, pos, done in todo:
+                del state['steps'][pos:]
+                if not ret:
+                    state['steps'].append(key)
+                    state['fingerprint'] = fingerprint(ds)
+                    self._cursor[ds].append(key)
+                else:
+                    # A failed step leaves the dataset in an unknown state
+                    state['fingerprint'] = None
+                self._dirty.add(ds)
+        self.save()
+        return ret
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""Vectorised SumThreshold RFI flagger.
+
+This is an in-process replacement for the automatic pgflag passes used by
+run_cal.py. The visibilities of a MIRIAD dataset are read once, every
+flagging pass is applied to the time x channel plane of each baseline and
+spectral window with NumPy, and the flags are written back to the flags item
+of the dataset in one go (see miriaduv.py).
+
+A pass is described by the Stokes parameter to flag on and the pgflag-style
+flagpar list:
+
+    flagpar = [threshold, chan_kernel, time_kernel, niter, nwin, dilation]
+
+threshold -- SumThreshold threshold for a single sample, in robust sigma.
+chan_kernel, time_kernel -- Gaussian smoothing widths (samples) used to
+    estimate the background.
+niter -- Number of background/flag iterations.
+nwin -- Number of SumThreshold window sizes (1, 2, 4, ... 2**(nwin-1)).
+dilation -- Number of samples the final flags are grown by in each direction.
+"""
+
+import numpy as np
+from scipy import ndimage
+
+from miriaduv import read_flags, read_uv, write_flags
+
+# AIPS/FITS Stokes codes
+STOKES_CODES = {1: 'i', 2: 'q', 3: 'u', 4: 'v',
+                -1: 'rr', -2: 'll', -3: 'rl', -4: 'lr',
+                -5: 'xx', -6: 'yy', -7: 'xy', -8: 'yx'}
+
+# Threshold reduction between successive window sizes
+RHO = 1.5
+
+
+def _window_flags(vals, win, chi):
+    """Flag every sample covered by a window of `win` samples whose sum exceeds win*chi.
+
+    Arguments:
+        vals {array} -- (..., n) array, windows run along the last axis.
+        win {int} -- Window size.
+        chi {float} -- Per-sample threshold.
+
+    Returns:
+        flags {array} -- Boolean (..., n) array.
+    """
+    n = vals.shape[-1]
+    csum = np.concatenate([np.zeros(vals.shape[:-1] + (1,)),
+                           np.cumsum(vals, axis=-1)], axis=-1)
+    hits = (csum[..., win:] - csum[..., :-win]) > win*chi
+    # Number of triggered windows starting at or before each position
+    chits = np.concatenate([np.zeros(hits.shape[:-1] + (1,), dtype=int),
+                            np.cumsum(hits, axis=-1)], axis=-1)
+    nstart = n - win + 1
+    pos = np.arange(n)
+    lo = np.clip(pos - win + 1, 0, nstart)
+    hi = np.clip(pos + 1, 0, nstart)
+    return (chits[..., hi] - chits[..., lo]) > 0
+
+
+def sumthreshold(res, flags, threshold, nwin, axis=-1):
+    """SumThreshold along one axis.
+
+    Flagged samples are replaced by the current threshold, so they neither
+    hide nor trigger neighbouring RFI.
+
+    Arguments:
+        res {array} -- Normalised residual amplitudes (amplitude minus
+            background, in robust sigma).
+        flags {array} -- Boolean flags (True = bad).
+        threshold {float} -- Threshold for a single sample.
+        nwin {int} -- Number of window sizes.
+
+    Keyword Arguments:
+        axis {int} -- Axis along which the windows run (default: {-1})
+
+    Returns:
+        flags {array} -- Updated flags.
+    """
+    res = np.moveaxis(res, axis, -1)
+    flags = np.moveaxis(flags, axis, -1).copy()
+    for k in range(nwin):
+        win = 2**k
+        if win > res.shape[-1]:
+            break
+        chi = threshold / RHO**k
+        vals = np.where(flags, chi, res)
+        flags |= _window_flags(vals, win, chi)
+    return np.moveaxis(flags, -1, axis)
+
+
+def flag_plane(amp, flags, flagpar):
+    """Flag a (..., time, channel) stack of amplitude planes.
+
+    Arguments:
+        amp {array} -- Amplitudes, shape (..., ntime, nchan).
+        flags {array} -- Boolean flags (True = bad), same shape.
+        flagpar {list} -- See module docstring.
+
+    Returns:
+        flags {array} -- Updated flags.
+    """
+    threshold, chan_kernel, time_kernel, niter, nwin, dilation = flagpar[:6]
+    sigma = [0]*(amp.ndim - 2) + [time_kernel, chan_kernel]
+    prior = flags
+    flags = flags.copy()
+    for _ in range(int(niter)):
+        good = (~flags).astype(float)
+        # Normalised convolution, so flagged samples don't bias the background
+        num = ndimage.gaussian_filter(np.where(flags, 0, amp), sigma)
+        den = ndimage.gaussian_filter(good, sigma)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            background = num / den
+        # Only excess power is RFI
+        res = amp - np.nan_to_num(background)
+        if not np.any(good):
+            break
+        mad = np.median(np.abs(res[~flags] - np.median(res[~flags])))
+        rms = 1.4826*mad
+        if rms == 0:
+            break
+        res /= rms
+        flags = sumthreshold(res, flags, threshold, int(nwin), axis=-1)
+        flags = sumthreshold(res, flags, threshold, int(nwin), axis=-2)
+    if dilation > 0:
+        structure = np.zeros([1]*(amp.ndim - 2) + [3, 3], dtype=bool)
+        structure[..., 1, :] = True
+        structure[..., :, 1] = True
+        # Only grow the flags found by this pass, as a separate pgflag call would
+        flags = prior | ndimage.binary_dilation(flags & ~prior, structure=structure,
+                                                iterations=int(dilation))
+    return flags
+
+
+def stokes_amplitude(vis, codes, stokes):
+    """Amplitude of a Stokes parameter from the correlations present.
+
+    Arguments:
+        vis {array} -- Complex visibilities, shape (..., nstokes).
+        codes {list} -- Polarization name of each correlation.
+        stokes {str} -- One of i, q, u, v, or a correlation name.
+
+    Returns:
+        amp {array} -- Amplitudes, shape (...).
+    """
+    idx = dict((code, i) for i, code in enumerate(codes))
+    if stokes in idx:
+        return np.abs(vis[..., idx[stokes]])
+    if all(p in idx for p in ('xx', 'yy', 'xy', 'yx')):
+        xx, yy = vis[..., idx['xx']], vis[..., idx['yy']]
+        xy, yx = vis[..., idx['xy']], vis[..., idx['yx']]
+        comb = {'i': (xx + yy)/2, 'q': (xx - yy)/2,
+                'u': (xy + yx)/2, 'v': (xy - yx)/2j}
+    elif all(p in idx for p in ('rr', 'll', 'rl', 'lr')):
+        rr, ll = vis[..., idx['rr']], vis[..., idx['ll']]
+        rl, lr = vis[..., idx['rl']], vis[..., idx['lr']]
+        comb = {'i': (rr + ll)/2, 'v': (rr - ll)/2,
+                'q': (rl + lr)/2, 'u': (rl - lr)/2j}
+    else:
+        raise ValueError('Cannot form Stokes %s from %s' %
+                         (stokes, ','.join(codes)))
+    return np.abs(comb[stokes])
+
+
+def _windows(nschan, nchan):
+    """Channel slices of the spectral windows of a record."""
+    if nschan is None:
+        return [slice(0, nchan)]
+    nschan = np.atleast_1d(nschan)
+    if nschan.sum() != nchan:
+        return [slice(0, nchan)]
+    edges = np.concatenate([[0], np.cumsum(nschan)])
+    return [slice(int(lo), int(hi)) for lo, hi in zip(edges[:-1], edges[1:])]
+
+
+def flag_miriad(vis, passes, verbose=False):
+    """Flag a MIRIAD dataset in place.
+
+    The visibilities are read once, all passes are applied per baseline and
+    spectral window, and the new flags are written to the flags item of the
+    dataset. Nothing else in the dataset is touched.
+
+    Arguments:
+        vis {str} -- MIRIAD dataset.
+        passes {list} -- List of (stokes, flagpar) passes, applied in order.
+
+    Keyword Arguments:
+        verbose {bool} -- Verbose output (default: {False})
+
+    Returns:
+        nflag {int} -- Number of newly flagged correlations.
+    """
+    corr, values, offsets = read_uv(vis, names=('time', 'baseline', 'pol', 'nschan'))
+    if len(corr) == 0:
+        return 0
+    nchan = corr.shape[1]
+    prior = read_flags(vis, offsets, nchan)
+    times = np.array(values['time'])
+    baselines = np.array(values['baseline'])
+    pols = np.array([STOKES_CODES.get(pol, 'i') if pol is not None else 'i'
+                     for pol in values['pol']])
+    codes = sorted(set(pols), key=lambda code: list(STOKES_CODES.values()).index(code))
+    ipol = np.array([codes.index(pol) for pol in pols])
+    windows = _windows(values['nschan'][0], nchan)
+
+    newflags = np.zeros(prior.shape, dtype=bool)
+    for bl in np.unique(baselines):
+        rows = np.where(baselines == bl)[0]
+        btimes, itime = np.unique(times[rows], return_inverse=True)
+        # (time, channel, polarization) cube, missing correlations are flagged
+        cube = np.zeros((len(btimes), nchan, len(codes)), dtype=np.complex64)
+        missing = np.ones(cube.shape, dtype=bool)
+        cube[itime, :, ipol[rows]] = corr[rows]
+        missing[itime, :, ipol[rows]] = prior[rows]
+        # Any flagged correlation flags the sample for every polarization
+        flags = np.any(missing, axis=-1)
+        for win in windows:
+            for stokes, flagpar in passes:
+                amp = stokes_amplitude(cube[:, win], codes, stokes)
+                flags[:, win] = flag_plane(amp, flags[:, win], flagpar)
+        newflags[rows] = flags[itime]
+        if verbose:
+            print('Baseline %d: flagged %.1f%%' %
+                  (bl, 100.0*flags.sum()/flags.size))
+    return write_flags(vis, offsets, newflags & ~prior)
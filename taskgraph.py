@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+"""Small dependency-graph runner for MIRIAD pipeline steps.
+
+Each task declares the datasets it reads (inputs), the datasets it creates
+(outputs) and the datasets it modifies in place (updates, e.g. pgflag or
+gpcopy). Dependencies are derived from those declarations in the order the
+tasks are added, so independent branches (different targets, different
+bands) run concurrently while steps touching the same dataset stay ordered.
+
+A task is skipped when it is up to date: its outputs exist and it finished
+(stamp file, or the outputs themselves) more recently than anything it reads.
+Changes to a dataset updated in place by later tasks are checked by the last
+of those tasks.
+"""
+
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from instrument import call
+
+
+def dataset_mtime(path):
+    """Modification time of a file or MIRIAD dataset.
+
+    MIRIAD tasks rewrite items (flags, gains, ...) inside the dataset directory
+    without touching the directory entry, so look at the items as well.
+
+    Arguments:
+        path {str} -- File or dataset directory.
+
+    Returns:
+        mtime {float} -- Latest modification time, or None if missing.
+    """
+    if not os.path.exists(path):
+        return None
+    mtime = os.path.getmtime(path)
+    if os.path.isdir(path):
+        for entry in os.scandir(path):
+            mtime = max(mtime, entry.stat().st_mtime)
+    return mtime
+
+
+class Task(object):
+    """A single pipeline step."""
+
+    def __init__(self, name, args=None, func=None, inputs=(), outputs=(),
+                 updates=(), log=None, force=False):
+        """
+        Arguments:
+            name {str} -- Unique task name (used for the stamp file).
+
+        Keyword Arguments:
+            args {list} -- Command line to run (default: {None})
+            func {callable} -- Python callable taking the open log file,
+                used instead of args (default: {None})
+            inputs {list} -- Datasets read by the task (default: {()})
+            outputs {list} -- Datasets created by the task (default: {()})
+            updates {list} -- Datasets modified in place (default: {()})
+            log {str or file} -- Log file (name or open file) for the task
+                output (default: {None})
+            force {bool} -- Always run the task (default: {False})
+        """
+        self.name = name
+        self.args = args
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.updates = list(updates)
+        self.log = log
+        self.force = force
+        self.deps = []
+        self.status = None
+
+    def __repr__(self):
+        return 'Task(%s)' % self.name
+
+    def execute(self):
+        """Run the task, returning True on success."""
+        if isinstance(self.log, str):
+            logf = open(self.log, 'a', 1)
+        else:
+            logf = self.log
+        try:
+            if self.func is not None:
+                ret = self.func(logf)
+            else:
+                ret = call(self.args, stdout=logf, stderr=logf)
+        finally:
+            if isinstance(self.log, str):
+                logf.close()
+        return not ret
+
+
+class TaskGraph(object):
+    """Collection of tasks with dependencies inferred from their datasets."""
+
+    def __init__(self, stampdir='.taskgraph', workers=1, logf=None):
+        """
+        Keyword Arguments:
+            stampdir {str} -- Directory holding the completion stamps
+                (default: {'.taskgraph'})
+            workers {int} -- Number of tasks run concurrently (default: {1})
+            logf {file} -- Log for the scheduling messages (default: {None})
+        """
+        self.stampdir = stampdir
+        self.workers = max(1, workers)
+        self.logf = logf
+        self.tasks = []
+        self._names = set()
+        self._writer = {}
+        self._readers = {}
+
+    def add(self, name, **kwargs):
+        """Add a task. See Task for the keyword arguments.
+
+        Returns:
+            task {Task} -- The new task.
+        """
+        if name in self._names:
+            raise ValueError('Duplicate task name %s' % name)
+        task = Task(name, **kwargs)
+        deps = []
+        for ds in task.inputs:
+            if ds in self._writer:
+                deps.append(self._writer[ds])
+        for ds in task.outputs + task.updates:
+            if ds in self._writer:
+                deps.append(self._writer[ds])
+            # Don't overwrite a dataset before its earlier readers are done
+            deps.extend(self._readers.get(ds, []))
+        for ds in task.inputs:
+            self._readers.setdefault(ds, []).append(task)
+        for ds in task.outputs + task.updates:
+            self._writer[ds] = task
+            self._readers[ds] = []
+        task.deps = [dep for i, dep in enumerate(deps)
+                     if dep not in deps[:i] and dep is not task]
+        self.tasks.append(task)
+        self._names.add(name)
+        return task
+
+    def _stamp(self, task):
+        return os.path.join(self.stampdir, task.name + '.done')
+
+    def _log(self, s2p):
+        if self.logf is not None:
+            print(s2p, file=self.logf)
+        print(s2p)
+
+    def _updated_later(self, task, ds, done):
+        """Check whether later tasks account for the changes to ds since task.
+
+        In-place steps on one dataset (gpcopy, then the flagging passes) all
+        touch it after the first one finished, so its mtime says nothing about
+        the earlier steps. They are fine as long as the last task writing the
+        dataset finished after them; if it hasn't finished yet it runs again
+        anyway, and checks the dataset itself.
+        """
+        later = [other for other in self.tasks[self.tasks.index(task) + 1:]
+                 if ds in other.outputs + other.updates]
+        if len(later) == 0:
+            return False
+        stamp = self._stamp(later[-1])
+        return not os.path.exists(stamp) or os.path.getmtime(stamp) >= done
+
+    def uptodate(self, task):
+        """Check whether a task can be skipped."""
+        if task.force or any(dep.status == 'ran' for dep in task.deps):
+            return False
+        if not all(os.path.exists(ds) for ds in task.outputs + task.updates):
+            return False
+        stamp = self._stamp(task)
+        if os.path.exists(stamp):
+            done = os.path.getmtime(stamp)
+        elif len(task.outputs) > 0:
+            done = min(dataset_mtime(ds) for ds in task.outputs)
+        else:
+            return False
+        produced = set()
+        for dep in task.deps:
+            produced.update(dep.outputs + dep.updates)
+            depstamp = self._stamp(dep)
+            if os.path.exists(depstamp) and os.path.getmtime(depstamp) > done:
+                return False
+        for ds in task.inputs + task.updates:
+            if ds in produced:
+                continue
+            if ds in task.updates and self._updated_later(task, ds, done):
+                continue
+            mtime = dataset_mtime(ds)
+            if mtime is None or mtime > done:
+                return False
+        return True
+
+    def _run_task(self, task):
+        if self.uptodate(task):
+            return 'skipped'
+        # Outputs are created from scratch; MIRIAD refuses to overwrite them
+        for ds in task.outputs:
+            if ds in task.inputs or ds in task.updates:
+                continue
+            if os.path.isdir(ds):
+                shutil.rmtree(ds)
+            elif os.path.exists(ds):
+                os.remove(ds)
+        if not task.execute():
+            return 'failed'
+        with open(self._stamp(task), 'w') as stampf:
+            stampf.write('%s\n' % time.ctime())
+        return 'ran'
+
+    def run(self):
+        """Run every task, concurrently where the dependencies allow.
+
+        A failed task doesn't stop independent branches, but everything that
+        depends on it is marked as blocked.
+
+        Returns:
+            ok {bool} -- True if no task failed or was blocked.
+        """
+        if not os.path.exists(self.stampdir):
+            os.makedirs(self.stampdir)
+        pending = list(self.tasks)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                for task in list(pending):
+                    if any(dep.status in ('failed', 'blocked') for dep in task.deps):
+                        task.status = 'blocked'
+                        self._log('Not running %s: a dependency failed' %
+                                  task.name)
+                        pending.remove(task)
+                    elif all(dep.status in ('ran', 'skipped') for dep in task.deps):
+                        pending.remove(task)
+                        running[pool.submit(self._run_task, task)] = task
+                if not running:
+                    continue
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    task.status = future.result()
+                    if task.status == 'skipped':
+                        self._log('Skipping %s: up to date' % task.name)
+                    elif task.status == 'failed':
+                        self._log('Task %s failed' % task.name)
+        return all(task.status in ('ran', 'skipped') for task in self.tasks)
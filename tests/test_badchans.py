@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+
+import badchans
+import miriaduv
+from test_miriaduv import make_records, write_dataset
+
+
+def write_badchans(tmpdir):
+    tmpdir.join('badchans_2100.txt').write('1-10\n20-30\n25-32\n')
+    return str(tmpdir)
+
+
+def test_read_badchans(tmpdir):
+    assert badchans.read_badchans(os.path.join(write_badchans(tmpdir), 'badchans_2100.txt')) == \
+        [(1, 10), (20, 32)]
+
+
+def test_flag_badchans_counts(tmpdir):
+    vislist = []
+    prior = []
+    for name in ('a.2100', 'b.2100'):
+        vis = str(tmpdir.join(name))
+        records = make_records(ntime=2)
+        write_dataset(vis, records)
+        prior.append(~np.array([rec[4] for rec in records]))
+        vislist.append(vis)
+    ret, counts = badchans.flag_badchans(vislist, '2100', None,
+                                         badchans_dir=write_badchans(tmpdir))
+    assert ret == 0
+    assert counts == {(1, 10): sum(int((~p[:, 0:10]).sum()) for p in prior),
+                      (20, 32): sum(int((~p[:, 19:32]).sum()) for p in prior)}
+    for vis, p in zip(vislist, prior):
+        offsets, nchan = miriaduv.read_layout(vis)
+        flags = miriaduv.read_flags(vis, offsets, nchan)
+        assert np.all(flags[:, 0:10]) and np.all(flags[:, 19:32])
+        # The other channels keep their flags
+        assert np.array_equal(flags[:, 10:19], p[:, 10:19])
+        assert np.array_equal(flags[:, 32:], p[:, 32:])
+
+
+def test_flag_badchans_failure(tmpdir):
+    vis = str(tmpdir.join('b.2100'))
+    write_dataset(vis, make_records(ntime=2))
+    ret, counts = badchans.flag_badchans([str(tmpdir.join('a.2100')), vis], '2100', None,
+                                         badchans_dir=write_badchans(tmpdir))
+    assert ret != 0
+    # The missing dataset isn't counted, the other one is still flagged
+    offsets, nchan = miriaduv.read_layout(vis)
+    assert np.all(miriaduv.read_flags(vis, offsets, nchan)[:, 0:10])
+    assert counts[(1, 10)] > 0
@@ -0,0 +1,130 @@
+import os
+
+import numpy as np
+
+import miriaduv
+from sumthreshold import flag_miriad
+
+
+def _update(var, code, payload=b'', align=4):
+    entry = bytes([var, 0, code, 0])
+    entry += b'\0'*(align - len(entry)) + payload
+    return entry + b'\0'*(-len(entry) % 8)
+
+
+def write_dataset(vis, records, nschan=None):
+    """Write a MIRIAD dataset from (time, baseline, pol, data, good) records,
+    data as real pairs and the flags bit-packed, as uvwrite does."""
+    os.makedirs(vis)
+    names = [('corr', 'r'), ('nschan', 'i'), ('pol', 'i'), ('coord', 'd'),
+             ('time', 'd'), ('baseline', 'r')]
+    with open(os.path.join(vis, 'vartable'), 'w') as tablef:
+        tablef.write(''.join('%s %s\n' % (vtype, name) for name, vtype in names))
+    stream = b''
+    if nschan is not None:
+        value = np.array(nschan, dtype='>i4').tobytes()
+        stream += _update(1, 0, np.array([len(value)], dtype='>i4').tobytes())
+        stream += _update(1, 1, value)
+    nchan = len(records[0][3])
+    stream += _update(0, 0, np.array([8*nchan], dtype='>i4').tobytes())
+    for var, size in [(2, 4), (3, 16), (4, 8), (5, 4)]:
+        stream += _update(var, 0, np.array([size], dtype='>i4').tobytes())
+    good = []
+    for time, baseline, pol, data, flags in records:
+        stream += _update(2, 1, np.array([pol], dtype='>i4').tobytes())
+        pairs = np.empty(2*nchan, dtype='>f4')
+        pairs[0::2], pairs[1::2] = data.real, data.imag
+        stream += _update(0, 1, pairs.tobytes())
+        stream += _update(3, 1, np.zeros(2, dtype='>f8').tobytes(), align=8)
+        stream += _update(4, 1, np.array([time], dtype='>f8').tobytes(), align=8)
+        stream += _update(5, 1, np.array([baseline], dtype='>f4').tobytes())
+        stream += _update(0, 2)
+        good.extend(flags)
+    with open(os.path.join(vis, 'visdata'), 'wb') as visf:
+        visf.write(stream)
+    with open(os.path.join(vis, 'header'), 'wb') as headf:
+        headf.write(b'')
+    pos = np.arange(len(good)) + miriaduv.FLAG_OFFSET
+    words = np.zeros(pos[-1]//miriaduv.BITS_PER_INT + 1, dtype=np.int64)
+    np.add.at(words, pos//miriaduv.BITS_PER_INT,
+              np.where(good, 1 << (pos % miriaduv.BITS_PER_INT), 0))
+    words[0] = 2
+    words.astype('>i4').tofile(os.path.join(vis, 'flags'))
+
+
+def make_records(ntime=40, nchan=64, seed=0):
+    rng = np.random.default_rng(seed)
+    records = []
+    for it in range(ntime):
+        for baseline in (258, 259, 515):
+            for pol in (-5, -6, -7, -8):
+                scale = 10 if pol > -7 else 1
+                data = scale*(rng.normal(size=nchan) + 1j*rng.normal(size=nchan))
+                good = rng.uniform(size=nchan) > 0.05
+                records.append((2459000.5 + it/8640., baseline, pol, data, good))
+    return records
+
+
+def test_read_uv(tmpdir):
+    vis = str(tmpdir.join('test.uv'))
+    records = make_records(ntime=3)
+    write_dataset(vis, records)
+    corr, values, offsets = miriaduv.read_uv(vis)
+    assert corr.shape == (len(records), 64)
+    assert values['pol'] == [rec[2] for rec in records]
+    assert values['baseline'] == [rec[1] for rec in records]
+    assert np.allclose(values['time'], [rec[0] for rec in records])
+    assert np.allclose(corr, [rec[3] for rec in records], atol=1e-5)
+    flags = miriaduv.read_flags(vis, offsets, 64)
+    assert np.array_equal(~flags, [rec[4] for rec in records])
+
+
+def test_write_flags_only_adds(tmpdir):
+    vis = str(tmpdir.join('test.uv'))
+    records = make_records(ntime=3)
+    write_dataset(vis, records)
+    visdata = open(os.path.join(vis, 'visdata'), 'rb').read()
+    corr, values, offsets = miriaduv.read_uv(vis)
+    prior = miriaduv.read_flags(vis, offsets, 64)
+    new = np.zeros(prior.shape, dtype=bool)
+    new[:, 10:20] = True
+    nflag = miriaduv.write_flags(vis, offsets, new)
+    assert nflag == (new & ~prior).sum()
+    flags = miriaduv.read_flags(vis, offsets, 64)
+    assert np.array_equal(flags, prior | new)
+    # The visibilities are left alone
+    assert open(os.path.join(vis, 'visdata'), 'rb').read() == visdata
+
+
+def test_write_flags_creates_item(tmpdir):
+    vis = str(tmpdir.join('test.uv'))
+    write_dataset(vis, make_records(ntime=2))
+    os.remove(os.path.join(vis, 'flags'))
+    corr, values, offsets = miriaduv.read_uv(vis)
+    assert not miriaduv.read_flags(vis, offsets, 64).any()
+    new = np.zeros(corr.shape, dtype=bool)
+    new[::3, 5] = True
+    assert miriaduv.write_flags(vis, offsets, new) == new.sum()
+    assert np.array_equal(miriaduv.read_flags(vis, offsets, 64), new)
+
+
+def test_flag_miriad(tmpdir):
+    vis = str(tmpdir.join('test.uv'))
+    records = make_records()
+    # Narrow-band RFI on one baseline, in the second spectral window
+    for time, baseline, pol, data, good in records:
+        if baseline == 259:
+            data[40] += 200
+    write_dataset(vis, records, nschan=[32, 32])
+    corr, values, offsets = miriaduv.read_uv(vis)
+    prior = miriaduv.read_flags(vis, offsets, 64)
+    nflag = flag_miriad(vis, [('xx', (8, 2, 2, 3, 6, 0))])
+    flags = miriaduv.read_flags(vis, offsets, 64)
+    baselines = np.array(values['baseline'])
+    assert nflag == (flags & ~prior).sum()
+    assert np.all(flags[baselines == 259, 40])
+    assert np.all(flags[prior])
+    # Any flagged polarization flags the sample for all of them
+    assert flags[baselines == 258].reshape(40, 4, 64).any(axis=1).sum() == \
+        flags[baselines == 258].reshape(40, 4, 64).all(axis=1).sum()
+    assert flags[baselines == 515].mean() < 0.5
@@ -0,0 +1,120 @@
+import json
+import os
+
+import numpy as np
+
+import run_selfcal
+
+
+def test_improvement():
+    prev = {'rms': 2.0, 'dr': 50.0}
+    assert run_selfcal.improvement(prev, {'rms': 1.0, 'dr': 60.0}) == 0.5
+    assert run_selfcal.improvement(prev, {'rms': 2.0, 'dr': 75.0}) == 0.5
+    assert run_selfcal.improvement(prev, {'rms': 3.0, 'dr': 25.0}) == -0.5
+
+
+def test_improvement_guards():
+    # Blank previous image: only the dynamic range can be compared
+    assert run_selfcal.improvement({'rms': 0.0, 'dr': 0.5},
+                                   {'rms': 1.0, 'dr': 1.0}) == 1.0
+    assert run_selfcal.improvement({'rms': 0.0, 'dr': 0.0},
+                                   {'rms': 1.0, 'dr': 10.0}) == 0.0
+    assert run_selfcal.improvement({'rms': 1.0, 'dr': 10.0},
+                                   {'rms': np.nan, 'dr': np.nan}) == 0.0
+    assert run_selfcal.dynamic_range(1.0, 0.0) == 0.0
+
+
+class FakePlan(object):
+    """ImagingPlan whose images have the given (rms, peak), and whose selfcal
+    writes a new gains item."""
+
+    def __init__(self, t, logf, scratch='.', reuse_model=True):
+        self.t = t
+        self.tmp = {'map': os.path.join(scratch, 'map')}
+        self.stats = list(FakePlan.stats)
+        self.rounds = 0
+
+    def invert(self, vis):
+        pass
+
+    def pin(self, fits_name):
+        pass
+
+    def remove(self, *names):
+        pass
+
+    def image(self, fits_out, clean_level, sigma):
+        rms, peak = self.stats.pop(0)
+        with open(fits_out, 'w') as fitsf:
+            fitsf.write('%s %s\n' % (rms, peak))
+        return rms, peak, -rms
+
+    def selfcal(self, vis, sigma, peak_min, interval, options):
+        self.rounds += 1
+        for item in ('header', 'gains'):
+            with open(os.path.join(vis, item), 'w') as itemf:
+                itemf.write('round %d\n' % self.rounds)
+        return 5.0*sigma
+
+
+def run_fake_selfcal(tmpdir, monkeypatch, stats):
+    monkeypatch.chdir(str(tmpdir))
+    monkeypatch.setattr(run_selfcal, 'ImagingPlan', FakePlan)
+    monkeypatch.setattr(run_selfcal, 'run_task', lambda args, vis, logf: 0)
+    monkeypatch.setattr(run_selfcal, 'get_noise', lambda name: (2.0, 10.0, -2.0))
+    FakePlan.stats = stats
+    t = 'field.2100'
+    os.makedirs(t + '.pscal')
+    with open(os.path.join(t + '.pscal', 'header'), 'w') as itemf:
+        itemf.write('original\n')
+    os.makedirs('scratch')
+    with open(t + '.scal.log', 'w') as logf:
+        record = run_selfcal.selfcal(t, logf, 'scratch', dict(run_selfcal.ADAPTIVE))
+    return t, record
+
+
+def test_adaptive_restores_gains(tmpdir, monkeypatch):
+    # p1 improves on p0, p2 makes the image worse
+    t, record = run_fake_selfcal(tmpdir, monkeypatch,
+                                 [(1.0, 50.0), (0.5, 50.0), (0.8, 40.0)])
+    assert record['final'] == 'p1'
+    assert record['images'][-1]['rejected']
+    # The gains of p1 are back, and p2.fits is the p1 image
+    with open(os.path.join(t + '.pscal', 'gains')) as itemf:
+        assert itemf.read() == 'round 1\n'
+    with open(t + '.p2.fits') as fitsf:
+        assert fitsf.read() == '0.5 50.0\n'
+    assert os.listdir('scratch') == []
+
+
+def test_adaptive_rejected_image_matches_files(tmpdir, monkeypatch):
+    t, record = run_fake_selfcal(tmpdir, monkeypatch,
+                                 [(1.0, 50.0), (0.5, 50.0), (0.8, 40.0)])
+    with open(t + '.scal.json') as jsonf:
+        saved = json.load(jsonf)
+    assert saved['final'] == 'p1'
+    # Every image kept in the record is on disk with the recorded stats
+    for image in saved['images']:
+        if image.get('rejected'):
+            continue
+        with open('%s.%s.fits' % (t, image['image'])) as fitsf:
+            assert fitsf.read() == '%s %s\n' % (image['rms'], image['peak'])
+    # The rejected p2 is set aside, and p2.fits is the final p1 image
+    rejected = [image for image in saved['images'] if image.get('rejected')]
+    assert [image['image'] for image in rejected] == ['p2']
+    with open(t + '.p2.rejected.fits') as fitsf:
+        assert fitsf.read() == '%s %s\n' % (rejected[0]['rms'], rejected[0]['peak'])
+    with open(t + '.p2.fits') as fitsf:
+        assert fitsf.read() == '0.5 50.0\n'
+
+
+def test_adaptive_restores_missing_gains(tmpdir, monkeypatch):
+    # p1 makes the image worse: the dataset had no gains before it
+    t, record = run_fake_selfcal(tmpdir, monkeypatch,
+                                 [(1.0, 50.0), (2.0, 40.0)])
+    assert record['final'] == 'p0'
+    assert not os.path.exists(os.path.join(t + '.pscal', 'gains'))
+    with open(os.path.join(t + '.pscal', 'header')) as itemf:
+        assert itemf.read() == 'original\n'
+    with open(t + '.p2.fits') as fitsf:
+        assert fitsf.read() == '1.0 50.0\n'
@@ -0,0 +1,65 @@
+import numpy as np
+from scipy import ndimage
+
+from run_cal import NATIVE_PASSES
+from sumthreshold import flag_plane, sumthreshold
+
+
+def rfi_plane(seed=0, inject=True):
+    """Noisy time x channel amplitudes with a smooth bandpass and injected RFI."""
+    rng = np.random.default_rng(seed)
+    ntime, nchan = 120, 256
+    chans = np.arange(nchan)
+    bandpass = 10 + 2*np.sin(chans/40.)
+    amp = bandpass + rng.normal(0, 0.5, (ntime, nchan))
+    rfi = np.zeros(amp.shape, dtype=bool)
+    # Narrow-band interference present all the time
+    rfi[:, 100] = True
+    # Broad-band burst
+    rfi[60, 20:200] = True
+    # Weak but extended interference, only caught by the larger windows
+    rfi[10:40, 180:184] = True
+    # Single strong sample
+    rfi[90, 30] = True
+    if not inject:
+        return amp, np.zeros(amp.shape, dtype=bool)
+    amp[:, 100] += 20
+    amp[60, 20:200] += 10
+    amp[10:40, 180:184] += 2
+    amp[90, 30] += 50
+    return amp, rfi
+
+
+def test_sumthreshold_flags_window_excess():
+    res = np.zeros(32)
+    res[10:14] = 4
+    flags = sumthreshold(res, np.zeros(32, dtype=bool), 8, 4)
+    # No sample exceeds the threshold, but the 4-sample window does
+    assert np.array_equal(np.where(flags)[0], np.arange(10, 14))
+
+
+def test_flag_plane_finds_injected_rfi():
+    amp, rfi = rfi_plane()
+    flags = np.zeros(amp.shape, dtype=bool)
+    for _, flagpar in NATIVE_PASSES*2:
+        flags = flag_plane(amp, flags, flagpar)
+    assert np.all(flags[rfi])
+    # Every pass dilates the edges the previous one found, but the flags
+    # stay around the RFI
+    assert flags[~rfi].mean() < 0.1
+    near = ndimage.binary_dilation(rfi, iterations=20)
+    assert not np.any(flags[~near])
+
+
+def test_flag_plane_keeps_clean_data():
+    amp, _ = rfi_plane(inject=False)
+    flags = flag_plane(amp, np.zeros(amp.shape, dtype=bool), NATIVE_PASSES[0][1])
+    assert flags.mean() < 0.001
+
+
+def test_flag_plane_keeps_prior_flags():
+    amp, _ = rfi_plane()
+    prior = np.zeros(amp.shape, dtype=bool)
+    prior[:, :5] = True
+    flags = flag_plane(amp, prior, NATIVE_PASSES[0][1])
+    assert np.all(flags[prior])
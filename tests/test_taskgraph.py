@@ -0,0 +1,74 @@
+import os
+
+from taskgraph import TaskGraph
+
+
+def append(path, text):
+    def run(logf):
+        with open(os.path.join(path, 'flags'), 'a') as itemf:
+            itemf.write(text)
+        return 0
+    return run
+
+
+def fail_once(path, text, state):
+    def run(logf):
+        if not state.get('failed'):
+            state['failed'] = True
+            # Crash half way through: the dataset is already modified
+            with open(os.path.join(path, 'flags'), 'a') as itemf:
+                itemf.write('partial ')
+            return 1
+        return append(path, text)(logf)
+    return run
+
+
+def chain(tmpdir, flag2=None):
+    """gpcopy, flag1, flag2 updating one dataset in place, as in run_cal."""
+    vis = os.path.join(str(tmpdir), 'target.uv')
+    graph = TaskGraph(stampdir=os.path.join(str(tmpdir), '.taskgraph'))
+    graph.add('gpcopy', func=append(vis, 'gains '), updates=[vis])
+    graph.add('flag1', func=append(vis, 'flag1 '), updates=[vis])
+    graph.add('flag2', func=flag2 or append(vis, 'flag2 '), updates=[vis])
+    return graph, vis
+
+
+def statuses(graph):
+    return [task.status for task in graph.tasks]
+
+
+def test_inplace_chain_skipped_on_rerun(tmpdir):
+    graph, vis = chain(tmpdir)
+    os.makedirs(vis)
+    assert graph.run()
+    assert statuses(graph) == ['ran', 'ran', 'ran']
+
+    graph, vis = chain(tmpdir)
+    assert graph.run()
+    assert statuses(graph) == ['skipped', 'skipped', 'skipped']
+    with open(os.path.join(vis, 'flags')) as itemf:
+        assert itemf.read() == 'gains flag1 flag2 '
+
+
+def test_inplace_chain_resumes_after_failure(tmpdir):
+    state = {}
+    graph, vis = chain(tmpdir)
+    os.makedirs(vis)
+    graph, vis = chain(tmpdir, flag2=fail_once(vis, 'flag2 ', state))
+    assert not graph.run()
+    assert statuses(graph) == ['ran', 'ran', 'failed']
+
+    graph, vis = chain(tmpdir, flag2=fail_once(vis, 'flag2 ', state))
+    assert graph.run()
+    assert statuses(graph) == ['skipped', 'skipped', 'ran']
+
+
+def test_rerun_after_earlier_step_changes(tmpdir):
+    graph, vis = chain(tmpdir)
+    os.makedirs(vis)
+    assert graph.run()
+
+    graph, vis = chain(tmpdir)
+    graph.tasks[0].force = True
+    assert graph.run()
+    assert statuses(graph) == ['ran', 'ran', 'ran']